@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of lazy decoding (`__lazy__ = True`) for wide documents
+of which only a few fields are read.
+
+No server is needed, documents are encoded to BSON in memory and decoded
+from the bytes as a cursor does. Time covers decoding, wrapping, reading
+`TOUCHED` fields and computing `changes`. Memory is the total size of the
+objects reachable from the wrapped documents (including their snapshots).
+
+Usage::
+
+    python benchmarks/lazy_bench.py
+"""
+
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient
+from simplemongo import Document, ObjectId
+
+
+N = 2000
+
+TOUCHED = 5
+
+# name: (number of top level fields, number of items in nested values)
+SHAPES = [
+    ('flat', (200, 1)),
+    ('nested', (40, 25)),
+]
+
+col = MongoClient(connect=False)['_simplemongo_bench']['wide']
+
+
+class Wide(Document):
+    col = col
+
+
+class LazyWide(Document):
+    col = col
+    __lazy__ = True
+
+
+def make_data(i, fields, items):
+    raw = {'_id': ObjectId()}
+    for j in range(fields):
+        if j % 4 == 0:
+            v = {'name': 'field %s' % j, 'count': i, 'at': datetime.datetime.now()}
+            for n in range(items):
+                v['k%d' % n] = 'value %s' % n
+        elif j % 4 == 1:
+            v = [j, i, 'item %s' % j] * items
+        elif j % 4 == 2:
+            v = 'value %s of document %s' % (j, i)
+        else:
+            v = float(i * j)
+        raw['f%d' % j] = v
+    return BSON.encode(raw)
+
+
+def object_size(root):
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            # read as plain dict, without triggering decoding or copy on write
+            stack.extend(dict.keys(o))
+            stack.extend(dict.values(o))
+        elif isinstance(o, (list, tuple, set)):
+            stack.extend(o)
+        if hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+    return size
+
+
+def touch(doc, modify):
+    for j in range(TOUCHED):
+        doc['f%d' % (j * 4)]
+    if modify:
+        doc['f0']['count'] += 1
+    doc.changes
+
+
+def bench(shape, cls, lazy, modify):
+    datas = [make_data(i, *shape) for i in range(N)]
+    t = time.time()
+    docs = []
+    for data in datas:
+        if lazy:
+            doc = cls(RawBSONDocument(data), from_db=True)
+        else:
+            doc = cls(BSON(data).decode(), from_db=True)
+        touch(doc, modify)
+        docs.append(doc)
+    elapsed = time.time() - t
+    del datas
+    return elapsed, object_size(docs)
+
+
+def main():
+    print '%d documents, %d fields read' % (N, TOUCHED)
+    print '%-8s %-20s %10s %10s %10s' % ('shape', 'mode', 'size', 'time', 'memory')
+    for name, shape in SHAPES:
+        data_size = len(make_data(0, *shape))
+        for title, cls, lazy, modify in [('eager', Wide, False, False),
+                                         ('eager, 1 modified', Wide, False, True),
+                                         ('lazy', LazyWide, True, False),
+                                         ('lazy, 1 modified', LazyWide, True, True)]:
+            elapsed, size = bench(shape, cls, lazy, modify)
+            print '%-8s %-20s %9.1fK %8.1fms %8.1fMB' % (
+                name, title, data_size / 1024.0, elapsed * 1000, size / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main()
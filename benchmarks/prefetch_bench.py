@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of iterating a cursor with and without `prefetch()`, when about
+half of the time is waiting for batches.
+
+No server is needed: the cursor is a stand-in that sleeps `LATENCY`
+seconds for every batch (as waiting for a getMore does, without holding
+the GIL) and returns pre-generated raw documents, which are wrapped and
+processed for about the same time as a batch takes to fetch.
+
+Usage::
+
+    python benchmarks/prefetch_bench.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pymongo import MongoClient
+from simplemongo import Document, ObjectId
+from simplemongo.cursor import SimplemongoCursor
+
+
+BATCHES = 50
+
+BATCH_SIZE = 100
+
+LATENCY = 0.02
+
+col = MongoClient(connect=False)['_simplemongo_bench']['user']
+
+
+class User(Document):
+    col = col
+
+
+class StandInCursor(SimplemongoCursor):
+    def __init__(self, batches):
+        self.batches = list(batches)
+        super(StandInCursor, self).__init__(col, wrapper=User)
+
+    def _refresh(self):
+        if not self.batches:
+            return 0
+        time.sleep(LATENCY)
+        self._Cursor__data.extend(self.batches.pop(0))
+        return len(self._Cursor__data)
+
+
+def make_batches():
+    return [[{'_id': ObjectId(), 'name': 'user %s' % i, 'scores': range(20)}
+             for i in range(BATCH_SIZE)]
+            for _ in range(BATCHES)]
+
+
+def calibrate():
+    # Number of rounds of `process` that take LATENCY for a batch
+    doc = User({'scores': range(20)})
+    t = time.time()
+    for _ in range(BATCH_SIZE):
+        process(doc, 100)
+    return int(100 * LATENCY / (time.time() - t))
+
+
+def process(doc, rounds):
+    for _ in range(rounds):
+        sum(doc['scores'])
+
+
+def bench(depth, rounds):
+    cursor = StandInCursor(make_batches())
+    if depth:
+        cursor.prefetch(depth)
+    t = time.time()
+    n = 0
+    for doc in cursor:
+        process(doc, rounds)
+        n += 1
+    assert n == BATCHES * BATCH_SIZE
+    return time.time() - t
+
+
+def main():
+    rounds = calibrate()
+    print '%d batches of %d documents, %.0fms latency per batch' % (
+        BATCHES, BATCH_SIZE, LATENCY * 1000)
+    print '%-20s %10s %12s' % ('mode', 'time', 'docs/s')
+    for title, depth in [('no prefetch', 0), ('prefetch(1)', 1), ('prefetch(2)', 2)]:
+        elapsed = bench(depth, rounds)
+        print '%-20s %8.1fms %12.0f' % (title, elapsed * 1000, BATCHES * BATCH_SIZE / elapsed)
+
+
+if __name__ == '__main__':
+    main()
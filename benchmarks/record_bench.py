@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of holding many small documents of a fixed shape in memory,
+as documents, read-only documents or compact records
+(`SimplemongoCursor.records()`).
+
+No server is needed, raw documents are generated in memory. Memory is the
+total size of the objects reachable from the results (including their
+snapshots) minus the size of the shared values, `tracemalloc` is not
+available on Python 2. BSON is the total size of the documents in BSON,
+for reference.
+
+Usage::
+
+    python benchmarks/record_bench.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bson import BSON
+from pymongo import MongoClient
+from simplemongo import Document, ObjectId
+
+
+N = 100000
+
+col = MongoClient(connect=False)['_simplemongo_bench']['point']
+
+
+class Point(Document):
+    col = col
+    struct = {
+        'name': str,
+        'x': float,
+        'y': float,
+        'level': int,
+        'visible': bool,
+    }
+
+
+def make_raw(i):
+    return {
+        '_id': ObjectId(),
+        'name': 'point %s' % i,
+        'x': i * 0.5,
+        'y': i * 1.5,
+        'level': i,
+        'visible': True,
+    }
+
+
+def object_size(root, exclude):
+    seen = set(id(o) for o in exclude)
+    stack = [root]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            # read as plain dict, without triggering copy on write
+            stack.extend(dict.keys(o))
+            stack.extend(dict.values(o))
+        elif isinstance(o, (list, tuple)):
+            stack.extend(o)
+        if hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+        elif hasattr(o, '__slots__'):
+            stack.extend(getattr(o, k) for k in o.__slots__ if hasattr(o, k))
+    return size
+
+
+def bench(wrap):
+    raws = [make_raw(i) for i in range(N)]
+    # Values are the same in all modes, only the containers are counted
+    values = [v for raw in raws for v in raw.itervalues()] + raws[0].keys()
+    t = time.time()
+    results = [wrap(raw) for raw in raws]
+    elapsed = time.time() - t
+    del raws
+    return elapsed, object_size(results, values)
+
+
+def main():
+    RecordClass = Point.get_record_class()
+    bson_size = sum(len(BSON.encode(make_raw(i))) for i in range(N))
+    print '%d documents, %.1fMB in BSON' % (N, bson_size / 1024.0 / 1024)
+    print '%-20s %10s %10s' % ('mode', 'time', 'memory')
+    for title, wrap in [('dict', dict),
+                        ('document', lambda raw: Point(raw, from_db=True)),
+                        ('read only document', lambda raw: Point(raw, from_db=True, read_only=True)),
+                        ('record', RecordClass.from_dict)]:
+        elapsed, size = bench(wrap)
+        print '%-20s %8.1fms %8.1fMB' % (title, elapsed * 1000, size / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite of the hot paths of dstruct and models, to compare
+between versions of simplemongo or pymongo.
+
+Micro benchmarks time `validate_dict`, `CompiledStruct.validate`,
+`build_dict`, `diff_dicts`, `hash_dict`, `map_dict`, `retrieve_dict`,
+wrapping a fetched document (`Document.__init__`) and `Document.changes`
+on documents of these shapes:
+
+- flat: `--width` scalar fields
+- deep: dicts nested `--depth` levels
+- wide: `--width` scalar fields and `--width` small dicts
+- array: a list of `--length` ints and a list of `--length` / 10 dicts
+
+Macro benchmarks time `save`, `insert`, iterating `find`, `one` by `_id`
+and `update_changes` of `--count` documents of each shape. No server is
+needed: the collection is a stand-in that keeps documents as BSON in
+memory, so that encoding and decoding are timed as with a server, but
+not the network nor the server (the spec of `find` is ignored).
+
+Times are the best of `--repeat` runs, in microseconds per call (per
+document for macro benchmarks). Results can be written to a JSON file,
+and compared with those of a previous run, e.g.::
+
+    python benchmarks/suite.py --json before.json
+    # upgrade pymongo, or change the code
+    python benchmarks/suite.py --compare before.json
+
+which exits with 1 if a benchmark is slower than in `before.json`
+by more than `--threshold` (10% by default).
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import contextlib
+import subprocess
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+import bson
+import pymongo
+from bson import BSON
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from simplemongo import models, Document, ObjectId
+from simplemongo.cursor import SimplemongoCursor
+from simplemongo.dstruct import (
+    validate_dict, CompiledStruct, build_dict, diff_dicts, hash_dict, map_dict, retrieve_dict)
+
+
+# Seconds of each run, the number of calls is calibrated to take at least this
+MIN_TIME = 0.05
+
+client = MongoClient(connect=False)
+
+
+# Shapes: (struct, make_doc, dot key for `retrieve_dict`, modify)
+
+def flat_shape(width):
+    types = [int, str, float, bool]
+    values = [1, 'x', 1.5, True]
+    struct = dict(('f%s' % i, types[i % 4]) for i in range(width))
+
+    def make_doc(n):
+        doc = dict(('f%s' % i, values[i % 4]) for i in range(width))
+        doc['f0'] = n
+        return doc
+
+    def modify(doc):
+        doc['f0'] += 1
+
+    return struct, make_doc, 'f%s' % (width - 1), modify
+
+
+def deep_shape(depth):
+    struct = {'value': int, 'name': str}
+    for i in range(depth):
+        struct = {'value': int, 'name': str, 'sub': struct}
+    key = '.'.join(['sub'] * depth + ['value'])
+
+    def make_doc(n):
+        doc = {'value': n, 'name': 'leaf'}
+        for i in range(depth):
+            doc = {'value': i, 'name': 'node', 'sub': doc}
+        return doc
+
+    def modify(doc):
+        d = doc
+        for i in range(depth):
+            d = d['sub']
+        d['value'] += 1
+
+    return struct, make_doc, key, modify
+
+
+def wide_shape(width):
+    struct, make_flat, key, modify = flat_shape(width)
+    for i in range(width):
+        struct['d%s' % i] = {'a': int, 'b': str}
+
+    def make_doc(n):
+        doc = make_flat(n)
+        for i in range(width):
+            doc['d%s' % i] = {'a': i, 'b': 'y'}
+        return doc
+
+    def modify_wide(doc):
+        doc['d%s' % (width - 1)]['a'] += 1
+
+    return struct, make_doc, 'd%s.b' % (width - 1), modify_wide
+
+
+def array_shape(length):
+    struct = {
+        'name': str,
+        'scores': [int],
+        'items': [{'name': str, 'count': int}],
+    }
+    items = length // 10
+
+    def make_doc(n):
+        return {
+            'name': 'doc %s' % n,
+            'scores': range(length),
+            'items': [{'name': 'item %s' % i, 'count': i} for i in range(items)],
+        }
+
+    def modify(doc):
+        doc['items'][-1]['count'] += 1
+        doc['scores'].append(0)
+
+    return struct, make_doc, 'items.[%s].name' % (items - 1), modify
+
+
+def make_shapes(depth, width, length):
+    return OrderedDict([
+        ('flat', flat_shape(width)),
+        ('deep', deep_shape(depth)),
+        ('wide', wide_shape(width)),
+        ('array', array_shape(length)),
+    ])
+
+
+class StandInCollection(Collection):
+    """Keeps documents encoded in BSON by `_id`, in order of insertion"""
+    def __init__(self, name, store=None, **kwargs):
+        super(StandInCollection, self).__init__(client['_simplemongo_bench'], name, **kwargs)
+        self.__dict__['store'] = OrderedDict() if store is None else store
+
+    def with_options(self, codec_options=None, read_preference=None,
+                     write_concern=None, read_concern=None):
+        return StandInCollection(
+            self.name, self.store,
+            codec_options=codec_options or self.codec_options,
+            read_preference=read_preference or self.read_preference,
+            write_concern=write_concern or self.write_concern,
+            read_concern=read_concern or self.read_concern)
+
+    def save(self, doc, manipulate=True, **kwargs):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        self.store[doc['_id']] = BSON.encode(doc, codec_options=self.codec_options)
+        return doc['_id']
+
+    def insert_many(self, docs, ordered=True, **kwargs):
+        for doc in docs:
+            self.save(doc)
+
+    def update(self, spec, document, **kwargs):
+        # Only encoded as it would be sent, the stored document is not changed
+        BSON.encode(spec)
+        BSON.encode(document)
+        return {'n': 1, 'nModified': 1, 'ok': 1.0, 'updatedExisting': True}
+
+    def remove(self, spec_or_id=None, **kwargs):
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        self.store.pop(spec_or_id.get('_id'), None)
+        return {'n': 1, 'ok': 1.0}
+
+    def find_one(self, filter=None, *args, **kwargs):
+        data = self.store.get(filter['_id'])
+        if data is None:
+            return None
+        return BSON(data).decode(codec_options=self.codec_options)
+
+
+class StandInCursor(SimplemongoCursor):
+    """Fetches the documents of a `StandInCollection` in batches,
+    decoded from the concatenated BSON as pymongo does for a reply"""
+    def _refresh(self):
+        data = self._Cursor__data
+        if data or self._Cursor__id == 0:
+            return len(data)
+        if self._Cursor__id is None:
+            self.__values = self.collection.store.values()
+            limit = abs(self._Cursor__limit)
+            if limit:
+                self.__values = self.__values[:limit]
+            self.__position = 0
+        size = self._Cursor__batch_size or 101
+        batch = self.__values[self.__position:self.__position + size]
+        self.__position += len(batch)
+        data.extend(bson.decode_all(''.join(batch), self._Cursor__codec_options))
+        self._Cursor__id = 0 if self.__position >= len(self.__values) else 1
+        return len(data)
+
+
+@contextlib.contextmanager
+def standin_cursors():
+    # `Document.find` creates `SimplemongoCursor` of the models module
+    models.SimplemongoCursor = StandInCursor
+    try:
+        yield
+    finally:
+        models.SimplemongoCursor = SimplemongoCursor
+
+
+def best_time(func, repeat, number=None):
+    """Return (seconds per call, number of calls per run)"""
+    if number is None:
+        number = 1
+        while True:
+            t = timeit.timeit(func, number=number)
+            if t >= MIN_TIME:
+                break
+            number *= 2 if t * 10 > MIN_TIME else 10
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number, number
+
+
+def micro_benchmarks(shape_name, shape):
+    struct, make_doc, key, modify = shape
+    doc = make_doc(0)
+    other = make_doc(1)
+    compiled = CompiledStruct(struct)
+
+    klass = type('%sDoc' % shape_name.capitalize(), (Document, ), {
+        'col': StandInCollection(shape_name),
+        'struct': struct,
+    })
+    raw = dict(doc, _id=ObjectId())
+    modified = klass(raw, from_db=True)
+    modify(modified)
+
+    return [
+        ('validate_dict', lambda: validate_dict(doc, struct)),
+        ('compiled_validate', lambda: compiled.validate(doc)),
+        ('build_dict', lambda: build_dict(struct)),
+        ('diff_dicts', lambda: diff_dicts(doc, other)),
+        ('hash_dict', lambda: hash_dict(doc)),
+        ('map_dict', lambda: map_dict(doc)),
+        ('retrieve_dict', lambda: retrieve_dict(doc, key)),
+        ('wrap', lambda: klass(raw, from_db=True)),
+        ('changes', lambda: modified.changes),
+    ]
+
+
+def macro_benchmarks(shape_name, shape, count):
+    """Return [(name, setup, run)], `run` takes what `setup` returns
+    and handles `count` documents"""
+    struct, make_doc, key, modify = shape
+    klass = type('%sDoc' % shape_name.capitalize(), (Document, ), {
+        'col': StandInCollection(shape_name),
+        'struct': struct,
+    })
+
+    def fill():
+        klass.col.store.clear()
+        klass.insert(make_doc(i) for i in range(count))
+
+    def setup_save():
+        klass.col.store.clear()
+        return [klass(make_doc(i)) for i in range(count)]
+
+    def run_save(docs):
+        for doc in docs:
+            doc.save()
+
+    def setup_insert():
+        klass.col.store.clear()
+        return [make_doc(i) for i in range(count)]
+
+    def run_insert(docs):
+        klass.insert(docs, keep_ids=False)
+
+    def run_find(_):
+        for doc in klass.find():
+            pass
+
+    def setup_one():
+        fill()
+        return list(klass.col.store)
+
+    def run_one(ids):
+        for _id in ids:
+            klass.one(_id)
+
+    def setup_update():
+        fill()
+        docs = list(klass.find())
+        for doc in docs:
+            modify(doc)
+        return docs
+
+    def run_update(docs):
+        for doc in docs:
+            doc.update_changes()
+
+    return [
+        ('save', setup_save, run_save),
+        ('insert', setup_insert, run_insert),
+        ('find', fill, run_find),
+        ('one', setup_one, run_one),
+        ('update_changes', setup_update, run_update),
+    ]
+
+
+def run(args):
+    shapes = make_shapes(args.depth, args.width, args.length)
+    selected = args.shape.split(',') if args.shape else shapes.keys()
+    results = OrderedDict()
+
+    def record(name, seconds, number):
+        if args.filter and args.filter not in name:
+            return
+        results[name] = {'us': seconds * 1e6, 'number': number}
+        print '%-40s %12.2f us' % (name, seconds * 1e6)
+        sys.stdout.flush()
+
+    for shape_name in selected:
+        shape = shapes[shape_name]
+        for name, func in micro_benchmarks(shape_name, shape):
+            full = 'micro.%s.%s' % (name, shape_name)
+            if args.filter and args.filter not in full:
+                continue
+            seconds, number = best_time(func, args.repeat)
+            record(full, seconds, number)
+
+        with standin_cursors():
+            for name, setup, run_macro in macro_benchmarks(shape_name, shape, args.count):
+                full = 'macro.%s.%s' % (name, shape_name)
+                if args.filter and args.filter not in full:
+                    continue
+                times = []
+                for _ in range(args.repeat):
+                    state = setup()
+                    start = time.time()
+                    run_macro(state)
+                    times.append(time.time() - start)
+                record(full, min(times) / args.count, args.count)
+    return results
+
+
+def git_commit():
+    # The commit of the tree benchmarked, None if not in a git repository
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def meta(args):
+    return OrderedDict([
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('commit', git_commit()),
+        ('pymongo', pymongo.version),
+        ('bson_c_extension', bson.has_c()),
+        ('params', OrderedDict([('depth', args.depth), ('width', args.width),
+                                ('length', args.length), ('count', args.count)])),
+    ])
+
+
+def compare(results, path, threshold):
+    """Print the ratio of results to those in `path`,
+    return the names of the benchmarks slower by more than `threshold`"""
+    with open(path) as f:
+        previous = json.load(f)
+    if previous['meta'].get('params') != results['meta']['params']:
+        print 'warning: parameters differ from %s: %s' % (path, previous['meta'].get('params'))
+    regressions = []
+    print
+    print '%-40s %12s %12s %8s' % ('compared to ' + os.path.basename(path), 'before', 'after', 'ratio')
+    for name, r in results['results'].iteritems():
+        before = previous['results'].get(name)
+        if before is None:
+            continue
+        ratio = r['us'] / before['us']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' slower'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = ' faster'
+        print '%-40s %12.2f %12.2f %7.2fx%s' % (name, before['us'], r['us'], ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of dstruct and models')
+    parser.add_argument('--shape', help='comma separated shapes to run, all by default: flat,deep,wide,array')
+    parser.add_argument('--filter', help='only run benchmarks with this in their name, e.g. macro.find')
+    parser.add_argument('--depth', type=int, default=6, help='levels of the deep shape')
+    parser.add_argument('--width', type=int, default=50, help='fields of the flat and wide shapes')
+    parser.add_argument('--length', type=int, default=1000, help='items of the array shape')
+    parser.add_argument('--count', type=int, default=1000, help='documents of macro benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best is kept')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare the results to those of this file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='ratio of slowdown reported as regression by --compare')
+    args = parser.parse_args()
+
+    results = OrderedDict([('meta', meta(args)), ('results', run(args))])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print
+            print '%s slower by more than %d%%: %s' % (
+                len(regressions), args.threshold * 100, ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
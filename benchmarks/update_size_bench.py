@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the BSON size of update specs generated by `Document.changes`.
+
+`first layer` is how the spec was generated before `diff_update`,
+by comparing the first layer only with `diff_dicts`.
+
+Usage::
+
+    python benchmarks/update_size_bench.py
+"""
+
+import os
+import sys
+import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bson import BSON
+from simplemongo.dstruct import diff_dicts, diff_update
+
+
+def first_layer_update(new, origin):
+    c = {}
+    diff = diff_dicts(new, origin)
+    if diff['+']:
+        c['$set'] = diff['+']
+    for i in diff['~']:
+        if isinstance(new[i], int) and isinstance(origin[i], int):
+            c.setdefault('$inc', {})[i] = new[i] - origin[i]
+        else:
+            c.setdefault('$set', {})[i] = new[i]
+    if diff['-']:
+        c['$unset'] = dict((i, '') for i in diff['-'])
+    return c
+
+
+def profile_doc():
+    return {
+        'name': 'reorx',
+        'counters': {'login': 10, 'posts': 200},
+        'attributes': dict(('attr%s' % i, 'value %s' % i) for i in range(200)),
+        'history': [{'action': 'login', 'at': i} for i in range(300)],
+        'tags': ['tag%s' % i for i in range(100)],
+    }
+
+
+def inc_counter(d):
+    d['counters']['login'] += 1
+
+
+def set_attribute(d):
+    d['attributes']['attr10'] = 'changed'
+
+
+def append_history(d):
+    d['history'].append({'action': 'logout', 'at': 301})
+
+
+def remove_tag(d):
+    d['tags'].remove('tag50')
+
+
+def main():
+    print '%-16s %12s %12s' % ('modification', 'first layer', 'diff_update')
+    for modify in (inc_counter, set_attribute, append_history, remove_tag):
+        origin = profile_doc()
+        new = copy.deepcopy(origin)
+        modify(new)
+        old_size = len(BSON.encode(first_layer_update(new, origin)))
+        new_size = len(BSON.encode(diff_update(new, origin)))
+        print '%-16s %10s B %10s B' % (modify.__name__, old_size, new_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of struct validation on deep and wide structs.
+
+`validate_dict` compiles the struct on every call, which is what
+`StructuredDict.validate` used to pay, `CompiledStruct.validate`
+only walks the document.
+
+Usage::
+
+    python benchmarks/validate_bench.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from simplemongo.dstruct import validate_dict, CompiledStruct
+
+
+def deep_struct(depth):
+    st = {'value': int, 'name': str}
+    for i in range(depth):
+        st = {'value': int, 'name': str, 'children': [st], 'sub': {'n': int}}
+    return st
+
+
+def deep_doc(depth, width=2):
+    d = {'value': 1, 'name': 'leaf'}
+    for i in range(depth):
+        d = {'value': i, 'name': 'node', 'children': [d] * width, 'sub': {'n': i}}
+    return d
+
+
+def deep_required(depth):
+    fields = []
+    path = None
+    for i in range(depth):
+        fields.append('value' if path is None else path + '.value')
+        fields.append('sub.n' if path is None else path + '.sub.n')
+        path = 'children' if path is None else path + '.children'
+    return fields
+
+
+def wide_struct(width):
+    st = {}
+    for i in range(width):
+        st['f%s' % i] = [int, str, float, bool][i % 4]
+        st['d%s' % i] = {'a': int, 'b': str}
+    return st
+
+
+def wide_doc(width):
+    values = [1, 'x', 1.0, True]
+    d = {}
+    for i in range(width):
+        d['f%s' % i] = values[i % 4]
+        d['d%s' % i] = {'a': i, 'b': 'y'}
+    return d
+
+
+def bench(title, doc, struct, required_fields, strict_fields, number):
+    compiled = CompiledStruct(struct, required_fields, strict_fields)
+
+    t_dict = min(timeit.repeat(
+        lambda: validate_dict(doc, struct, required_fields, strict_fields),
+        number=number, repeat=3))
+    t_compiled = min(timeit.repeat(
+        lambda: compiled.validate(doc),
+        number=number, repeat=3))
+
+    print '%-20s validate_dict: %8.2f us  compiled: %8.2f us  speedup: %.1fx' % (
+        title, t_dict / number * 1e6, t_compiled / number * 1e6, t_dict / t_compiled)
+
+
+def main():
+    bench('deep (depth=6)', deep_doc(6), deep_struct(6),
+          deep_required(6), ['name'], 200)
+    bench('wide (width=200)', wide_doc(200), wide_struct(200),
+          ['f%s' % i for i in range(0, 200, 2)],
+          ['d%s.a' % i for i in range(0, 200, 3)], 500)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of wrapping documents fetched from database, as
+`SimplemongoCursor.next` does for every result of `find()`.
+
+No server is needed, raw documents are generated in memory.
+Memory is the total size of the objects reachable from the wrapped
+documents (including their snapshots).
+
+Usage::
+
+    python benchmarks/wrap_bench.py
+"""
+
+import os
+import sys
+import copy
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pymongo import MongoClient
+from simplemongo import Document, ObjectId
+
+
+N = 10000
+
+col = MongoClient(connect=False)['_simplemongo_bench']['user']
+
+
+class User(Document):
+    col = col
+    struct = {
+        'name': str,
+        'age': int,
+        'attributes': {
+            'vitality': float,
+            'armor': int,
+        },
+        'skills': [
+            {
+                'name': str,
+                'level': int,
+            }
+        ],
+        'created_at': datetime.datetime,
+    }
+
+
+def make_raw(i):
+    return {
+        '_id': ObjectId(),
+        'name': 'user %s' % i,
+        'age': i % 80,
+        'attributes': {'vitality': 100.0, 'armor': i % 30},
+        'skills': [{'name': 'skill %s' % j, 'level': j} for j in range(10)],
+        'created_at': datetime.datetime.now(),
+    }
+
+
+def object_size(root):
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            # read as plain dict, without triggering copy on write
+            stack.extend(dict.keys(o))
+            stack.extend(dict.values(o))
+        elif isinstance(o, (list, tuple)):
+            stack.extend(o)
+        if hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+    return size
+
+
+def wrap_deepcopy(raw):
+    # How documents were wrapped before copy on write
+    doc = User()
+    dict.update(doc, copy.deepcopy(raw))
+    doc._raw = raw
+    doc._in_db = True
+    return doc
+
+
+def wrap_cow(raw):
+    return User(raw, from_db=True)
+
+
+def wrap_cow_array(raw):
+    # The list of skills is copied when got, as it may be modified
+    doc = User(raw, from_db=True)
+    doc['skills']
+    return doc
+
+
+def wrap_read_only(raw):
+    return User(raw, from_db=True, read_only=True)
+
+
+def wrap_cow_modified(raw):
+    doc = User(raw, from_db=True)
+    doc['attributes']['armor'] += 1
+    return doc
+
+
+def bench(wrap):
+    raws = [make_raw(i) for i in range(N)]
+    t = time.time()
+    docs = [wrap(raw) for raw in raws]
+    elapsed = time.time() - t
+    del raws
+    return elapsed, object_size(docs)
+
+
+def main():
+    print '%d documents' % N
+    print '%-28s %10s %10s' % ('mode', 'time', 'memory')
+    for title, wrap in [('deepcopy (previous)', wrap_deepcopy),
+                        ('copy on write', wrap_cow),
+                        ('copy on write, 1 modified', wrap_cow_modified),
+                        ('copy on write, array got', wrap_cow_array),
+                        ('read only', wrap_read_only)]:
+        elapsed, size = bench(wrap)
+        print '%-28s %8.1fms %8.1fMB' % (title, elapsed * 1000, size / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 
 __all__ = [
-    'Document', 'Struct', 'ObjectId', 'oid',
+    'Document', 'Struct', 'ObjectId', 'oid', 'Session', 'IdentityMap',
 ]
 
 from bson.objectid import ObjectId
 from .dstruct import Struct
 from .models import Document, oid
+from .session import Session, IdentityMap
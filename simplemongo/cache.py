@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Read-through cache for `Document.one` lookups by `_id`.
+
+A `Document` subclass gets cached by assigning a backend to `__cache__`
+and optionally a TTL in seconds to `__cache_ttl__`::
+
+    class Config(Document):
+        col = db['config']
+        __cache__ = LRUCache(max_size=10000)
+        __cache_ttl__ = 300
+
+Values are stored as BSON bytes, so every hit decodes into new dicts and
+callers can not modify each other's data. `save`, `update_self`
+(`update_changes`), `remove`, `auto_fix` and `Session.flush` invalidate
+the entries of the written documents, in the backends of all the classes
+of the same collection (see `invalidate`), not only of the class written by.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class CacheBackend(object):
+    """Interface of cache backends, values are bytes and keys are str"""
+
+    def get(self, key):
+        """Return the value of `key`, or None if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """Set `key` to `value`, expires after `ttl` seconds if not None"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """In-process backend, evicts the least recently used key
+    when `max_size` is exceeded"""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or (item[1] is not None and item[1] < time.time()):
+                self.misses += 1
+                return None
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            expire = None
+        else:
+            expire = time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expire)
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def cache_key(col, _id):
+    # repr keeps ObjectId('...') and '...' apart
+    return '%s:%r' % (col.full_name, _id)
+
+
+# {collection full name: backends that cached documents of it},
+# replaced, not changed in place, as it is iterated without lock
+_backends = {}
+
+_backends_lock = threading.Lock()
+
+
+def register(col, backend):
+    """Remember that `backend` caches documents of `col`"""
+    name = col.full_name
+    if backend in _backends.get(name, ()):
+        return
+    with _backends_lock:
+        backends = _backends.get(name, ())
+        if backend not in backends:
+            _backends[name] = backends + (backend, )
+
+
+def invalidate(col, _id):
+    """Delete the entry of `_id` of `col` from every backend it is
+    cached in, whichever `Document` class it was cached by"""
+    backends = _backends.get(col.full_name)
+    if backends:
+        key = cache_key(col, _id)
+        for backend in backends:
+            backend.delete(key)
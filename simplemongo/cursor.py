@@ -1,29 +1,344 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
+import time
+import weakref
+import threading
+from Queue import Queue, Empty, Full
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
 from pymongo.cursor import Cursor
+from . import tracing
+
+
+# Put in the prefetch queue after the last batch
+_DONE = object()
+
+
+class _Raised(object):
+    """An exception raised in the prefetch thread"""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def get_field(doc, dot_key):
+    """Get value by `dot_key` from `doc` like a projection does,
+    a list on the way gives the list of values of its items,
+    None is returned if not exist.
+
+    A `Document` is read without copy on write, so the value got
+    should not be modified."""
+    def recurse(o, keys):
+        if not keys:
+            return o
+        if isinstance(o, dict):
+            if keys[0] not in o:
+                return None
+            return recurse(o[keys[0]], keys[1:])
+        if isinstance(o, list):
+            return [recurse(i, keys) for i in o]
+        return None
+
+    keys = dot_key.split('.')
+    peek = getattr(doc, '_peek', None)
+    if peek is not None:
+        return recurse(peek(keys[0]), keys[1:])
+    return recurse(doc, keys)
+
+
+def _put(queue, item, stop):
+    # Wait for a free slot until `stop` is set
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _prefetch(cursor_ref, queue, stop):
+    """Run in the prefetch thread, put batches of raw documents fetched by
+    the cursor in `queue`. Only a weak reference of the cursor is kept
+    while waiting, so that the cursor can be collected (and stop the thread)
+    when it is dropped by the consumer."""
+    try:
+        while not stop.is_set():
+            cursor = cursor_ref()
+            if cursor is None:
+                return
+            data = cursor._Cursor__data
+            if cursor._Cursor__empty or not (data or cursor._refresh()):
+                item = _DONE
+            else:
+                item = list(data)
+                data.clear()
+                if cursor._Cursor__manipulate:
+                    col = cursor.collection
+                    item = [col.database._fix_outgoing(i, col) for i in item]
+            del cursor, data
+            if not _put(queue, item, stop) or item is _DONE:
+                return
+    except Exception:
+        _put(queue, _Raised(sys.exc_info()), stop)
 
 
 class SimplemongoCursor(Cursor):
+    """Cursor that wraps results by `wrapper`, a `Document` subclass"""
     def __init__(self, *args, **kwargs):
+        self.__prefetch_depth = 0
+        self.__prefetch_thread = None
         self.__wrapper = kwargs.pop('wrapper')
+        self.__read_only = kwargs.pop('read_only', False)
+        self.__raw = False
+        self.__bson = False
+        self.__fields = None
+        self.__record_class = None
+        self.__references = None
+        self.__resolved = []
+        self.__plan_guard = self.__wrapper.__plan_guard__
 
         super(SimplemongoCursor, self).__init__(*args, **kwargs)
 
-    def next(self):
-        # Directly call pymongo Cursor's `next` method
-        raw = super(SimplemongoCursor, self).next()
+    def _clone_base(self):
+        return self.__class__(self.collection, wrapper=self.__wrapper,
+                              read_only=self.__read_only)
 
-        if raw is None:
-            return None
+    def _clone(self, deepcopy=True):
+        # A clone, e.g. by `clone` or an index like `find()[10]`, which
+        # is got from a clone, returns results the same way
+        clone = super(SimplemongoCursor, self)._clone(deepcopy)
+        clone._Cursor__codec_options = self._Cursor__codec_options
+        clone.__raw = self.__raw
+        clone.__bson = self.__bson
+        clone.__fields = self.__fields
+        clone.__record_class = self.__record_class
+        clone.__references = self.__references
+        clone.__prefetch_depth = self.__prefetch_depth
+        return clone
+
+    def explain(self):
+        # The plan is returned as it is, and not checked by the plan guard
+        c = self.clone()
+        c._Cursor__codec_options = self.collection.codec_options
+        c.__plan_guard = None
+        c.__references = None
+        c.__prefetch_depth = 0
+        c.__bson = True
+        c._Cursor__explain = True
+        # Always use a hard limit for explains, like pymongo
+        if c._Cursor__limit:
+            c._Cursor__limit = -abs(c._Cursor__limit)
+        return next(c)
+
+    def __check_plan(self):
+        # Only before the first query of the cursor
+        guard = self.__plan_guard
+        self.__plan_guard = None
+        guard.check_cursor(self)
+
+    def __project(self, fields, exclude_id=False):
+        self._Cursor__check_okay_to_chain()
+        projection = dict((f, 1) for f in fields)
+        if exclude_id:
+            projection['_id'] = 0
+        self._Cursor__projection = projection
+
+    def raw(self, *fields):
+        """Return results as plain dicts, not wrapped by `wrapper`.
+
+        If `fields` are given, only they (and `_id`) are fetched.
+        """
+        if fields:
+            self.__project(fields)
+        self.__raw = True
+        return self
+
+    def bson(self):
+        """Return results as `RawBSONDocument`, not decoded,
+        for copying documents as they are (e.g. `Document.export`)"""
+        self._Cursor__check_okay_to_chain()
+        self._Cursor__codec_options = self._Cursor__codec_options._replace(
+            document_class=RawBSONDocument)
+        self.__bson = True
+        return self
 
-        return self.__wrapper(raw, from_db=True)
+    def values_list(self, *fields):
+        """Return results as tuples of the values of `fields`,
+        only `fields` are fetched.
 
-    def __getitem__(self, index):
-        rv = super(SimplemongoCursor, self).__getitem__(index)
+        >>> User.find().values_list('name', 'attributes.armor').next()
+        ('reorx', 20)
+        """
+        assert fields, '`values_list` requires at least one field'
+        self.__project(fields, exclude_id='_id' not in fields)
+        self.__fields = fields
+        return self
 
-        if isinstance(rv, dict):
-            return self.__wrapper(rv, from_db=True)
-        else:
-            # rv is SimplemongoCursor instance
+    def records(self):
+        """Return results as compact records of the fields in `struct`
+        (see `record.Record`), only these fields are fetched."""
+        record_class = self.__wrapper.get_record_class()
+        self.__project(record_class._fields)
+        self.__record_class = record_class
+        return self
+
+    def prefetch(self, *paths, **kwargs):
+        """Fetch ahead, batches or referenced documents:
+
+        `prefetch(depth=2)` (or `prefetch(2)`) fetches batches in a
+        background thread while the results are processed, at most `depth`
+        batches are fetched ahead. Results are still wrapped in the iterating
+        thread. The thread is stopped by `close`, `rewind`, or when the cursor
+        is collected, e.g. after breaking out of
+        `for doc in Document.find().prefetch()`.
+
+        `prefetch('owner', 'members')` resolves the documents referenced by
+        these paths of `references` of the document class for a whole batch
+        at once, see `Document.ref`. Both can be combined with
+        `prefetch('owner', depth=2)`.
+        """
+        depth = kwargs.pop('depth', None)
+        assert not kwargs, 'unexpected arguments %s' % kwargs.keys()
+        if len(paths) == 1 and isinstance(paths[0], (int, long)):
+            depth = paths[0]
+            paths = ()
+        self._Cursor__check_okay_to_chain()
+        if paths:
+            declared = self.__wrapper.references or {}
+            for path in paths:
+                assert path in declared, '%s is not in `references` of %s' % (
+                    path, self.__wrapper.__name__)
+            self.__references = paths
+        if depth is not None or not paths:
+            depth = 2 if depth is None else depth
+            assert depth > 0, '`depth` should be positive'
+            self.__prefetch_depth = depth
+        return self
+
+    def __start_prefetch(self):
+        self.__prefetch_queue = Queue(self.__prefetch_depth)
+        self.__prefetch_stop = threading.Event()
+        self.__prefetched = []
+        self.__prefetch_thread = threading.Thread(
+            target=_prefetch,
+            args=(weakref.ref(self), self.__prefetch_queue, self.__prefetch_stop))
+        self.__prefetch_thread.daemon = True
+        self.__prefetch_thread.start()
+
+    def __stop_prefetch(self):
+        if self.__prefetch_thread is None:
+            return
+        self.__prefetch_stop.set()
+        if self.__prefetch_thread is not threading.current_thread():
+            self.__prefetch_thread.join()
+        self.__prefetch_thread = None
+
+    def __next_prefetched(self):
+        if self.__prefetch_thread is None:
+            self.__start_prefetch()
+        while not self.__prefetched:
+            try:
+                # Wait with timeout, or KeyboardInterrupt is not raised
+                item = self.__prefetch_queue.get(timeout=1)
+            except Empty:
+                continue
+            if item is _DONE:
+                # Keep raising StopIteration on later calls
+                self.__prefetch_queue.put(item)
+                raise StopIteration
+            if isinstance(item, _Raised):
+                self.__prefetch_queue.put(_DONE)
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            item.reverse()
+            self.__prefetched = item
+        return self.__prefetched.pop()
+
+    def _refresh(self):
+        # Without round trip if killed, exhausted or not consumed,
+        # explains are not traced
+        if (not tracing.listeners or self._Cursor__killed or self._Cursor__id == 0 or
+                self._Cursor__data or self._Cursor__explain):
+            return super(SimplemongoCursor, self)._refresh()
+        operation = 'find' if self._Cursor__id is None else 'getmore'
+        start = time.time()
+        count = super(SimplemongoCursor, self)._refresh()
+        tracing.emit(operation, self.collection, start, count, list(self._Cursor__data))
+        return count
+
+    def close(self):
+        self.__stop_prefetch()
+        super(SimplemongoCursor, self).close()
+
+    def rewind(self):
+        self.__stop_prefetch()
+        self.__resolved = []
+        return super(SimplemongoCursor, self).rewind()
+
+    def __del__(self):
+        if self.__prefetch_thread is not None:
+            # No join, the thread only holds a weak reference of the cursor
+            self.__prefetch_stop.set()
+        super(SimplemongoCursor, self).__del__()
+
+    def __wrap(self, raw):
+        if self.__bson:
+            return raw
+        if isinstance(raw, RawBSONDocument) and (
+                self.__raw or self.__fields is not None or self.__record_class is not None):
+            # Fetched by a `__lazy__` document class
+            raw = BSON(raw.raw).decode(self.__wrapper.col.codec_options)
+        if self.__record_class is not None:
+            return self.__record_class.from_dict(raw)
+        if self.__fields is not None:
+            return tuple(get_field(raw, f) for f in self.__fields)
+        if self.__raw:
+            return raw
+        return self.__wrapper.wrap(
+            raw, read_only=self.__read_only, projection=self._Cursor__projection)
+
+    def __next_raw(self):
+        if self.__prefetch_depth:
+            return self.__next_prefetched()
+        # Directly call pymongo Cursor's `next` method
+        return super(SimplemongoCursor, self).next()
+
+    def __take_batch(self):
+        # The raw documents left in the batch fetched, without fetching more
+        if self.__prefetch_depth:
+            rv = self.__prefetched[::-1]
+            self.__prefetched = []
             return rv
+        data = self._Cursor__data
+        rv = list(data)
+        data.clear()
+        if self._Cursor__manipulate:
+            col = self.collection
+            rv = [col.database._fix_outgoing(i, col) for i in rv]
+        return rv
+
+    def __next_resolved(self):
+        if not self.__resolved:
+            assert not (self.__raw or self.__bson or self.__fields is not None or
+                        self.__record_class is not None), \
+                'references are only resolved for documents'
+            raws = [self.__next_raw()]
+            raws.extend(self.__take_batch())
+            docs = [self.__wrap(raw) for raw in raws if raw is not None]
+            self.__wrapper.resolve_refs(docs, *self.__references)
+            docs.reverse()
+            self.__resolved = docs
+        return self.__resolved.pop()
+
+    def next(self):
+        if self.__plan_guard is not None:
+            self.__check_plan()
+        if self.__references:
+            return self.__next_resolved()
+
+        raw = self.__next_raw()
+        if raw is None:
+            return None
+
+        return self.__wrap(raw)
@@ -86,12 +86,111 @@ def check_struct(struct):
                 raise StructError('value "%s" is not one of ALLOW_TYPES' % v)
 
 
-def _remove_list_mark(key):
-    if '[' in key:
-        index = key.find('[')
-        key = key[0:index - 1] + key[index + 3:]
-        return _remove_list_mark(key)
-    return key
+class _Node(object):
+    """One node of a compiled struct, see `CompiledStruct`"""
+    __slots__ = ('path', 'typ', 'strict', 'required', 'required_set', 'not_none',
+                 'children', 'item')
+
+
+def _compile_node(st, path, local_required, strict_fields):
+    node = _Node()
+    node.path = path
+    node.typ = get_typ(st)
+    node.strict = path in strict_fields
+
+    # Keys required right under this node, keep order and duplicates
+    # as they appear in error messages
+    node.required = [i.split('.')[0] for i in local_required]
+    node.required_set = frozenset(node.required)
+    node.not_none = bool(node.required) and node.typ is dict
+    node.children = None
+    node.item = None
+
+    if isinstance(st, dict):
+        node.children = []
+        for k, nst in st.iteritems():
+            kdot = k + '.'
+            next_required = [i[len(kdot):] for i in local_required if i.startswith(kdot)]
+            if path is None:
+                nk = k
+            else:
+                nk = path + '.' + k
+            node.children.append(
+                (k, _compile_node(nst, nk, next_required, strict_fields)))
+    elif isinstance(st, list) and len(st) == 1:
+        # List items share the path (list marks are not part of it)
+        # and the required fields of the list itself
+        node.item = _compile_node(st[0], path, local_required, strict_fields)
+    return node
+
+
+def _check_node(node, o, ck):
+    # `ck` is the current key, None means it equals `node.path`,
+    # which is true until a list is walked through
+    if o is None:
+        if node.not_none:
+            raise TypeError(
+                "On key '%s' None, should not be None since %s are required in it" %
+                (node.path if ck is None else ck, node.required))
+        if node.strict:
+            raise TypeError("On key '%s' %s, %s, should be type %s" % (
+                node.path if ck is None else ck, o, type(o), node.typ))
+        return
+
+    elif not isinstance(o, node.typ):
+        raise TypeError("On key '%s' %s, %s, should be type %s" % (
+            node.path if ck is None else ck, o, type(o), node.typ))
+
+    if node.children is not None:
+        required = node.required_set
+        for k, child in node.children:
+            if k in o:
+                if ck is None:
+                    _check_node(child, o[k], None)
+                else:
+                    _check_node(child, o[k], ck + '.' + k)
+            elif k in required:
+                raise KeyError("Under key '%s', subkey '%s', value %s, not exist" % (
+                    (node.path if ck is None else ck) or '$', k, o))
+
+    elif node.item is not None:
+        item = node.item
+        if ck is None:
+            ck = node.path
+        for loop, i in enumerate(o):
+            _check_node(item, i, '%s.[%s]' % (ck, loop))
+
+
+class CompiledStruct(object):
+    """
+    A validation plan compiled from `struct`, `required_fields` and `strict_fields`.
+
+    Everything that only depends on the definition (type tuples, required keys
+    of each node, strictness of each path) is computed once here,
+    so that `validate` only walks the document.
+
+    Paths of `required_fields` and `strict_fields` are struct paths,
+    list marks like `skills.[0].level` are not part of them.
+    """
+    def __init__(self, struct, required_fields=None, strict_fields=None):
+        assert isinstance(struct, dict), 'struct must be dict'
+        check_struct(struct)
+
+        self.struct = struct
+        self.required_fields = required_fields
+        self.strict_fields = strict_fields
+
+        self._root = _compile_node(
+            struct, None, list(required_fields or []), frozenset(strict_fields or []))
+
+    def compiled_from(self, struct, required_fields, strict_fields):
+        """Whether this plan was compiled from exactly these objects"""
+        return (self.struct is struct and
+                self.required_fields is required_fields and
+                self.strict_fields is strict_fields)
+
+    def validate(self, doc):
+        _check_node(self._root, doc, None)
 
 
 def validate_dict(doc, struct, required_fields=None, strict_fields=None):
@@ -99,13 +198,16 @@ def validate_dict(doc, struct, required_fields=None, strict_fields=None):
     Validate a dict from the defined structure.
 
     Thoughts:
-        In the inner function `recurse_check`, treat `st` as basement,
-        iter every key and value to see if key-value exists and fits in `o`,
+        `struct` is compiled into a `CompiledStruct` first, then the compiled
+        nodes are walked along with `o`, each key of a dict node is checked
+        to see if key-value exists and fits in `o`,
 
         during the iteration, when list is encountered, check if the value of
         the same key in `o` is list, then iter the list value from `o` ( not `st`),
-        and pass the first item of `st`s list value as `st` argument to the
-        newly running `recurse_check`.
+        and check every item against the item node of the list.
+
+    To validate many dicts against the same struct, compile it once
+    with `CompiledStruct` and call its `validate` method instead.
 
     This function can strictly check that if every key in `struct`
     is the same as in `doc`, that is, `struct` -> `doc`, so this example will not pass:
@@ -156,133 +258,7 @@ def validate_dict(doc, struct, required_fields=None, strict_fields=None):
     ... }
     >>> validate_dict(doc, struct)
     """
-    logger.debug('------call validate_dict()')
-
-    # assert isinstance(doc, dict), 'doc must be dict'
-    assert isinstance(struct, dict), 'struct must be dict'
-    check_struct(struct)
-
-    # required_parents_set = set()
-    # for i in required_fields:
-    #     if '.' in i:
-    #         required_parents_set |= set(i.split('.')[1:])
-    # print 'parents set', required_parents_set
-    if required_fields is None:
-        required_fields = []
-    if strict_fields is None:
-        strict_fields = []
-
-    # required_sets = set(required_fields)
-
-    logger.debug('required_fields: %s', required_fields)
-    logger.debug('strict_fields: %s', strict_fields)
-
-    def parent_of(k):
-        for i in required_fields:
-            kdot = k + '.'
-            if i.startswith(kdot):
-                return i
-        return False
-
-    def is_strict(k):
-        if _remove_list_mark(k) in strict_fields:
-            return True
-        return False
-
-    def recurse_check(st, o, ck, local_required=None):
-        # `st` means struct, it could be a type
-        # `nst` means next loop struct
-        # `o`  means object to be validate
-        # `ck` means current key
-        # `nk` means next key
-        # `bv` means bottom value
-
-        if local_required is None:
-            local_required = []
-        local_required_current = []
-        # local_required_next = []
-        for i in local_required:
-            sp = i.split('.')
-            local_required_current.append(sp[0])
-            # if len(sp) > 1:
-            #     local_required_next.append('.'.join(sp[1:]))
-
-        def get_next_required(k):
-            nr = []
-            for i in local_required:
-                if i.startswith(k + '.'):
-                    nr.append(i[len(k) + 1:])
-            return nr
-
-        typ = get_typ(st)
-        # if st in ALLOW_TYPES:
-        #     typ = st
-        # else:
-        #     # list or dict
-        #     typ = type(st)
-        logger.debug(
-            '@ %s\ndefined: %s\nobj   : %s %s\nrequired: %s',
-            ck, typ, type(o), o, local_required_current)
-
-        if o is None:
-            if local_required_current and typ is dict:
-            # field = parent_of(ck)
-            # if field:
-            #     logger.debug('parent of %s' % field)
-                raise TypeError(
-                    "On key '%s' None, should not be None since %s are required in it" %
-                    (ck, local_required_current))
-
-            if is_strict(ck):
-                raise TypeError("On key '%s' %s, %s, should be type %s" % (ck, o, type(o), typ))
-
-            return
-
-        elif not isinstance(o, typ):
-            # TODO support multi-type validation (use tuple to define)
-            raise TypeError("On key '%s' %s, %s, should be type %s" % (ck, o, type(o), typ))
-
-        logger.debug('---')
-
-        # recurse down step
-        if isinstance(st, dict):
-            for k, nst in st.iteritems():
-                if k in local_required_current and not k in o:
-                    raise KeyError("Under key '%s', subkey '%s', value %s, not exist" % (ck or '$', k, o))
-
-                # local_required_next = get_next_required(k)
-                # if local_required_next:
-                #     if not k in o:
-                #         raise TypeError(
-                #             "On key '%s' None, should not be None since %s is required in it" %
-                #             (ck, local_required_next))
-
-                if k in o:
-                    if ck is None:
-                        nk = k
-                    else:
-                        nk = ck + '.' + k
-
-                    # if nk in required_sets:
-                    #     required_sets.remove(nk)
-
-
-                    recurse_check(nst, o[k], nk, get_next_required(k))
-
-        elif isinstance(st, list) and len(st) == 1:
-            # NOTE currently, redundancy validations, which may occured on list,
-            # could not be reduced, because of the unperfect mechanism ..
-            # nk = ck + '.*'
-            nst = st[0]
-            for loop, i in enumerate(o):
-                nk = '%s.[%s]' % (ck, loop)
-                recurse_check(nst, i, nk, local_required)
-
-    recurse_check(struct, doc, None, required_fields)
-
-    # if required_sets:
-    #     raise KeyError('required fields: %s not exist', required_sets)
-    logger.debug('------validation all passed !')
+    CompiledStruct(struct, required_fields, strict_fields).validate(doc)
 
 
 def build_dict(struct, *args, **kwargs):
@@ -372,6 +348,56 @@ def retrieve_dict(doc, dot_key):
     return recurse_dict(doc, spKeys)
 
 
+def struct_projection(struct):
+    """
+    Return the projection of the fields defined in `struct`, with dotted
+    paths for nested dicts. Lists are projected as a whole, as a list
+    modified in a partial document would be `$set` as a whole.
+    """
+    projection = {}
+
+    def recurse_struct(st, pk):
+        for k, v in st.iteritems():
+            if pk is None:
+                ck = k
+            else:
+                ck = pk + '.' + k
+            if isinstance(v, dict) and v:
+                recurse_struct(v, ck)
+            else:
+                projection[ck] = 1
+
+    recurse_struct(struct, None)
+    return projection
+
+
+def struct_paths(struct):
+    """
+    Return a dict of the dotted paths in `struct` to their types, like
+    paths in queries, list marks are not part of them: the type of a list
+    is the type of its items (list if not defined), the paths in dicts
+    of a list are under the path of the list.
+    """
+    paths = {}
+
+    def recurse_struct(st, pk):
+        for k, v in st.iteritems():
+            if pk is None:
+                ck = k
+            else:
+                ck = pk + '.' + k
+            if isinstance(v, list):
+                v = v[0] if v else list
+            if isinstance(v, dict):
+                paths[ck] = dict
+                recurse_struct(v, ck)
+            else:
+                paths[ck] = v
+
+    recurse_struct(struct, None)
+    return paths
+
+
 def map_dict(o):
     def recurse_doc(mapping, d, pk):
         if isinstance(d, dict):
@@ -436,6 +462,108 @@ def diff_dicts(new, origin):
     return diff
 
 
+def _is_int(v):
+    return isinstance(v, (int, long)) and not isinstance(v, bool)
+
+
+def _is_scalar(v):
+    return not isinstance(v, (dict, list))
+
+
+def diff_list(new, origin):
+    """
+    Return ('$push', items) if `new` only appends items to `origin`,
+    ('$pull', items) if `new` only removes scalar items from `origin`,
+    otherwise None.
+
+    A removal is taken only if every occurrence of the removed values
+    is removed and the order of the rest is kept, as `$pull` does.
+    """
+    ln, lo = len(new), len(origin)
+    if ln > lo:
+        if new[:lo] == origin:
+            return '$push', new[lo:]
+    elif ln < lo:
+        try:
+            kept = set(new)
+            # items of `origin` are looked up in `kept`
+            set(origin)
+        except TypeError:
+            kept = new
+        removed = []
+        for i in origin:
+            if i not in kept and i not in removed:
+                if not _is_scalar(i):
+                    return None
+                removed.append(i)
+        if removed and [i for i in origin if i not in removed] == new:
+            return '$pull', removed
+    return None
+
+
+def diff_update(new, origin):
+    """
+    Compare `new` with `origin` deeply, return the update spec that
+    turns `origin` into `new`, with dotted paths as deep as possible:
+
+        * `$set` for added and modified values
+        * `$unset` for removed keys
+        * `$inc` for modified int values
+        * `$push` with `$each` for lists that only get items appended
+        * `$pull` with `$in` for lists that only get scalar items removed
+
+    Other modifications on a list `$set` the list as a whole.
+
+    Values that are the same object in `new` and `origin` are not compared.
+    """
+    spec = {}
+
+    def recurse_dict(n, o, pk):
+        # Iterate as plain dict, in case `n` overrides item access
+        for k, v in dict.iteritems(n):
+            if pk is None:
+                ck = k
+            else:
+                ck = pk + '.' + k
+
+            if k not in o:
+                spec.setdefault('$set', {})[ck] = v
+                continue
+
+            ov = o[k]
+            if v is ov:
+                continue
+
+            if isinstance(v, dict) and isinstance(ov, dict):
+                recurse_dict(v, ov, ck)
+            elif isinstance(v, list) and isinstance(ov, list):
+                if v == ov:
+                    continue
+                rv = diff_list(v, ov)
+                if rv is None:
+                    spec.setdefault('$set', {})[ck] = v
+                elif rv[0] == '$push':
+                    spec.setdefault('$push', {})[ck] = {'$each': rv[1]}
+                else:
+                    spec.setdefault('$pull', {})[ck] = {'$in': rv[1]}
+            elif _is_int(v) and _is_int(ov):
+                if v != ov:
+                    spec.setdefault('$inc', {})[ck] = v - ov
+            elif v != ov:
+                spec.setdefault('$set', {})[ck] = v
+
+        for k in o:
+            if k not in n:
+                if pk is None:
+                    ck = k
+                else:
+                    ck = pk + '.' + k
+                spec.setdefault('$unset', {})[ck] = ''
+
+    recurse_dict(new, origin, None)
+    return spec
+
+
 class GenCaller(object):
     def __get__(self, ins, owner):
         return Gen(owner)
@@ -516,9 +644,14 @@ class Struct(object):
 
 class StructuredDictMetaclass(type):
     def __new__(cls, name, bases, attrs):
-        if 'struct' in attrs:
-            check_struct(attrs['struct'])
-        return type.__new__(cls, name, bases, attrs)
+        klass = type.__new__(cls, name, bases, attrs)
+
+        # Compile struct once for the class, this also checks the struct
+        struct = getattr(klass, 'struct', None)
+        if isinstance(struct, dict):
+            klass._compiled_struct = CompiledStruct(
+                struct, klass.required_fields, klass.strict_fields)
+        return klass
 
 
 class StructuredDict(dict):
@@ -531,8 +664,7 @@ class StructuredDict(dict):
         5. keys not in struct could not be read or set.
         6. validator is not included in concept, it should be outside of structure.
 
-    TODO.
-        * auto_fix for raw doc in mongodb to fit struct (always use in developing at which time struct changes frequently)
+    To fix documents stored before `struct` was changed, see `Document.auto_fix`.
 
     NOTE.
         * '' and None. When a key has no input default value, it will be asigned as None
@@ -598,12 +730,25 @@ class StructuredDict(dict):
         ins.validate()
         return ins
 
+    @classmethod
+    def get_compiled_struct(cls):
+        """
+        return the `CompiledStruct` of cls, it is compiled again
+        if `struct`, `required_fields` or `strict_fields` is reassigned.
+        """
+        compiled = getattr(cls, '_compiled_struct', None)
+        if compiled is None or not compiled.compiled_from(
+                cls.struct, cls.required_fields, cls.strict_fields):
+            compiled = CompiledStruct(cls.struct, cls.required_fields, cls.strict_fields)
+            cls._compiled_struct = compiled
+        return compiled
+
     def validate(self):
         cls = self.__class__
         assert hasattr(cls, 'struct'), '`validate` method requires definition of `struct`'
-        validate_dict(self, cls.struct,
-                      required_fields=cls.required_fields,
-                      strict_fields=cls.strict_fields)
+        # Validate a plain dict copy of the first layer, so that item access
+        # overridden by subclasses is not triggered
+        cls.get_compiled_struct().validate(dict(self))
 
     def retrieval_get(self, dot_key):
         """
@@ -613,19 +758,24 @@ class StructuredDict(dict):
             'menu.file.name'
             'menu.ps.[0].title'
         """
-        return retrieve_dict(dict(self), dot_key)
+        return retrieve_dict(self, dot_key)
 
-    def retrieval_set(self, dot_key, value):
+    def _retrieval_parent(self, dot_key):
         keys = dot_key.split('.')
         last_key = keys.pop(-1)
-        last = self.retrieval_get('.'.join(keys))
-        last[_key_rule(last_key)] = value
+        if keys:
+            last = self.retrieval_get('.'.join(keys))
+        else:
+            last = self
+        return last, _key_rule(last_key)
+
+    def retrieval_set(self, dot_key, value):
+        last, key = self._retrieval_parent(dot_key)
+        last[key] = value
 
     def retrieval_del(self, dot_key):
-        keys = dot_key.split('.')
-        last_key = keys.pop(-1)
-        last = self.retrieval_get('.'.join(keys))
-        del last[_key_rule(last_key)]
+        last, key = self._retrieval_parent(dot_key)
+        del last[key]
 
     def _pprint(self):
         from torext.utils import pprint
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming export and import of collections, see `Document.export`
+and `Document.import_`.
+
+Two formats are supported:
+
+- 'bson': documents concatenated in BSON, like the files of mongodump,
+  exported as the bytes fetched from the server without decoding
+- 'ndjson': a document per line in MongoDB extended JSON
+  (`bson.json_util`), e.g. `{"_id": {"$oid": "..."}}`
+
+Files can be compressed by gzip or bz2. The format and compression
+are guessed from the extension if not given, e.g. `users.ndjson.gz`.
+"""
+
+import bz2
+import gzip
+import json
+import datetime
+from bson import decode_file_iter
+from bson.json_util import default as json_default, object_hook as json_object_hook
+
+
+FORMATS = ('bson', 'ndjson')
+
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'bz2': '.bz2',
+}
+
+_EXTENSIONS = {
+    '.bson': 'bson',
+    '.ndjson': 'ndjson',
+    '.json': 'ndjson',
+    '.jsonl': 'ndjson',
+}
+
+# Size of the buffer of plain files
+_BUFFER_SIZE = 1 << 20
+
+
+def guess_format(path, format=None, compress=None):
+    """Return (format, compress) of `path`, guessed from
+    the extension for those not given"""
+    name = path
+    if compress is None:
+        for c, ext in COMPRESSIONS.iteritems():
+            if name.endswith(ext):
+                compress = c
+                break
+    if compress is not None:
+        if compress not in COMPRESSIONS:
+            raise ValueError('compress should be one of %s, got %r' % (COMPRESSIONS.keys(), compress))
+        ext = COMPRESSIONS[compress]
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if format is None:
+        for ext, f in _EXTENSIONS.iteritems():
+            if name.endswith(ext):
+                format = f
+                break
+        else:
+            raise ValueError('could not guess format of %s, should be one of %s' % (path, FORMATS))
+    if format not in FORMATS:
+        raise ValueError('format should be one of %s, got %r' % (FORMATS, format))
+    return format, compress
+
+
+def open_file(path, mode, compress=None):
+    """Open `path` in binary `mode` ('r' or 'w'), compressed by `compress`"""
+    if compress == 'gzip':
+        return gzip.open(path, mode + 'b')
+    if compress == 'bz2':
+        return bz2.BZ2File(path, mode + 'b', _BUFFER_SIZE)
+    return open(path, mode + 'b', _BUFFER_SIZE)
+
+
+def encode_ndjson(doc):
+    return json.dumps(doc, default=json_default, separators=(',', ':')) + '\n'
+
+
+def encode_documents(docs, format):
+    """Return the bytes of `docs`, which are `RawBSONDocument`
+    for 'bson', dicts for 'ndjson'"""
+    if format == 'bson':
+        return ''.join(doc.raw for doc in docs)
+    return ''.join(encode_ndjson(doc) for doc in docs)
+
+
+def iter_documents(fileobj, format, codec_options):
+    """Yield documents decoded from `fileobj` one by one"""
+    if format == 'bson':
+        for doc in decode_file_iter(fileobj, codec_options):
+            yield doc
+    else:
+        if codec_options.tz_aware:
+            object_hook = json_object_hook
+        else:
+            # Datetimes are decoded in UTC, naive like from BSON
+            def object_hook(dct):
+                value = json_object_hook(dct)
+                if isinstance(value, datetime.datetime):
+                    return value.replace(tzinfo=None)
+                return value
+        for line in fileobj:
+            if line.strip():
+                yield json.loads(line, object_hook=object_hook)
+
+
+class ExportResult(object):
+    """Result of `Document.export`, `size` is the number of bytes
+    before compression"""
+    def __init__(self, path, format):
+        self.path = path
+        self.format = format
+        self.count = 0
+        self.size = 0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Documents per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.count / self.elapsed
+
+    def __repr__(self):
+        return '<ExportResult: %s documents to %s in %.2fs (%.0f/s)>' % (
+            self.count, self.path, self.elapsed, self.rate)
+
+
+class Writer(object):
+    """Write documents to a file in batches, thread-safe with `lock`"""
+    def __init__(self, fileobj, format, result, lock=None):
+        self.fileobj = fileobj
+        self.format = format
+        self.result = result
+        self.lock = lock
+
+    def write(self, docs):
+        data = encode_documents(docs, self.format)
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            self.fileobj.write(data)
+            self.result.count += len(docs)
+            self.result.size += len(data)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def write_all(self, docs, batch_size):
+        """Write an iterable of documents, return the number written"""
+        count = 0
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                self.write(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+            count += len(batch)
+        return count
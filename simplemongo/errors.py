@@ -16,3 +16,16 @@ class ObjectNotFound(SimplemongoException):
 
 class MultipleObjectsReturned(SimplemongoException):
     pass
+
+
+class InvalidToken(SimplemongoException):
+    pass
+
+
+class SchemaVersionError(SimplemongoException):
+    pass
+
+
+class QueryPlanError(SimplemongoException):
+    """Raised by `plan.PlanGuard`, the first argument is the `plan.PlanEvent`"""
+    pass
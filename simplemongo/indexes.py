@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Indexes declared by `indexes` of `Document` subclasses, see
+`Document.ensure_indexes` and `Document.unused_indexes`.
+
+An item of `indexes` is the keys of an index, or a dict of `keys`
+and options of `create_index`::
+
+    indexes = [
+        'name',
+        [('group', ASCENDING), ('score', DESCENDING)],
+        {'keys': 'email', 'unique': True, 'sparse': True},
+        {'keys': 'created_at', 'expireAfterSeconds': 3600},
+        {'keys': 'score', 'partialFilterExpression': {'score': {'$gt': 0}}},
+    ]
+
+where keys are a key (ascending), or a list of keys or (key, direction).
+Keys are checked to be paths of `struct` when the class is defined.
+"""
+
+import logging
+import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.helpers import _gen_index_name
+from . import errors
+from .dstruct import struct_paths
+
+
+DIRECTIONS = (ASCENDING, DESCENDING, 'text', 'hashed', '2d', '2dsphere', 'geoHaystack')
+
+OPTIONS = frozenset([
+    'name', 'unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression',
+    'collation', 'weights', 'default_language', 'language_override',
+    'min', 'max', 'bits', 'bucketSize', 'storageEngine',
+])
+
+# Options that make an index different in `index_information`
+_COMPARED_OPTIONS = ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression')
+
+
+def normalize_index(item):
+    """Return (keys, options) of an item of `indexes`, keys are
+    a list of (key, direction), options include `name`"""
+    if isinstance(item, dict):
+        options = dict(item)
+        if 'keys' not in options:
+            raise errors.StructError('index %r has no `keys`' % item)
+        keys = options.pop('keys')
+    else:
+        keys = item
+        options = {}
+    if isinstance(keys, basestring):
+        keys = [keys]
+    if not isinstance(keys, (list, tuple)) or not keys:
+        raise errors.StructError('keys of index %r should be a key or a list of keys' % item)
+    normalized = []
+    for key in keys:
+        if isinstance(key, basestring):
+            key = (key, ASCENDING)
+        if not isinstance(key, (list, tuple)) or len(key) != 2:
+            raise errors.StructError('key %r of index %r should be a key or (key, direction)' % (key, item))
+        if key[1] not in DIRECTIONS:
+            raise errors.StructError('direction of key %r of index %r should be one of %s' %
+                                     (key[0], item, DIRECTIONS))
+        normalized.append((key[0], key[1]))
+
+    unknown = set(options) - OPTIONS
+    if unknown:
+        raise errors.StructError('unknown options %s of index %r' % (sorted(unknown), item))
+    options.setdefault('name', _gen_index_name(normalized))
+    return normalized, options
+
+
+def _filter_paths(expression):
+    # Paths in a query, under `$and` and `$or`
+    for k, v in expression.iteritems():
+        if k in ('$and', '$or'):
+            for sub in v:
+                for path in _filter_paths(sub):
+                    yield path
+        elif not k.startswith('$'):
+            yield k
+
+
+def check_indexes(indexes, struct, extra_paths=('_id', )):
+    """Return [(keys, options), ...] of `indexes`, raise `errors.StructError`
+    if an index is invalid or not on paths of `struct` (or `extra_paths`)"""
+    paths = struct_paths(struct)
+    for path in extra_paths:
+        paths.setdefault(path, None)
+    rv = []
+    names = set()
+    for item in indexes:
+        keys, options = normalize_index(item)
+        for key, _ in keys:
+            if key not in paths:
+                raise errors.StructError('key %s of index %s is not in struct' % (key, options['name']))
+        if options['name'] in names:
+            raise errors.StructError('index %s is declared twice' % options['name'])
+        names.add(options['name'])
+
+        if 'expireAfterSeconds' in options:
+            if len(keys) != 1 or paths[keys[0][0]] is not datetime.datetime:
+                raise errors.StructError('TTL index %s should be on a single datetime key' %
+                                         options['name'])
+        expression = options.get('partialFilterExpression')
+        if expression is not None:
+            for path in _filter_paths(expression):
+                if path not in paths:
+                    raise errors.StructError('key %s in partialFilterExpression of index %s '
+                                             'is not in struct' % (path, options['name']))
+        rv.append((keys, options))
+    return rv
+
+
+def diff_indexes(declared, information):
+    """Compare `declared` [(keys, options), ...] with `information`
+    from `Collection.index_information`, indexes are matched by keys.
+
+    Return (missing, conflicts, undeclared): the declared indexes not
+    created, [(name, options, existing information), ...] of the declared
+    indexes created with different options, and the names of the indexes
+    created but not declared (except `_id_`).
+    """
+    existing = {}
+    for name, info in information.iteritems():
+        existing[tuple(tuple(k) for k in info['key'])] = name
+    missing = []
+    conflicts = []
+    matched = set()
+    for keys, options in declared:
+        name = existing.get(tuple(keys))
+        if name is None:
+            missing.append((keys, options))
+            continue
+        matched.add(name)
+        info = information[name]
+        for option in _COMPARED_OPTIONS:
+            if option in ('unique', 'sparse'):
+                differ = bool(options.get(option)) != bool(info.get(option))
+            else:
+                differ = options.get(option) != info.get(option)
+            if differ:
+                conflicts.append((options['name'], options, info))
+                break
+    undeclared = [n for n in information if n not in matched and n != '_id_']
+    return missing, conflicts, undeclared
+
+
+class IndexSyncResult(object):
+    """Result of `Document.ensure_indexes`, see `diff_indexes` for
+    `conflicts` and `undeclared`, `created` are the names of the indexes
+    created (or to be created if `create` is off)"""
+    def __init__(self):
+        self.created = []
+        self.conflicts = []
+        self.undeclared = []
+
+    def __repr__(self):
+        return '<IndexSyncResult: created=%s conflicts=%s undeclared=%s>' % (
+            self.created, [i[0] for i in self.conflicts], self.undeclared)
+
+
+def sync_indexes(col, declared, background=True, create=True):
+    """Create the indexes in `declared` missing in `col`,
+    return an `IndexSyncResult`"""
+    result = IndexSyncResult()
+    missing, result.conflicts, result.undeclared = diff_indexes(declared, col.index_information())
+    for name, options, info in result.conflicts:
+        # Not dropped, rebuilding an index should be decided by hand
+        logging.warning('index %s of %s is declared as %s, but created as %s',
+                        name, col.full_name, options, info)
+    if missing:
+        if create:
+            models = [IndexModel(keys, background=background, **options)
+                      for keys, options in missing]
+            result.created = col.create_indexes(models)
+            logging.info('created indexes %s of %s', result.created, col.full_name)
+        else:
+            result.created = [options['name'] for keys, options in missing]
+    return result
+
+
+def index_usage(col):
+    """Return {name: (ops, since)} of the indexes of `col` by `$indexStats`,
+    the number of operations that used an index since `since`, counted
+    on the server that runs it since the index was created or the
+    server restarted"""
+    usage = {}
+    for stat in col.aggregate([{'$indexStats': {}}]):
+        accesses = stat['accesses']
+        usage[stat['name']] = (accesses['ops'], accesses['since'])
+    return usage
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Lazy decoding for documents with `__lazy__` turned on.
+
+Documents are fetched as raw BSON bytes (`RawBSONDocument`), only the
+boundaries of the top level elements are scanned when a document is
+wrapped, a field is decoded the first time it is accessed. A nested
+dict or list is decoded as a whole along with its top level field.
+
+The bytes are also the snapshot for `changes`: only decoded fields can be
+modified, so only they are decoded again from the bytes and compared.
+"""
+
+import copy
+import struct
+from bson import BSON, _element_to_dict
+from bson.errors import InvalidBSON
+from bson.raw_bson import RawBSONDocument
+from .dstruct import diff_update
+
+
+_UNPACK_INT = struct.Struct('<i').unpack_from
+_PACK_INT = struct.Struct('<i').pack
+
+# Sizes of values by element type, see http://bsonspec.org/spec.html
+_FIXED_SIZES = {
+    '\x01': 8,   # double
+    '\x06': 0,   # undefined
+    '\x07': 12,  # ObjectId
+    '\x08': 1,   # bool
+    '\x09': 8,   # datetime
+    '\x0A': 0,   # null
+    '\x10': 4,   # int32
+    '\x11': 8,   # timestamp
+    '\x12': 8,   # int64
+    '\x13': 16,  # decimal128
+    '\xFF': 0,   # min key
+    '\x7F': 0,   # max key
+}
+
+
+# Values starting with an int32 size, the number of bytes
+# not counted in that size by element type
+_PREFIXED_SIZES = {
+    '\x02': 4,   # string
+    '\x03': 0,   # document
+    '\x04': 0,   # array
+    '\x05': 5,   # binary, the size and subtype
+    '\x0C': 16,  # db pointer, the string and ObjectId
+    '\x0D': 4,   # code
+    '\x0E': 4,   # symbol
+    '\x0F': 0,   # code with scope
+}
+
+
+def _value_size(data, typ, pos):
+    size = _FIXED_SIZES.get(typ)
+    if size is not None:
+        return size
+    size = _PREFIXED_SIZES.get(typ)
+    if size is not None:
+        return size + _UNPACK_INT(data, pos)[0]
+    # regex, two cstrings
+    if typ == '\x0B':
+        end = data.index('\x00', data.index('\x00', pos) + 1)
+        return end + 1 - pos
+    raise InvalidBSON('unknown element type %r' % typ)
+
+
+# Decoded keys are shared by documents, as the same keys
+# are in most documents of a collection
+_KEYS = {}
+
+_KEYS_MAX = 10000
+
+
+def _decode_key(b):
+    k = _KEYS.get(b)
+    if k is None:
+        k = b.decode('utf8')
+        if len(_KEYS) < _KEYS_MAX:
+            _KEYS[b] = k
+    return k
+
+
+def iter_elements(data, pos=4):
+    """Yield (key, start, end) of the top level elements in BSON bytes
+    `data` from offset `pos`, values are not decoded"""
+    end = len(data) - 1
+    value_size = _value_size
+    while pos < end:
+        start = pos
+        key_end = data.index('\x00', pos + 1)
+        pos = key_end + 1 + value_size(data, data[start], key_end + 1)
+        yield _decode_key(data[start + 1:key_end]), start, pos
+    if pos != end:
+        raise InvalidBSON('bad document size')
+
+
+def index_elements(data):
+    """Return a dict of key to (start, end) of the top level elements"""
+    return dict((k, (start, end)) for k, start, end in iter_elements(data))
+
+
+def element_end(data, start):
+    key_end = data.index('\x00', start + 1)
+    return key_end + 1 + _value_size(data, data[start], key_end + 1)
+
+
+def decode_element(data, start, codec_options):
+    """Decode the element at offset `start` of BSON bytes `data`,
+    return (key, value)"""
+    key, value, _ = _element_to_dict(data, start, len(data) - 1, codec_options)
+    return key, value
+
+
+class LazyDocumentMixin(object):
+    """
+    Put in front of the bases of a `Document` subclass by `DocumentMetaclass`
+    when `__lazy__` is True.
+
+    The decoded fields are stored in the dict itself, the others are located
+    in `_bson` by `_index` (key in UTF-8 to offset of the element), which is
+    filled as far as `_bson` has been scanned for the keys asked for.
+    `_deleted` are the keys in `_bson` that are deleted from the document.
+
+    All the dict methods are overridden to decode on demand, `dict(doc)`
+    or other C level access only sees the decoded fields.
+    """
+    _bson = None
+    _index = None
+    _scan_pos = None
+    _deleted = None
+    _decoded_all = False
+
+    def _load(self, raw, snapshot=True):
+        # Bytes are always kept, they are what fields are decoded from
+        if isinstance(raw, RawBSONDocument):
+            data = raw.raw
+        elif isinstance(raw, str):
+            data = raw
+        else:
+            data = BSON.encode(raw)
+        dict.clear(self)
+        self._set_bson(data)
+
+    def _set_bson(self, data):
+        self._bson = data
+        self._index = {}
+        self._scan_pos = 4
+        self._deleted = None
+        self._decoded_all = False
+
+    def _reset_changes(self):
+        # Encode the decoded fields, keep the others as they are
+        pending = self._pending_items()
+        body = BSON.encode(dict.copy(self))[4:-1]
+        data = self._bson
+        for k, start in pending:
+            body += data[start:element_end(data, start)]
+        self._set_bson(_PACK_INT(len(body) + 5) + body + '\x00')
+        self._decoded_all = not pending
+
+    @classmethod
+    def _raw_id(cls, raw):
+        # Getting from `RawBSONDocument` would decode all of it
+        data = raw.raw
+        for k, start, end in iter_elements(data):
+            if k == '_id':
+                return decode_element(data, start, cls.col.codec_options)[1]
+        return None
+
+    def _locate(self, k):
+        """Return the offset of the element of `k` in `_bson`, or None"""
+        if self._index is None:
+            return None
+        if isinstance(k, unicode):
+            k = k.encode('utf8')
+        elif not isinstance(k, str):
+            return None
+        pos = self._index.get(k)
+        if pos is None and self._scan_pos is not None:
+            pos = self._scan(k)
+        return pos
+
+    def _scan(self, until=None):
+        # Same as `iter_elements`, inlined as it is the hot path
+        data = self._bson
+        index = self._index
+        find = data.index
+        fixed = _FIXED_SIZES
+        prefixed = _PREFIXED_SIZES
+        unpack = _UNPACK_INT
+        pos = self._scan_pos
+        end = len(data) - 1
+        while pos < end:
+            start = pos
+            typ = data[pos]
+            key_end = find('\x00', pos + 1)
+            k = data[pos + 1:key_end]
+            index[k] = start
+            pos = key_end + 1
+            if typ in fixed:
+                pos += fixed[typ]
+            elif typ in prefixed:
+                pos += prefixed[typ] + unpack(data, pos)[0]
+            else:
+                pos += _value_size(data, typ, pos)
+            if k == until:
+                self._scan_pos = pos
+                return start
+        if pos != end:
+            raise InvalidBSON('bad document size')
+        self._scan_pos = None
+        return None
+
+    def _is_pending(self, k):
+        return (not dict.__contains__(self, k) and
+                not (self._deleted and k in self._deleted) and
+                self._locate(k) is not None)
+
+    def _pending_items(self):
+        """Return [(key, offset), ...] of the fields not decoded or deleted"""
+        if self._index is None or self._decoded_all:
+            return []
+        if self._scan_pos is not None:
+            self._scan()
+        deleted = self._deleted or ()
+        items = []
+        for b, start in self._index.iteritems():
+            k = _decode_key(b)
+            if not dict.__contains__(self, k) and k not in deleted:
+                items.append((k, start))
+        return items
+
+    def _decode(self, pos):
+        k, value = decode_element(self._bson, pos, self.col.codec_options)
+        dict.__setitem__(self, k, value)
+        return value
+
+    def _decode_all(self):
+        if self._index is None or self._decoded_all:
+            return
+        decoded = BSON(self._bson).decode(self.col.codec_options)
+        deleted = self._deleted or ()
+        for k, v in decoded.iteritems():
+            if not dict.__contains__(self, k) and k not in deleted:
+                dict.__setitem__(self, k, v)
+        self._decoded_all = True
+
+    @property
+    def changes(self):
+        if not self._in_db or self._index is None:
+            return None
+        data = self._bson
+        codec_options = self.col.codec_options
+        if self._decoded_all:
+            origin = BSON(data).decode(codec_options)
+        else:
+            # Fields not decoded are not modified, compare the others only
+            origin = {}
+            for k in dict.keys(self) + list(self._deleted or ()):
+                pos = self._locate(k)
+                if pos is not None:
+                    origin[k] = decode_element(data, pos, codec_options)[1]
+        return diff_update(dict.copy(self), origin)
+
+    def validate(self):
+        # Only the fields in struct are validated
+        for k in self.struct:
+            self.get(k)
+        super(LazyDocumentMixin, self).validate()
+
+    def save(self):
+        self._decode_all()
+        return super(LazyDocumentMixin, self).save()
+
+    def _removed(self):
+        self._decode_all()
+        super(LazyDocumentMixin, self)._removed()
+
+    def __getitem__(self, k):
+        try:
+            return dict.__getitem__(self, k)
+        except KeyError:
+            pass
+        if self._deleted and k in self._deleted:
+            raise KeyError(k)
+        pos = self._locate(k)
+        if pos is None:
+            raise KeyError(k)
+        return self._decode(pos)
+
+    def _peek(self, k, default=None):
+        return self.get(k, default)
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self[k]
+        self[k] = default
+        return default
+
+    def __setitem__(self, k, v):
+        if self._deleted and k in self._deleted:
+            self._deleted.discard(k)
+        super(LazyDocumentMixin, self).__setitem__(k, v)
+
+    def __delitem__(self, k):
+        if dict.__contains__(self, k):
+            dict.__delitem__(self, k)
+        elif not self._is_pending(k):
+            raise KeyError(k)
+        if self._locate(k) is not None:
+            if self._deleted is None:
+                self._deleted = set()
+            self._deleted.add(k)
+
+    def pop(self, k, *args):
+        if k in self:
+            v = self[k]
+            del self[k]
+            return v
+        if args:
+            return args[0]
+        raise KeyError(k)
+
+    def clear(self):
+        if self._index is not None:
+            if self._scan_pos is not None:
+                self._scan()
+            self._deleted = set(_decode_key(b) for b in self._index)
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def __contains__(self, k):
+        return dict.__contains__(self, k) or self._is_pending(k)
+
+    has_key = __contains__
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._pending_items())
+
+    def keys(self):
+        return dict.keys(self) + [k for k, _ in self._pending_items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def values(self):
+        self._decode_all()
+        return dict.values(self)
+
+    def items(self):
+        self._decode_all()
+        return dict.items(self)
+
+    def itervalues(self):
+        self._decode_all()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._decode_all()
+        return dict.iteritems(self)
+
+    def viewvalues(self):
+        self._decode_all()
+        return dict.viewvalues(self)
+
+    def viewitems(self):
+        self._decode_all()
+        return dict.viewitems(self)
+
+    def copy(self):
+        self._decode_all()
+        return dict.copy(self)
+
+    def __eq__(self, other):
+        self._decode_all()
+        if isinstance(other, LazyDocumentMixin):
+            other._decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._decode_all()
+        return dict.__repr__(self)
+
+    def __str__(self):
+        self._decode_all()
+        return super(LazyDocumentMixin, self).__str__()
+
+    def __deepcopy__(self, memo):
+        self._decode_all()
+        cls = self.__class__
+        copied = cls.__new__(cls)
+        memo[id(self)] = copied
+        copied.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        for k, v in dict.iteritems(self):
+            dict.__setitem__(copied, k, copy.deepcopy(v, memo))
+        return copied
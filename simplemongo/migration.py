@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bring documents stored in a collection in line with a changed `struct`,
+see `Document.auto_fix`.
+
+For each document the minimal update is computed by `compute_fix`:
+
+- keys in `struct` missing in the document are set to their values
+  in `build_dict(struct, **defaults)`, including in dicts of lists
+- values of another type than in `struct` are converted by a converter
+  of the struct path, or of (value type, struct type) in `CONVERTERS`
+- keys not in `struct` are unset, if `remove_unknown` is on
+
+The update only applies if the fields are still as they were read
+(a filled key is still missing, a converted value is still the same),
+so that documents written meanwhile by the application are not clobbered.
+"""
+
+import os
+import copy
+import time
+import logging
+import datetime
+from bson import BSON
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import CursorNotFound
+from .dstruct import build_dict, get_typ
+from .session import current_identity_map
+
+
+def _float_to_int(v):
+    if not v.is_integer():
+        raise ValueError('%s is not integral' % v)
+    return int(v)
+
+
+def _to_int(v):
+    i = int(v)
+    if isinstance(i, long):
+        raise ValueError('%s does not fit in int' % v)
+    return i
+
+
+# Converters of values of a type (key[0]) to the type in struct (key[1]),
+# a converter raises ValueError or TypeError if the value could not be converted
+CONVERTERS = {
+    (int, float): float,
+    (long, float): float,
+    (long, int): _to_int,
+    (float, int): _float_to_int,
+    (str, int): _to_int,
+    (unicode, int): _to_int,
+    (str, float): float,
+    (unicode, float): float,
+    (int, str): str,
+    (long, str): str,
+    (float, str): repr,
+    (int, unicode): unicode,
+    (long, unicode): unicode,
+    (float, unicode): lambda v: unicode(repr(v)),
+    (str, ObjectId): ObjectId,
+    (unicode, ObjectId): ObjectId,
+    (ObjectId, str): str,
+    (ObjectId, unicode): unicode,
+}
+
+
+def register_converter(from_type, to_type, func):
+    """Register `func` to convert values of `from_type` to `to_type`
+    of struct in `compute_fix`, for all documents"""
+    CONVERTERS[(from_type, to_type)] = func
+
+
+def _find_converter(converters, path, value, st):
+    func = converters.get(path)
+    if func is not None:
+        return func
+    # A dict or list in struct is looked up by its container type
+    if isinstance(st, dict):
+        st = dict
+    elif isinstance(st, list):
+        st = list
+    # Subclasses like `bson.int64.Int64` use the converters of their bases
+    for typ in type(value).__mro__:
+        func = converters.get((typ, st))
+        if func is not None:
+            return func
+    return None
+
+
+def compute_fix(doc, struct, template=None, remove_unknown=False, converters=None, keep=('_id', )):
+    """Return (update, conditions, errors) to fix `doc` for `struct`.
+
+    `update` has `$set` and `$unset` if any, it is empty if nothing to fix.
+    `conditions` are the filters on the fixed fields that the update
+    requires to still hold. `errors` are messages of values
+    that could not be converted, they are left as they are.
+
+    :param template: the dict built from `struct` to get the values
+                     of missing keys, `build_dict(struct)` if None
+    :param converters: dict of struct path (e.g. 'skills.power', without
+                       list indexes) or (value type, struct type)
+                       to converter, defaults to `CONVERTERS`
+    :param keep: top level keys not in `struct` that are not unset
+    """
+    if template is None:
+        template = build_dict(struct)
+    if converters is None:
+        converters = CONVERTERS
+    sets = {}
+    unsets = {}
+    conditions = {}
+    errors = []
+
+    def convert(value, st, path, spath):
+        func = _find_converter(converters, spath, value, st)
+        if func is None:
+            errors.append("On key '%s' %r, no converter from %s to %s" % (path, value, type(value), st))
+            return
+        try:
+            new = func(value)
+        except (TypeError, ValueError) as e:
+            errors.append("On key '%s' %r, could not convert to %s: %s" % (path, value, st, e))
+            return
+        sets[path] = new
+        conditions[path] = value
+
+    def recurse(st, d, tmpl, path, spath):
+        for k, v in st.iteritems():
+            if path is None:
+                p = sp = k
+            else:
+                p = path + '.' + k
+                sp = spath + '.' + k
+            if k not in d:
+                sets[p] = copy.deepcopy(tmpl.get(k))
+                conditions[p] = {'$exists': False}
+                continue
+            value = d[k]
+            if value is None:
+                # None is allowed as in validation
+                continue
+            if isinstance(v, dict):
+                if isinstance(value, dict):
+                    sub = tmpl.get(k)
+                    recurse(v, value, sub if isinstance(sub, dict) else {}, p, sp)
+                    continue
+            elif isinstance(v, list):
+                if isinstance(value, list):
+                    if len(v) == 1:
+                        recurse_list(v[0], value, p, sp)
+                    continue
+            elif isinstance(value, get_typ(v)):
+                continue
+            convert(value, v, p, sp)
+
+        if remove_unknown:
+            for k in d:
+                if k not in st and not (path is None and k in keep):
+                    unsets[k if path is None else path + '.' + k] = ''
+
+    def recurse_list(st, items, path, spath):
+        if isinstance(st, dict):
+            tmpl = build_dict(st)
+            for i, item in enumerate(items):
+                if isinstance(item, dict):
+                    recurse(st, item, tmpl, '%s.%s' % (path, i), spath)
+                elif item is not None:
+                    errors.append("On key '%s.%s' %r, should be a dict" % (path, i, item))
+        else:
+            typ = get_typ(st)
+            for i, item in enumerate(items):
+                if item is not None and not isinstance(item, typ):
+                    convert(item, st, '%s.%s' % (path, i), spath)
+
+    recurse(struct, doc, template, None, None)
+    update = {}
+    if sets:
+        update['$set'] = sets
+    if unsets:
+        update['$unset'] = unsets
+    return update, conditions, errors
+
+
+class FileCheckpoint(object):
+    """Keep the last `_id` processed in a file at `path`,
+    in BSON to keep its type"""
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            return BSON(f.read()).decode()['_id']
+
+    def save(self, _id):
+        # Written to a temporary file then renamed, to be never half written
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(BSON.encode({'_id': _id}))
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class CollectionCheckpoint(object):
+    """Keep the last `_id` processed in a document of `col` named `name`,
+    to resume from another host"""
+    def __init__(self, col, name):
+        self.col = col
+        self.name = name
+
+    def load(self):
+        doc = self.col.find_one({'_id': self.name})
+        if doc is None:
+            return None
+        return doc['last_id']
+
+    def save(self, _id):
+        self.col.update_one(
+            {'_id': self.name},
+            {'$set': {'last_id': _id, 'updated_at': datetime.datetime.utcnow()}},
+            upsert=True)
+
+    def clear(self):
+        self.col.delete_one({'_id': self.name})
+
+
+class MigrationResult(object):
+    """Result of `Document.auto_fix`
+
+    `fixed` is the number of documents that need an update, `matched`
+    and `modified` are from the server, a fixed document is not matched
+    if it was changed meanwhile. `errors` are dicts of `_id` and `errmsg`
+    (list of messages) of documents with values that could not be converted.
+    `last_id` is the last `_id` processed, which is saved in the checkpoint.
+    """
+    def __init__(self):
+        self.scanned = 0
+        self.fixed = 0
+        self.matched = 0
+        self.modified = 0
+        self.errors = []
+        self.last_id = None
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Scanned documents per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.scanned / self.elapsed
+
+    def __repr__(self):
+        return '<MigrationResult: scanned=%s fixed=%s modified=%s errors=%s>' % (
+            self.scanned, self.fixed, self.modified, len(self.errors))
+
+
+def run_migration(cls, spec, remove_unknown, converters, batch_size, max_rate,
+                  checkpoint, dry_run, progress):
+    defaults = getattr(cls, 'defaults', None) or {}
+    if isinstance(defaults, dict):
+        template = build_dict(cls.struct, **defaults)
+    else:
+        template = build_dict(cls.struct, *defaults)
+    if converters:
+        merged = dict(CONVERTERS)
+        merged.update(converters)
+        converters = merged
+    else:
+        converters = CONVERTERS
+
+    keep = ('_id', )
+    if cls.__schema_version__ is not None:
+        keep += (cls.__version_field__, )
+
+    result = MigrationResult()
+    if checkpoint is not None:
+        result.last_id = checkpoint.load()
+        if result.last_id is not None:
+            logging.info('resume fixing %s after %s', cls.__name__, result.last_id)
+    col = cls.get_write_collection()
+    start = time.time()
+    state = {'ops': [], 'ids': [], 'count': 0, 'last_id': result.last_id}
+
+    def flush():
+        ops = state['ops']
+        if ops and not dry_run:
+            rv = col.bulk_write(ops, ordered=False)
+            result.matched += rv.matched_count
+            result.modified += rv.modified_count or 0
+            # Cached and mapped documents are the unfixed ones
+            imap = current_identity_map()
+            for _id in state['ids']:
+                cls.invalidate_cache(_id)
+                if imap is not None:
+                    imap.discard(cls, _id)
+        result.last_id = state['last_id']
+        if checkpoint is not None and not dry_run and state['count']:
+            checkpoint.save(result.last_id)
+        state['ops'] = []
+        state['ids'] = []
+        state['count'] = 0
+        result.elapsed = time.time() - start
+        if progress is not None:
+            progress(result)
+        # Throttle to `max_rate` scanned documents per second
+        if max_rate:
+            delay = result.scanned / float(max_rate) - result.elapsed
+            if delay > 0:
+                time.sleep(delay)
+
+    while True:
+        query = spec
+        if result.last_id is not None:
+            condition = {'_id': {'$gt': result.last_id}}
+            query = {'$and': [spec, condition]} if spec else condition
+        cursor = cls.find(query, auto_projection=False).sort('_id', ASCENDING)
+        cursor.batch_size(batch_size).raw()
+        try:
+            for raw in cursor:
+                result.scanned += 1
+                update, conditions, errors = compute_fix(
+                    raw, cls.struct, template, remove_unknown, converters, keep)
+                if errors:
+                    result.errors.append({'_id': raw['_id'], 'errmsg': errors})
+                if update:
+                    result.fixed += 1
+                    logging.debug('fix %s: %s', raw['_id'], update)
+                    spec_one = {'_id': raw['_id']}
+                    spec_one.update(conditions)
+                    state['ops'].append(UpdateOne(spec_one, update))
+                    state['ids'].append(raw['_id'])
+                state['last_id'] = raw['_id']
+                state['count'] += 1
+                if state['count'] >= batch_size:
+                    flush()
+        except CursorNotFound:
+            # Timed out on the server, e.g. while throttled, go on from the checkpoint
+            logging.warning('cursor lost while fixing %s, resume after %s',
+                            cls.__name__, state['last_id'])
+            flush()
+            continue
+        flush()
+        break
+    logging.info('fixed %s of %s documents of %s in %.2fs (%.0f/s), %s errors',
+                 result.fixed, result.scanned, cls.__name__, result.elapsed,
+                 result.rate, len(result.errors))
+    return result
@@ -4,17 +4,49 @@
 # simple orm wrapper of MongoDB using pymongo
 
 import copy
+import time
 import logging
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+from bson import BSON
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
 from pymongo.collection import Collection
-from . import errors
-from .dstruct import StructuredDict, StructuredDictMetaclass, diff_dicts
-from .cursor import SimplemongoCursor, Cursor
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.write_concern import WriteConcern
+from . import errors, scan, dump, migration, upgrade, indexes, tracing, references, cache
+from .dstruct import StructuredDict, StructuredDictMetaclass, diff_update, struct_projection
+from .tracking import TrackedDocumentMixin
+from .lazy import LazyDocumentMixin, RawBSONDocument
+from .cursor import SimplemongoCursor, Cursor, get_field
+from .session import current_session, current_identity_map
+from .record import make_record_class
+from .pagination import normalize_sort, keyset_filter, encode_token, decode_token, Page
 
 
 # TODO replace logging to certain logger
 
 
+_missing = object()
+
+
+_CONTAINERS = frozenset([dict, list])
+
+
+def _copy(value):
+    # Copy the dicts and lists of a decoded document, much faster than
+    # `copy.deepcopy`, other values from BSON are not modified in place
+    cls = type(value)
+    if cls is dict:
+        return {k: _copy(v) if type(v) in _CONTAINERS else v for k, v in value.iteritems()}
+    if cls is list:
+        return [_copy(i) if type(i) in _CONTAINERS else i for i in value]
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
 def oid(id):
     if isinstance(id, ObjectId):
         return id
@@ -26,6 +58,39 @@ def oid(id):
         raise ValueError('get type %s, should be str/unicode or ObjectId' % type(id))
 
 
+class InsertResult(object):
+    """Result of `Document.insert`
+
+    `errors` are dicts of `index` (position in the inserted iterable),
+    `code` and `errmsg`, `code` is None for validation errors.
+    """
+    def __init__(self):
+        self.inserted_count = 0
+        self.inserted_ids = []
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """Inserted documents per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.inserted_count / self.elapsed
+
+    def __repr__(self):
+        return '<InsertResult: inserted=%s errors=%s>' % (self.inserted_count, len(self.errors))
+
+
+def _get_attr(attrs, bases, name):
+    # Attribute of the class being defined
+    if name in attrs:
+        return attrs[name]
+    for base in bases:
+        if hasattr(base, name):
+            return getattr(base, name)
+    return None
+
+
 class DocumentMetaclass(StructuredDictMetaclass):
     """
     use for judging if Document's subclasses have assign attribute 'col' properly
@@ -47,6 +112,50 @@ class DocumentMetaclass(StructuredDictMetaclass):
                     '`col` should be pymongo.Collection instance, received: %s %s' %
                     (attrs['col'], type(attrs['col'])))
 
+            # put the change tracking methods in front if `__track_changes__` is on
+            track = attrs.get('__track_changes__')
+            if track is None:
+                track = any(getattr(b, '__track_changes__', False) for b in bases)
+            is_tracked = any(issubclass(b, TrackedDocumentMixin) for b in bases)
+            if track and not is_tracked:
+                bases = (TrackedDocumentMixin, ) + bases
+            elif is_tracked and not track:
+                raise errors.StructError(
+                    '`__track_changes__` could not be turned off for subclass of %s' % bases)
+
+            # the same for lazy decoding if `__lazy__` is on
+            lazy = attrs.get('__lazy__')
+            if lazy is None:
+                lazy = any(getattr(b, '__lazy__', False) for b in bases)
+            is_lazy = any(issubclass(b, LazyDocumentMixin) for b in bases)
+            if lazy and not is_lazy:
+                if track:
+                    raise errors.StructError(
+                        '`__lazy__` and `__track_changes__` could not be both turned on')
+                bases = (LazyDocumentMixin, ) + bases
+            elif is_lazy and not lazy:
+                raise errors.StructError(
+                    '`__lazy__` could not be turned off for subclass of %s' % bases)
+
+            # check the upgrade chain if the class is versioned
+            version = _get_attr(attrs, bases, '__schema_version__')
+            if version is not None:
+                upgrade.check_upgrades(version, _get_attr(attrs, bases, '__upgrades__') or {})
+
+            # check the declared indexes against struct
+            declared = _get_attr(attrs, bases, 'indexes')
+            struct = _get_attr(attrs, bases, 'struct')
+            if declared and struct is not None:
+                extra_paths = ['_id']
+                if version is not None:
+                    extra_paths.append(_get_attr(attrs, bases, '__version_field__'))
+                indexes.check_indexes(declared, struct, extra_paths)
+
+            # check the declared references against struct
+            declared = _get_attr(attrs, bases, 'references')
+            if declared:
+                references.check_references(declared, struct)
+
         # return type.__new__(cls, name, bases, attrs)
         return StructuredDictMetaclass.__new__(cls, name, bases, attrs)
 
@@ -107,25 +216,99 @@ class Document(StructuredDict):
     # validate only works on `save` method
     __validate__ = True
 
-    def __init__(self, raw=None, from_db=False):
+    # Record modified paths as they happen instead of diffing with a snapshot,
+    # see `tracking.TrackedDocumentMixin`
+    __track_changes__ = False
+
+    # Fetch documents as BSON bytes and decode fields on access,
+    # see `lazy.LazyDocumentMixin`
+    __lazy__ = False
+
+    # A `cache.CacheBackend` to cache `one` lookups by `_id`,
+    # entries expire after `__cache_ttl__` seconds (never if None)
+    __cache__ = None
+
+    __cache_ttl__ = 60
+
+    # Fetch only the fields in `struct` by `find`, `one` and `pull`,
+    # can be overridden by `auto_projection` argument of `find` and `one`
+    __auto_projection__ = False
+
+    # Upgrade documents stored with an older version on read, see `upgrade`,
+    # the version is in `__version_field__`, `__upgrades__` maps a version
+    # to the function that upgrades a document to the next version
+    __schema_version__ = None
+
+    __version_field__ = '_v'
+
+    __upgrades__ = {}
+
+    # Write upgraded documents back in background by `upgrade.write_behind`
+    __upgrade_write_behind__ = False
+
+    # Indexes of `col`, see `indexes` for the format and `ensure_indexes`
+    indexes = None
+
+    # A `plan.PlanGuard` to check plans of queries by `find` and `one`
+    __plan_guard__ = None
+
+    # References to other documents, see `references` for the format and `ref`
+    references = None
+
+    _read_only = False
+
+    # {path: resolved documents} of `ref`
+    _resolved_refs = None
+
+    _projection = None
+
+    # Top level keys of an upgrade put to `upgrade.write_behind`
+    _upgrade_keys = None
+
+    def __init__(self, raw=None, from_db=False, read_only=False, projection=None):
         """ wrapper of raw data from cursor
 
         NOTE *initialize without validation*
+
+        A `read_only` document keeps no snapshot of `raw`,
+        it could not be written back to database.
+
+        A document fetched with `projection` is partial, `save` is refused
+        on it, as it would remove the fields not fetched.
+
+        A document of an older version than `__schema_version__` is
+        upgraded if it is not partial, see `upgrade`.
         """
         self._in_db = from_db
+        self._raw = None
+        if projection is not None:
+            self._projection = projection
 
         if raw is None:
             assert self._in_db is False
             super(Document, self).__init__()
-            self._raw = None
+        elif read_only:
+            super(Document, self).__init__()
+            self._load(raw, snapshot=False)
+            self._read_only = True
+        elif self._in_db:
+            super(Document, self).__init__()
+            self._load(raw)
         else:
+            super(Document, self).__init__(raw)
+
+        if self.__schema_version__ is not None:
             if self._in_db:
-                # Use deepcopy to isolate raw and Document itself
-                super(Document, self).__init__(copy.deepcopy(raw))
-                self._raw = raw
-            else:
-                super(Document, self).__init__(raw)
-                self._raw = None
+                if projection is None:
+                    self._upgrade()
+            elif raw is None or self.__version_field__ not in raw:
+                # New documents are of the current version
+                self[self.__version_field__] = self.__schema_version__
+
+        if self._in_db and not read_only:
+            session = current_session()
+            if session is not None:
+                session.add(self)
 
         # A document instance can be get in 3 ways:
         # 1. Document(raw)
@@ -138,6 +321,159 @@ class Document(StructuredDict):
         #    Has _id
         #    Has self._raw
 
+    def _load(self, raw, snapshot=True):
+        """Replace the content of the document by `raw` fetched from database.
+
+        `raw` is kept as the snapshot if `snapshot` is True, nested values
+        are shared with it until they are got from the document, see `_detach`.
+        """
+        dict.clear(self)
+        dict.update(self, raw)
+        if snapshot:
+            self._raw = raw
+
+    def _reset_changes(self):
+        """Take the current content as what is stored in database"""
+        raw = self._raw or {}
+        snapshot = {}
+        for k, v in dict.iteritems(self):
+            # Values still shared with the snapshot are not copied
+            if v is not raw.get(k, _missing):
+                v = _copy(v)
+            snapshot[k] = v
+        self._raw = snapshot
+
+    def _detach(self, k, v):
+        # Copy on write: a dict or list shared with the snapshot is copied
+        # the first time it is got, as it may be modified after that
+        raw = self._raw
+        if raw is not None and isinstance(v, (dict, list)) and v is raw.get(k):
+            v = _copy(v)
+            dict.__setitem__(self, k, v)
+        return v
+
+    def _peek(self, k, default=None):
+        # Read without copy on write, the value must not be modified,
+        # see `cursor.get_field`
+        return dict.get(self, k, default)
+
+    def __getitem__(self, k):
+        return self._detach(k, dict.__getitem__(self, k))
+
+    def get(self, k, default=None):
+        if k in self:
+            return self._detach(k, dict.__getitem__(self, k))
+        return default
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self._detach(k, dict.__getitem__(self, k))
+        dict.__setitem__(self, k, default)
+        return default
+
+    def pop(self, k, *args):
+        if k in self:
+            self._detach(k, dict.__getitem__(self, k))
+        return dict.pop(self, k, *args)
+
+    def popitem(self):
+        if not self:
+            return dict.popitem(self)
+        k = next(iter(self))
+        return k, self.pop(k)
+
+    def values(self):
+        return [self[k] for k in dict.keys(self)]
+
+    def items(self):
+        return [(k, self[k]) for k in dict.keys(self)]
+
+    def itervalues(self):
+        for k in dict.keys(self):
+            yield self[k]
+
+    def iteritems(self):
+        for k in dict.keys(self):
+            yield k, self[k]
+
+    def viewvalues(self):
+        # A view reads the values without `__getitem__`, detach them first
+        for k in dict.keys(self):
+            self._detach(k, dict.__getitem__(self, k))
+        return dict.viewvalues(self)
+
+    def viewitems(self):
+        for k in dict.keys(self):
+            self._detach(k, dict.__getitem__(self, k))
+        return dict.viewitems(self)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def _upgrade(self):
+        cls = self.__class__
+        field = cls.__version_field__
+        version = self.get(field, 0)
+        if version == cls.__schema_version__:
+            return
+        if not isinstance(version, (int, long)):
+            raise errors.SchemaVersionError('%s of %s is not a version: %r' % (
+                field, self.get('_id'), version))
+        if version > cls.__schema_version__:
+            # Written by a newer version of the application
+            return
+        cls.get_upgrade(version)(self)
+        if cls.__upgrade_write_behind__ and not self._read_only:
+            if version == 0:
+                spec = {'_id': self['_id'], field: {'$exists': False}}
+            else:
+                spec = {'_id': self['_id'], field: version}
+            keys = upgrade.changed_keys(self.changes)
+            upgrade.write_behind.put(cls.get_write_collection(), spec,
+                                     upgrade.absolute_update(self, keys))
+            # Written by `write_behind`, or with the next changes by `update_changes`
+            self._reset_changes()
+            self._upgrade_keys = keys
+
+    @classmethod
+    def get_upgrade(cls, version):
+        """Return the function that upgrades a document of `version` to
+        `__schema_version__`, compiled once per version, compiled again
+        if `__schema_version__` or `__upgrades__` is reassigned"""
+        cached = cls.__dict__.get('_compiled_upgrades')
+        if (cached is None or cached[0] is not cls.__upgrades__ or
+                cached[1] != cls.__schema_version__):
+            cached = (cls.__upgrades__, cls.__schema_version__, {})
+            cls._compiled_upgrades = cached
+        func = cached[2].get(version)
+        if func is None:
+            func = upgrade.compile_upgrade(
+                cls.__upgrades__, version, cls.__schema_version__, cls.__version_field__)
+            cached[2][version] = func
+        return func
+
+    @classmethod
+    def wrap(cls, raw, read_only=False, projection=None):
+        """Wrap `raw` fetched from database, return the instance in the
+        current identity map if there is one. Read-only and partial
+        documents are not in the identity map."""
+        imap = current_identity_map()
+        if imap is None or read_only or projection is not None:
+            return cls(raw, from_db=True, read_only=read_only, projection=projection)
+
+        _id = cls._raw_id(raw)
+        if _id is None:
+            return cls(raw, from_db=True, projection=projection)
+        doc = imap.get(cls, _id)
+        if doc is None:
+            doc = cls(raw, from_db=True, projection=projection)
+            imap.put(doc)
+        return doc
+
+    @classmethod
+    def _raw_id(cls, raw):
+        return raw.get('_id')
+
     def __str__(self):
         return '<Document: %s >' % dict(self)
 
@@ -154,88 +490,444 @@ class Document(StructuredDict):
         return options
 
     def save(self):
+        assert not self._read_only, 'Could not save read-only document'
+        assert self._projection is None, \
+            'Could not save partial document fetched with projection, use `update_changes`'
         if self.__class__.__validate__:
             logging.debug('__validate__ is on')
             self.validate()
 
         if '_id' not in self:
             self['_id'] = ObjectId()
-            logging.debug('_id generated %s' % self['_id'])
-
-        if self._raw is None:
-            self._raw = copy.deepcopy(dict(self))
+            logging.debug('_id generated %s', self['_id'])
 
+        start = time.time() if tracing.listeners else None
         rv = self.col.save(self, **self._get_write_options(manipulate=True))
-        logging.debug('ObjectId(%s) saved' % rv)
+        if start is not None:
+            tracing.emit('save', self.col, start, 1, [self])
+        logging.debug('ObjectId(%s) saved', rv)
+        self.__class__.invalidate_cache(self['_id'])
+        self._reset_changes()
+        self._upgrade_keys = None
         self._in_db = True
+        imap = current_identity_map()
+        if imap is not None:
+            imap.put(self)
         return rv
 
     def remove(self):
         assert self._in_db, 'Could not remove document which is not in database'
-        self._history = self.copy()
+        assert not self._read_only, 'Could not remove read-only document'
         _id = self['_id']
+        start = time.time() if tracing.listeners else None
         self.col.remove(_id, **self._get_write_options())
-        logging.debug('%s removed' % _id)
-        self.clear()
+        if start is not None:
+            tracing.emit('remove', self.col, start, 1)
+        self.__class__.invalidate_cache(_id)
+        imap = current_identity_map()
+        if imap is not None:
+            imap.discard(self.__class__, _id)
+        logging.debug('%s removed', _id)
+        self._removed()
+
+    def _removed(self):
+        """Clear the document after it is removed from database,
+        the content is kept in `_history`"""
+        self._history = dict.copy(self)
+        dict.clear(self)
         self._in_db = False
 
     def update_self(self, spec, **kwargs):
+        assert not self._read_only, 'Could not update read-only document'
         options = self._get_write_options(**kwargs)
         # Make sure `multi` is False
         options['multi'] = False
+        start = time.time() if tracing.listeners else None
         rv = self.col.update(
             self.identifier, spec, **options)
+        if start is not None:
+            tracing.emit('update_self', self.col, start, 1, [spec])
+        self.__class__.invalidate_cache(self['_id'])
         return rv
 
+    @classmethod
+    def invalidate_cache(cls, _id):
+        # Also cached by other classes of the collection
+        cache.invalidate(cls.col, _id)
+
     @property
     def changes(self):
+        """The update spec from the snapshot to current content, see `diff_update`"""
         if not self._raw:
             return None
-        c = {}
-
-        diff = diff_dicts(self, self._raw)
-
-        # $set & $inc
-        if diff['+']:
-            c['$set'] = diff['+']
-
-        # $inc
-        for i in diff['~']:
-            if isinstance(self[i], int) and isinstance(self._raw[i], int):
-                inc = c.setdefault('$inc', {})
-                inc[i] = self[i] - self._raw[i]
-            else:
-                set_ = c.setdefault('$set', {})
-                set_[i] = self[i]
-
-        # $unset
-        if diff['-']:
-            c['$unset'] = diff['-']
-
-        return c
+        return diff_update(self, self._raw)
 
     def update_changes(self, **kwargs):
+        assert not self._read_only, 'Could not update read-only document'
         c = self.changes
         if c:
+            if self._upgrade_keys:
+                # The upgrade may not be written by `write_behind` yet
+                c = upgrade.absolute_update(self, self._upgrade_keys, c)
             logging.debug('update changes: %s', c)
             self.update_self(c, **kwargs)
+            self._reset_changes()
+            self._upgrade_keys = None
         else:
             logging.debug('no changes to update')
 
     def pull(self):
-        """Update document from database
+        """Update document from database, with the projection
+        it was fetched with
         """
-        cursor = Cursor(self.col, self.identifier)
+        start = time.time() if tracing.listeners else None
+        cursor = Cursor(self.get_read_collection(), self.identifier, self._projection)
         try:
             doc = cursor.next()
         except StopIteration:
             raise errors.SimplemongoException('Document was deleted before `pull` was called')
-        self.clear()
-        self.update(doc)
+        if start is not None:
+            tracing.emit('pull', self.col, start, 1, [doc])
+        self._load(doc)
+        self._resolved_refs = None
+        self._upgrade_keys = None
+        if self.__schema_version__ is not None and self._projection is None:
+            self._upgrade()
+        imap = current_identity_map()
+        if imap is not None and self._projection is None:
+            imap.put(self)
+
+    @classmethod
+    def get_projection(cls):
+        """Return the projection of the fields in `struct`, see `dstruct.struct_projection`"""
+        assert hasattr(cls, 'struct'), '`get_projection` method requires definition of `struct`'
+        cached = cls.__dict__.get('_struct_projection')
+        if cached is None or cached[0] is not cls.struct:
+            cached = (cls.struct, struct_projection(cls.struct))
+            cls._struct_projection = cached
+        return cached[1]
+
+    @classmethod
+    def _add_projection(cls, args, kwargs, index):
+        """Pop `auto_projection` from `kwargs`, add the projection of `struct`
+        to `kwargs` if needed, return the projection of the query.
+
+        `index` is the position of `projection` in `args`.
+        """
+        auto = kwargs.pop('auto_projection', None)
+        if auto is None:
+            auto = cls.__auto_projection__
+        if len(args) > index:
+            projection = args[index]
+        else:
+            projection = kwargs.get('projection')
+        if projection is None and auto:
+            projection = kwargs['projection'] = cls.get_projection()
+        return projection
 
     @classmethod
-    def insert(cls, *args, **kwargs):
-        pass
+    def get_record_class(cls):
+        """Return the `record.Record` class of the fields in `struct`,
+        generated again if `struct` is reassigned"""
+        assert hasattr(cls, 'struct'), '`get_record_class` method requires definition of `struct`'
+        record_class = cls.__dict__.get('_record_class')
+        if record_class is None or record_class._struct is not cls.struct:
+            record_class = make_record_class('%sRecord' % cls.__name__, cls.struct)
+            cls._record_class = record_class
+        return record_class
+
+    @classmethod
+    def get_indexes(cls):
+        """Return [(keys, options), ...] of `indexes` checked against
+        `struct`, checked again if `indexes` or `struct` is reassigned"""
+        cached = cls.__dict__.get('_checked_indexes')
+        struct = getattr(cls, 'struct', None)
+        if cached is None or cached[0] is not cls.indexes or cached[1] is not struct:
+            if struct is None:
+                declared = [indexes.normalize_index(i) for i in cls.indexes or []]
+            else:
+                extra_paths = ['_id']
+                if cls.__schema_version__ is not None:
+                    extra_paths.append(cls.__version_field__)
+                declared = indexes.check_indexes(cls.indexes or [], struct, extra_paths)
+            cached = (cls.indexes, struct, declared)
+            cls._checked_indexes = cached
+        return cached[2]
+
+    @classmethod
+    def get_references(cls):
+        """Return {path: class} of `references`, classes given by name
+        are looked up in the subclasses of `Document`"""
+        cached = cls.__dict__.get('_references_classes')
+        if cached is None or cached[0] is not cls.references:
+            resolved = {}
+            for path, target in (cls.references or {}).iteritems():
+                if isinstance(target, basestring):
+                    target = references.find_class(Document, target)
+                resolved[path] = target
+            cached = (cls.references, resolved)
+            cls._references_classes = cached
+        return cached[1]
+
+    @classmethod
+    def resolve_refs(cls, docs, *paths):
+        """Fetch the documents referenced by `paths` of `references`
+        for all `docs` at once, to be returned by `ref`"""
+        references.resolve(docs, paths, cls.get_references())
+
+    def ref(self, path):
+        """Return the document referenced by `path` of `references`, or
+        the list of documents for a list of ids (without those not found).
+
+        Resolved once, for a whole batch if the document was fetched by
+        a cursor with `prefetch(path)`, see `references`.
+        """
+        assert path in (self.references or {}), '%s is not in `references`' % path
+        if self._resolved_refs is None or path not in self._resolved_refs:
+            self.resolve_refs([self], path)
+        return self._resolved_refs[path]
+
+    def _set_ref(self, path, resolved):
+        if self._resolved_refs is None:
+            self._resolved_refs = {}
+        self._resolved_refs[path] = resolved
+
+    @classmethod
+    def ensure_indexes(cls, background=True, create=True):
+        """Create the indexes in `indexes` that are not in `col`, in
+        background by default. Indexes of the same keys but different
+        options are not changed, they are in `conflicts` of the result,
+        as well as indexes not declared in `undeclared`.
+
+        Return an `indexes.IndexSyncResult`, turn `create` off to only
+        get what would be created.
+        """
+        return indexes.sync_indexes(cls.col, cls.get_indexes(), background, create)
+
+    @classmethod
+    def ensure_all_indexes(cls, background=True, create=True):
+        """Call `ensure_indexes` of all the subclasses with `indexes`,
+        e.g. `Document.ensure_all_indexes()` when the application starts,
+        return {class name: `indexes.IndexSyncResult`}"""
+        results = {}
+        todo = [cls]
+        seen = set()
+        while todo:
+            klass = todo.pop()
+            todo.extend(klass.__subclasses__())
+            if klass in seen or not klass.indexes:
+                continue
+            seen.add(klass)
+            results['%s.%s' % (klass.__module__, klass.__name__)] = klass.ensure_indexes(
+                background, create)
+        return results
+
+    @classmethod
+    def unused_indexes(cls):
+        """Return the names of the declared indexes that no operation
+        has used, by `$indexStats`, see `indexes.index_usage`"""
+        usage = indexes.index_usage(cls.col)
+        return [options['name'] for keys, options in cls.get_indexes()
+                if options['name'] in usage and usage[options['name']][0] == 0]
+
+    @classmethod
+    def get_read_collection(cls):
+        """`col` that returns `RawBSONDocument` if `__lazy__` is on"""
+        if not cls.__lazy__:
+            return cls.col
+        return cls.col.with_options(
+            codec_options=cls.col.codec_options._replace(document_class=RawBSONDocument))
+
+    @classmethod
+    def get_write_collection(cls):
+        """`col` with `__write_concern__` applied, for write methods
+        that do not take write concern as arguments"""
+        return cls.col.with_options(
+            write_concern=WriteConcern(**cls.__write_concern__))
+
+    @classmethod
+    def insert(cls, docs, batch_size=1000, ordered=True, validate=None, keep_ids=True):
+        """Insert documents or dicts from an iterable in batches.
+
+        The iterable is consumed lazily, only one batch is held at a time.
+        `_id` is generated for items that do not have one. Items are inserted
+        with the version they have, dicts without `__version_field__` are
+        of version 0 and upgraded when read, documents created by the class
+        are of the current version.
+
+        :param ordered: like `ordered` in `insert_many`, stop at the first
+                        validation or write error
+        :param validate: validate items before inserting,
+                         defaults to `__validate__`
+        :param keep_ids: collect the `_id` of inserted items in
+                         `inserted_ids`, turn off for huge iterables
+
+        Return an `InsertResult`.
+        """
+        if validate is None:
+            validate = cls.__validate__
+        if validate:
+            compiled = cls.get_compiled_struct()
+        col = cls.get_write_collection()
+        result = InsertResult()
+        start = time.time()
+
+        def flush(batch, positions):
+            # `positions` are the indexes of items of `batch` in `docs`,
+            # return False if inserting should stop
+            result.elapsed = time.time() - start
+            if not batch:
+                return True
+            inserted = batch
+            ok = True
+            batch_start = time.time() if tracing.listeners else None
+            try:
+                col.insert_many(batch, ordered=ordered)
+            except BulkWriteError as e:
+                failed = set()
+                for error in e.details['writeErrors']:
+                    failed.add(error['index'])
+                    result.errors.append({
+                        'index': positions[error['index']],
+                        'code': error['code'],
+                        'errmsg': error['errmsg'],
+                    })
+                if ordered:
+                    inserted = batch[:e.details['nInserted']]
+                    ok = False
+                else:
+                    inserted = [doc for i, doc in enumerate(batch) if i not in failed]
+            logging.debug('inserted %s documents', len(inserted))
+            if batch_start is not None:
+                tracing.emit('insert', col, batch_start, len(inserted), batch)
+
+            result.inserted_count += len(inserted)
+            for doc in inserted:
+                if keep_ids:
+                    result.inserted_ids.append(doc['_id'])
+                if isinstance(doc, Document):
+                    doc._reset_changes()
+                    doc._in_db = True
+            result.elapsed = time.time() - start
+            return ok
+
+        iterator = enumerate(docs)
+        while True:
+            batch = []
+            positions = []
+            consumed = False
+            for index, doc in itertools.islice(iterator, batch_size):
+                consumed = True
+                if validate:
+                    try:
+                        if isinstance(doc, StructuredDict):
+                            doc.validate()
+                        else:
+                            compiled.validate(doc)
+                    except (TypeError, KeyError) as e:
+                        result.errors.append({'index': index, 'code': None, 'errmsg': e.args[0]})
+                        if ordered:
+                            flush(batch, positions)
+                            return result
+                        continue
+                if '_id' not in doc:
+                    doc['_id'] = ObjectId()
+                batch.append(doc)
+                positions.append(index)
+
+            if not consumed or not flush(batch, positions):
+                return result
+
+    @classmethod
+    def auto_fix(cls, spec=None, remove_unknown=False, converters=None, batch_size=500,
+                 max_rate=None, checkpoint=None, dry_run=False, progress=None):
+        """Update the documents matching `spec` in the collection to fit
+        `struct`, in order of `_id`, see `migration` for what are fixed.
+
+        Updates are written by `bulk_write` after every `batch_size`
+        documents are scanned, then the last `_id` is saved in `checkpoint`
+        (a `migration.FileCheckpoint` or `migration.CollectionCheckpoint`),
+        a later run with the same checkpoint goes on after it.
+
+        :param remove_unknown: unset keys not in `struct` (except `_id`)
+        :param converters: dict of struct path or (value type, struct type)
+                           to converter, over `migration.CONVERTERS`
+        :param max_rate: at most this many documents scanned per second
+        :param dry_run: only count what would be fixed, write nothing
+        :param progress: called with the `migration.MigrationResult`
+                         after every batch
+
+        Return a `migration.MigrationResult`.
+        """
+        assert hasattr(cls, 'struct'), '`auto_fix` method requires definition of `struct`'
+        return migration.run_migration(
+            cls, spec, remove_unknown, converters, batch_size, max_rate,
+            checkpoint, dry_run, progress)
+
+    @classmethod
+    def export(cls, path, spec=None, format=None, compress=None, batch_size=1000,
+               prefetch=None, chunks=None, **kwargs):
+        """Write the documents matching `spec` to a file at `path`, streamed
+        in batches of `batch_size`, see `dump` for the formats and compression,
+        which are guessed from the extension if not given.
+
+        :param prefetch: fetch ahead by `cursor.prefetch(depth)` if given
+        :param chunks: if given, read in parallel by `parallel_scan` split
+                       into `chunks` ranges, in threads, documents are not
+                       written in order of `_id` then
+
+        Other keyword arguments are passed to `find`.
+        Return a `dump.ExportResult`.
+        """
+        format, compress = dump.guess_format(path, format, compress)
+        result = dump.ExportResult(path, format)
+        start = time.time()
+
+        def prepare(cursor):
+            if format == 'bson':
+                # Written as the bytes from the server, not decoded
+                cursor.bson()
+            else:
+                cursor.raw()
+            if prefetch:
+                cursor.prefetch(prefetch)
+            return cursor
+
+        with dump.open_file(path, 'w', compress) as f:
+            if chunks:
+                writer = dump.Writer(f, format, result, threading.Lock())
+                scanned = cls.parallel_scan(
+                    lambda cursor: writer.write_all(prepare(cursor), batch_size),
+                    spec, chunks=chunks, **kwargs)
+                if not scanned.ok:
+                    raise scanned.errors[0]['error']
+            else:
+                writer = dump.Writer(f, format, result)
+                writer.write_all(prepare(cls.find(spec, **kwargs)), batch_size)
+        result.elapsed = time.time() - start
+        logging.info('exported %s documents of %s to %s in %.2fs (%.0f/s)',
+                     result.count, cls.__name__, path, result.elapsed, result.rate)
+        return result
+
+    @classmethod
+    def import_(cls, path, format=None, compress=None, validate=None, batch_size=1000,
+                ordered=False, keep_ids=False):
+        """Insert the documents in a file written by `export` (or mongodump,
+        mongoexport) by `insert`, read one batch at a time.
+
+        Unlike `insert`, `ordered` defaults to False, so that documents
+        already in the collection or invalid are skipped and reported in
+        `errors`. Return an `InsertResult`.
+        """
+        format, compress = dump.guess_format(path, format, compress)
+        with dump.open_file(path, 'r', compress) as f:
+            docs = dump.iter_documents(f, format, cls.col.codec_options)
+            result = cls.insert(docs, batch_size=batch_size, ordered=ordered,
+                                validate=validate, keep_ids=keep_ids)
+        logging.info('imported %s documents of %s from %s in %.2fs (%.0f/s), %s errors',
+                     result.inserted_count, cls.__name__, path, result.elapsed,
+                     result.rate, len(result.errors))
+        return result
 
     @classmethod
     def new(cls, **kwargs):
@@ -244,31 +936,191 @@ class Document(StructuredDict):
         """
         if '_id' not in kwargs:
             kwargs['_id'] = ObjectId()
-            logging.debug('_id generated %s' % kwargs['_id'])
+            logging.debug('_id generated %s', kwargs['_id'])
         instance = cls.build_instance(**kwargs)
         return instance
 
     @classmethod
     def find(cls, *args, **kwargs):
+        """Arguments are the same as `pymongo.Collection.find`, except:
+
+        :param read_only: wrap results as read-only documents, which
+                          keep no snapshot for `changes`
+        :param auto_projection: fetch only the fields in `struct`,
+                                defaults to `__auto_projection__`
+        """
+        cls._add_projection(args, kwargs, 1)
         logging.debug('find: %s, %s', args, kwargs)
         kwargs['wrapper'] = cls
-        cursor = SimplemongoCursor(cls.col, *args, **kwargs)
+        cursor = SimplemongoCursor(cls.get_read_collection(), *args, **kwargs)
         return cursor
 
+    @classmethod
+    def paginate(cls, spec=None, sort=None, after=None, limit=20, **kwargs):
+        """Return a `pagination.Page` of at most `limit` documents matching
+        `spec` in order of `sort`, after the page whose `next_token` is `after`.
+
+        `sort` is a list of keys or (key, direction), `_id` is added as the
+        last key if missing. A page is fetched by a range on the sort keys,
+        its cost does not depend on how deep it is if the sort keys
+        are indexed. Sort keys should not be missing, null or of different
+        types in the matched documents, as a range only matches one type.
+
+        Other keyword arguments are passed to `find`.
+        """
+        sort = normalize_sort(sort)
+        if after is not None:
+            values = decode_token(after, sort)
+            condition = keyset_filter(sort, values)
+            if spec:
+                spec = {'$and': [spec, condition]}
+            else:
+                spec = condition
+
+        # One more document to know if there is a next page
+        docs = list(cls.find(spec, **kwargs).sort(sort).limit(limit + 1))
+        next_token = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            last = docs[-1]
+            next_token = encode_token(sort, [get_field(last, k) for k, _ in sort])
+        return Page(docs, next_token)
+
+    @classmethod
+    def get_split_points(cls, chunks, split='time'):
+        """Return the `_id` values that split the collection into at most
+        `chunks` ranges, see `scan` for the `split` methods"""
+        if split == 'time':
+            bounds = []
+            for direction in (ASCENDING, DESCENDING):
+                for raw in cls.col.find({}, {'_id': 1}).sort('_id', direction).limit(1):
+                    bounds.append(raw['_id'])
+            if not bounds:
+                return []
+            if not all(isinstance(i, ObjectId) for i in bounds):
+                raise ValueError("split='time' requires ObjectId `_id`, use split='sample'")
+            return scan.time_split_points(bounds[0], bounds[1], chunks)
+        elif split == 'sample':
+            pipeline = [
+                {'$sample': {'size': chunks * scan.SAMPLES_PER_CHUNK}},
+                {'$project': {'_id': 1}},
+            ]
+            ids = [raw['_id'] for raw in cls.col.aggregate(pipeline)]
+            return scan.sample_split_points(ids, chunks)
+        else:
+            raise ValueError("split should be 'time' or 'sample', got %r" % split)
+
+    @classmethod
+    def parallel_scan(cls, func, spec=None, chunks=8, split='time', executor='thread',
+                      workers=4, retries=2, retry_on=(PyMongoError, ), retry_delay=0.5,
+                      progress=None, **kwargs):
+        """Split the documents matching `spec` into ranges of `_id`,
+        call `func` with the cursor of `find` for each range in a pool,
+        return a `scan.ScanResult` of the return values.
+
+        :param chunks: number of ranges, there may be fewer
+        :param split: 'time' for ObjectId timestamps, 'sample' for sampled
+                      `_id` values, or a sorted list of `_id` values
+        :param executor: 'thread' or 'process', for the process pool `func`
+                         and this class should be defined at module level,
+                         and `col` should connect after fork
+                         (e.g. `MongoClient(connect=False)`)
+        :param retries: times to call `func` again for a chunk on `retry_on`
+                        errors, with delays of `retry_delay` doubled each time,
+                        `func` should be safe to run again on the same chunk
+        :param progress: called with (done, total) of chunks in this thread
+
+        Other keyword arguments are passed to `find`. Chunks that failed are
+        in `errors` of the result, instead of raising.
+        """
+        if isinstance(split, basestring):
+            points = cls.get_split_points(chunks, split)
+        else:
+            points = split
+        ranges = scan.chunk_ranges(points)
+        logging.debug('parallel scan of %s in %s chunks', cls.__name__, len(ranges))
+        return scan.run_scan(cls, func, spec, ranges, executor, workers, retries,
+                             retry_on, retry_delay, progress, kwargs)
+
+    @classmethod
+    def _find_one_by_id(cls, _id, *args, **kwargs):
+        # Read through `__cache__`, only for whole documents
+        col = cls.get_read_collection()
+        if cls.__cache__ is None or args or kwargs:
+            return col.find_one({'_id': _id}, *args, **kwargs)
+
+        key = cache.cache_key(cls.col, _id)
+        data = cls.__cache__.get(key)
+        if data is not None:
+            return BSON(data).decode(codec_options=col.codec_options)
+
+        raw = col.find_one({'_id': _id})
+        if raw is not None:
+            cache.register(cls.col, cls.__cache__)
+            cls.__cache__.set(key, BSON.encode(raw), cls.__cache_ttl__)
+        return raw
+
     @classmethod
     def one(cls, spec_or_id, allow_multiple=False, *args, **kwargs):
+        """Return the only document matching `spec_or_id`, or None.
+
+        Raise `MultipleObjectsReturned` if more than one document matches,
+        unless `allow_multiple` is True. Takes one round trip: a lookup by
+        `_id` uses `find_one`, others fetch at most 2 documents in one batch.
+
+        `read_only` and `auto_projection` are the same as in `find`.
+        """
+        if not tracing.listeners:
+            return cls._one(spec_or_id, allow_multiple, *args, **kwargs)
+        start = time.time()
+        rv = cls._one(spec_or_id, allow_multiple, *args, **kwargs)
+        tracing.emit('one', cls.col, start, int(rv is not None))
+        return rv
+
+    @classmethod
+    def _one(cls, spec_or_id, allow_multiple, *args, **kwargs):
         if spec_or_id is not None and not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
 
-        cursor = cls.find(spec_or_id, *args, **kwargs)
-        if not allow_multiple:
-            count = cursor.count()
-            if count > 1:
-                raise errors.MultipleObjectsReturned(
-                    'explain: %s' % cursor.explain())
-        for doc in cursor:
+        # `_id` is unique, no need to check multiple results, unless it is
+        # a query like a regex that matches many ids
+        if (spec_or_id is not None and len(spec_or_id) == 1 and '_id' in spec_or_id and
+                isinstance(spec_or_id['_id'], (ObjectId, basestring, int, long))):
+            read_only = kwargs.pop('read_only', False)
+            projection = cls._add_projection(args, kwargs, 0)
+            imap = current_identity_map()
+            if read_only or projection is not None:
+                imap = None
+            if imap is not None:
+                doc = imap.get(cls, spec_or_id['_id'])
+                if doc is not None:
+                    return doc
+            raw = cls._find_one_by_id(spec_or_id['_id'], *args, **kwargs)
+            if raw is None:
+                return None
+            doc = cls(raw, from_db=True, read_only=read_only, projection=projection)
+            if imap is not None:
+                imap.put(doc)
             return doc
-        return None
+
+        cursor = cls.find(spec_or_id, *args, **kwargs)
+        if allow_multiple:
+            # Negative limit returns a single batch and closes the cursor
+            cursor.limit(-1)
+        else:
+            # Not -2, a single batch may hold only one of two large documents
+            cursor.limit(2)
+
+        rv = None
+        try:
+            for doc in cursor:
+                if rv is not None:
+                    raise errors.MultipleObjectsReturned(
+                        'explain: %s' % cursor.explain())
+                rv = doc
+        finally:
+            cursor.close()
+        return rv
 
     @classmethod
     def one_or_raise(cls, *args, **kwargs):
@@ -276,3 +1128,79 @@ class Document(StructuredDict):
         if rv is None:
             raise errors.ObjectNotFound('Could not find: %s, %s' % (args, kwargs))
         return rv
+
+    @classmethod
+    def get_many(cls, ids, chunk_size=1000, preserve_order=True, missing='skip',
+                 workers=None, read_only=False, **kwargs):
+        """Return the documents of `ids` (ObjectId or str, see `oid`),
+        fetched by `$in` queries of at most `chunk_size` distinct ids,
+        except those in the current identity map.
+
+        With `preserve_order` the documents are in the order of `ids`
+        (a repeated id gives the same document again), otherwise in the
+        order they are got. An id not found is left out if `missing` is
+        'skip', given as None if 'none' (only with `preserve_order`), or
+        `ObjectNotFound` is raised if 'raise'.
+
+        If `workers` is given, the chunks are fetched by a pool of threads,
+        documents are still wrapped in the calling thread.
+
+        `read_only` and `auto_projection` are the same as in `find`.
+        """
+        assert missing in ('skip', 'none', 'raise'), \
+            "`missing` should be 'skip', 'none' or 'raise', got %r" % missing
+        assert preserve_order or missing != 'none', "`missing='none'` requires `preserve_order`"
+        assert chunk_size > 0, '`chunk_size` should be positive'
+        projection = cls._add_projection((), kwargs, 0)
+        ids = [oid(i) for i in ids]
+
+        found = {}
+        order = []
+        todo = []
+        imap = None if read_only or projection is not None else current_identity_map()
+        seen = set()
+        for _id in ids:
+            if _id in seen:
+                continue
+            seen.add(_id)
+            doc = imap.get(cls, _id) if imap is not None else None
+            if doc is None:
+                todo.append(_id)
+            else:
+                found[_id] = doc
+                order.append(_id)
+
+        start = time.time() if tracing.listeners else None
+        col = cls.get_read_collection()
+        chunks = [todo[i:i + chunk_size] for i in xrange(0, len(todo), chunk_size)]
+
+        def fetch(chunk):
+            return list(col.find({'_id': {'$in': chunk}}, **kwargs))
+
+        if workers and len(chunks) > 1:
+            pool = ThreadPool(min(workers, len(chunks)))
+            try:
+                batches = pool.map(fetch, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            batches = [fetch(chunk) for chunk in chunks]
+
+        fetched = [raw for raws in batches for raw in raws]
+        if start is not None:
+            tracing.emit('get_many', cls.col, start, len(fetched), fetched)
+        for raw in fetched:
+            _id = cls._raw_id(raw)
+            found[_id] = cls.wrap(raw, read_only=read_only, projection=projection)
+            order.append(_id)
+
+        if missing == 'raise' and len(found) < len(seen):
+            not_found = [i for i in todo if i not in found]
+            raise errors.ObjectNotFound('%s ids of %s not found: %s' % (
+                len(not_found), cls.__name__, not_found[:10]))
+        if not preserve_order:
+            return [found[i] for i in order]
+        if missing == 'none':
+            return [found.get(i) for i in ids]
+        return [found[i] for i in ids if i in found]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Keyset pagination, see `Document.paginate`.
+
+A page is fetched by a range on the sort keys starting after the last
+document of the previous page, instead of skipping the documents
+of the previous pages, so the cost of a page does not depend on how
+deep it is (with an index on the sort keys).
+
+The position is passed between pages as an opaque token, which is the
+sort and the values of the sort keys of the last document, encoded in
+BSON (so that types like ObjectId and datetime are kept) and base64.
+"""
+
+import base64
+import binascii
+from bson import BSON
+from bson.errors import InvalidBSON
+from pymongo import ASCENDING, DESCENDING
+from . import errors
+
+
+def normalize_sort(sort):
+    """Return `sort` as a list of (key, direction), with `_id` ascending
+    added as the last key if it is not in `sort`, to make the order total.
+
+    `sort` is a list of keys or (key, direction), like in `Cursor.sort`.
+    """
+    rv = []
+    for item in sort or []:
+        if isinstance(item, basestring):
+            item = (item, ASCENDING)
+        key, direction = item
+        if direction not in (ASCENDING, DESCENDING):
+            raise ValueError('direction of %s should be ASCENDING or DESCENDING, got %r' %
+                             (key, direction))
+        rv.append((key, direction))
+    if '_id' not in [k for k, _ in rv]:
+        rv.append(('_id', ASCENDING))
+    return rv
+
+
+def keyset_filter(sort, values):
+    """Return the filter of documents after the one whose values of
+    the sort keys are `values`, in order of `sort` (normalized).
+
+    For sort keys k1, k2, k3 it matches:
+    k1 after v1, or k1 = v1 and k2 after v2, or k1 = v1 and k2 = v2 and k3 after v3,
+    where "after" is `$gt` for ascending keys and `$lt` for descending keys.
+    """
+    clauses = []
+    for i, (key, direction) in enumerate(sort):
+        clause = {}
+        for j in range(i):
+            clause[sort[j][0]] = values[j]
+        if direction == ASCENDING:
+            clause[key] = {'$gt': values[i]}
+        else:
+            clause[key] = {'$lt': values[i]}
+        clauses.append(clause)
+
+    if len(clauses) == 1:
+        return clauses[0]
+    # Bound the first key as a whole, so that the index is scanned
+    # from the position instead of once for every clause
+    key, direction = sort[0]
+    if direction == ASCENDING:
+        bound = {'$gte': values[0]}
+    else:
+        bound = {'$lte': values[0]}
+    return {key: bound, '$or': clauses}
+
+
+def encode_token(sort, values):
+    data = BSON.encode({'s': [list(i) for i in sort], 'v': values})
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_token(token, sort):
+    """Return the values in `token`, raise `errors.InvalidToken` if it
+    could not be decoded or it was not generated with `sort`"""
+    try:
+        token = str(token)
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        d = BSON(data).decode()
+        token_sort, values = d['s'], d['v']
+    except (TypeError, ValueError, KeyError, InvalidBSON, binascii.Error):
+        raise errors.InvalidToken('could not decode token %r' % token)
+    if [tuple(i) for i in token_sort] != sort or len(values) != len(sort):
+        raise errors.InvalidToken('token %r was not generated with sort %s' % (token, sort))
+    return values
+
+
+class Page(object):
+    """A page of documents returned by `Document.paginate`
+
+    `next_token` is passed as `after` to get the next page,
+    it is None if this is the last page.
+    """
+    def __init__(self, documents, next_token):
+        self.documents = documents
+        self.next_token = next_token
+
+    @property
+    def has_next(self):
+        return self.next_token is not None
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __getitem__(self, index):
+        return self.documents[index]
+
+    def __repr__(self):
+        return '<Page: %s documents, has_next=%s>' % (len(self.documents), self.has_next)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Guard against queries that are not served by an index, for `Document`
+subclasses with `__plan_guard__`, e.g.::
+
+    class User(Document):
+        __plan_guard__ = PlanGuard('raise')
+
+Before the first batch of a cursor of `find` (and `one`) is fetched, the
+query is explained if its shape has not been seen by the guard. The shape
+is the spec with the values replaced, the sort, the projection and the
+hint, so that `{'name': 'a'}` and `{'name': 'b'}` are explained once.
+
+A plan is bad if it scans the collection (COLLSCAN), or if it examines
+more than `max_ratio` documents for each document returned (and at least
+`min_examined`). A query without filter is not checked, as it is meant to
+scan the collection.
+"""
+
+import logging
+import threading
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from . import errors
+
+
+ACTIONS = ('warn', 'raise', 'record')
+
+_LOGICAL = ('$and', '$or', '$nor')
+
+
+def _operators_shape(operators):
+    shape = []
+    for op in sorted(operators):
+        v = operators[op]
+        if op == '$elemMatch' and isinstance(v, dict):
+            shape.append((op, query_shape(v)))
+        elif op == '$not' and isinstance(v, dict):
+            shape.append((op, _operators_shape(v)))
+        else:
+            shape.append((op, '?'))
+    return tuple(shape)
+
+
+def query_shape(spec):
+    """Return `spec` with values replaced by '?' as a hashable tuple,
+    keys and operators are kept"""
+    if not spec:
+        return ()
+    shape = []
+    for k in sorted(spec):
+        v = spec[k]
+        if k in _LOGICAL and isinstance(v, (list, tuple)):
+            shape.append((k, tuple(query_shape(i) for i in v)))
+        elif (isinstance(v, dict) and v and
+              all(isinstance(i, basestring) and i.startswith('$') for i in v)):
+            shape.append((k, _operators_shape(v)))
+        else:
+            shape.append((k, '?'))
+    return tuple(shape)
+
+
+def _iter_stages(plan):
+    if not isinstance(plan, dict):
+        return
+    if 'stage' in plan:
+        yield plan['stage']
+    for k in ('inputStage', 'queryPlan'):
+        if k in plan:
+            for stage in _iter_stages(plan[k]):
+                yield stage
+    for k in ('inputStages', 'shards'):
+        for sub in plan.get(k) or []:
+            for stage in _iter_stages(sub.get('winningPlan', sub)):
+                yield stage
+
+
+def analyze_explain(explain):
+    """Return (stages, docs examined, documents returned) of the
+    output of `explain`, the numbers are None if not in it"""
+    if isinstance(explain, RawBSONDocument):
+        explain = BSON(explain.raw).decode()
+    planner = explain.get('queryPlanner')
+    if planner is not None:
+        stages = set(_iter_stages(planner.get('winningPlan')))
+        stats = explain.get('executionStats') or {}
+        return stages, stats.get('totalDocsExamined'), stats.get('nReturned')
+    # Before MongoDB 3.0
+    stages = set()
+    if explain.get('cursor', '').startswith('BasicCursor'):
+        stages.add('COLLSCAN')
+    return stages, explain.get('nscannedObjects'), explain.get('n')
+
+
+class PlanEvent(object):
+    """A query with a bad plan found by `PlanGuard`, `reason` is
+    'COLLSCAN' or 'ratio'"""
+    def __init__(self, collection, spec, sort, reason, stages, docs_examined, n_returned):
+        self.collection = collection
+        self.spec = spec
+        self.sort = sort
+        self.reason = reason
+        self.stages = stages
+        self.docs_examined = docs_examined
+        self.n_returned = n_returned
+
+    def __repr__(self):
+        return '<PlanEvent: %s on %s, spec=%s sort=%s examined=%s returned=%s>' % (
+            self.reason, self.collection, self.spec, self.sort,
+            self.docs_examined, self.n_returned)
+
+
+class PlanGuard(object):
+    """Check plans of queries once per shape, see the module doc.
+
+    :param action: what to do with a bad plan, 'warn' logs a warning once
+                   per shape, 'raise' raises `errors.QueryPlanError` for
+                   every query of the shape, 'record' appends the
+                   `PlanEvent` to `events` once per shape
+    :param max_ratio: docs examined per document returned that is too many,
+                      None to only check COLLSCAN
+    :param min_examined: docs examined under which the ratio is not checked
+    :param max_shapes: the shapes seen are forgotten when there are
+                       more than this
+    """
+    def __init__(self, action='warn', max_ratio=None, min_examined=1000, max_shapes=10000):
+        if action not in ACTIONS:
+            raise ValueError('action should be one of %s, got %r' % (ACTIONS, action))
+        self.action = action
+        self.max_ratio = max_ratio
+        self.min_examined = min_examined
+        self.max_shapes = max_shapes
+        self.events = []
+        self.explained = 0
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def check_cursor(self, cursor):
+        """Check the plan of `cursor` before it is iterated"""
+        spec = cursor._Cursor__spec
+        if not spec:
+            return
+        ordering = cursor._Cursor__ordering
+        projection = cursor._Cursor__projection
+        hint = cursor._Cursor__hint
+        key = (
+            cursor.collection.full_name,
+            query_shape(spec),
+            tuple(ordering.items()) if ordering else None,
+            tuple(sorted(projection)) if projection else None,
+            tuple(hint.items()) if isinstance(hint, dict) else hint,
+        )
+        try:
+            event = self._shapes[key]
+            new = False
+        except KeyError:
+            event = self.analyze(cursor, spec, ordering)
+            new = True
+            with self._lock:
+                if len(self._shapes) >= self.max_shapes:
+                    self._shapes.clear()
+                self._shapes[key] = event
+        if event is not None:
+            self.report(event, new)
+
+    def analyze(self, cursor, spec, ordering):
+        """Return a `PlanEvent` if the plan of `cursor` is bad, or None"""
+        self.explained += 1
+        stages, examined, returned = analyze_explain(cursor.explain())
+        reason = None
+        if 'COLLSCAN' in stages:
+            reason = 'COLLSCAN'
+        elif (self.max_ratio is not None and examined is not None and
+              examined >= self.min_examined and
+              examined > self.max_ratio * max(returned or 0, 1)):
+            reason = 'ratio'
+        if reason is None:
+            return None
+        return PlanEvent(cursor.collection.full_name, spec,
+                         ordering.items() if ordering else None,
+                         reason, sorted(stages), examined, returned)
+
+    def report(self, event, new):
+        if self.action == 'raise':
+            raise errors.QueryPlanError(event)
+        if not new:
+            return
+        if self.action == 'warn':
+            logging.warning('bad query plan: %s', event)
+        else:
+            self.events.append(event)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact records for holding many documents of a fixed shape in memory.
+
+A record class is generated from the top level keys of a `struct`
+(plus `_id`), fields are stored in `__slots__`, so a record is a single
+small object instead of a dict, with no snapshot. Nested dicts and lists
+are kept as they are.
+
+Records are read-mostly: fields can be assigned, but there is no change
+tracking, convert to a dict by `to_dict` to write them back.
+"""
+
+import re
+import keyword
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class Record(object):
+    """Base class of generated record classes, see `make_record_class`
+
+    Fields are got by `record[key]` (or `record.key` if the key
+    is a valid attribute name), a field missing in the source dict
+    raises KeyError (or AttributeError).
+    """
+    __slots__ = ()
+
+    # The struct generated from
+    _struct = None
+
+    # Keys of the fields, and names of the slots in the same order
+    _fields = ()
+    _slot_names = ()
+    _slot_by_key = {}
+
+    def __init__(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create from a dict, keys that are not fields are ignored"""
+        record = cls.__new__(cls)
+        for k, slot in zip(cls._fields, cls._slot_names):
+            if k in d:
+                setattr(record, slot, d[k])
+        return record
+
+    def to_dict(self):
+        d = {}
+        for k, slot in zip(self._fields, self._slot_names):
+            try:
+                d[k] = getattr(self, slot)
+            except AttributeError:
+                pass
+        return d
+
+    def __getitem__(self, k):
+        try:
+            return getattr(self, self._slot_by_key[k])
+        except AttributeError:
+            raise KeyError(k)
+
+    def __setitem__(self, k, v):
+        try:
+            slot = self._slot_by_key[k]
+        except KeyError:
+            raise KeyError('%s is not a field of %s' % (k, self.__class__.__name__))
+        setattr(self, slot, v)
+
+    def __delitem__(self, k):
+        try:
+            delattr(self, self._slot_by_key[k])
+        except AttributeError:
+            raise KeyError(k)
+
+    def __contains__(self, k):
+        slot = self._slot_by_key.get(k)
+        return slot is not None and hasattr(self, slot)
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [k for k, slot in zip(self._fields, self._slot_names) if hasattr(self, slot)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
+
+
+def make_record_class(name, struct):
+    """Generate a `Record` subclass with fields of the top level keys
+    of `struct` and `_id`"""
+    fields = list(struct)
+    if '_id' not in fields:
+        fields.insert(0, '_id')
+
+    slot_names = []
+    for i, k in enumerate(fields):
+        # Keys that could not be attribute names are only got by item access
+        if (isinstance(k, str) and _IDENTIFIER.match(k) and not keyword.iskeyword(k) and
+                not k.startswith('__') and not hasattr(Record, k)):
+            slot_names.append(k)
+        else:
+            slot_names.append('_field_%d' % i)
+
+    return type(name, (Record, ), {
+        '__slots__': tuple(slot_names),
+        '_struct': struct,
+        '_fields': tuple(fields),
+        '_slot_names': tuple(slot_names),
+        '_slot_by_key': dict(zip(fields, slot_names)),
+    })
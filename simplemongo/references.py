@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+References between documents, declared by `references` of `Document`
+subclasses as struct paths of `ObjectId` (or lists of `ObjectId`, also
+in dicts of lists) to the referenced class, or its name for classes
+defined later::
+
+    class Project(Document):
+        struct = {
+            'owner': ObjectId,
+            'members': [ObjectId],
+            'review': {'reviewer': ObjectId},
+        }
+        references = {
+            'owner': User,
+            'members': User,
+            'review.reviewer': 'Reviewer',
+        }
+
+`Document.ref(path)` returns the referenced documents, fetched one
+document at a time, unless they were resolved for a whole batch of
+a cursor by `SimplemongoCursor.prefetch('owner', 'members')`: the ids of
+all the documents of the batch are fetched together by chunked `$in`
+queries, one per referenced class (see `Document.get_many`). Documents
+in the current identity map are not fetched again.
+"""
+
+from bson.objectid import ObjectId
+from collections import OrderedDict
+from . import errors
+from .cursor import get_field
+from .dstruct import struct_paths
+
+
+# Ids in a `$in` query
+CHUNK_SIZE = 1000
+
+
+def check_references(references, struct):
+    """Raise `errors.StructError` if a path of `references` is not
+    a path of `ObjectId` in `struct`"""
+    if struct is None:
+        raise errors.StructError('`references` requires `struct`')
+    paths = struct_paths(struct)
+    for path, target in references.iteritems():
+        if path not in paths:
+            raise errors.StructError('reference %s is not in struct' % path)
+        if paths[path] is not ObjectId:
+            raise errors.StructError('reference %s should be ObjectId or [ObjectId] in struct, got %s' %
+                                     (path, paths[path]))
+        if not isinstance(target, (basestring, type)):
+            raise errors.StructError('reference %s should be to a class or its name, got %r' %
+                                     (path, target))
+
+
+def find_class(base, name):
+    """Return the subclass of `base` named `name`,
+    or `module.name` if the name is not unique"""
+    found = []
+    todo = [base]
+    seen = set()
+    while todo:
+        klass = todo.pop()
+        if klass in seen:
+            continue
+        seen.add(klass)
+        todo.extend(klass.__subclasses__())
+        if klass.__name__ == name or '%s.%s' % (klass.__module__, klass.__name__) == name:
+            found.append(klass)
+    if not found:
+        raise errors.StructError('no document class named %s' % name)
+    if len(found) > 1:
+        raise errors.StructError('%s document classes named %s, use module.name: %s' % (
+            len(found), name, ['%s.%s' % (k.__module__, k.__name__) for k in found]))
+    return found[0]
+
+
+def _ids(value):
+    # A value from `get_field`, lists are nested for lists in lists
+    if isinstance(value, list):
+        for i in value:
+            for _id in _ids(i):
+                yield _id
+    elif value is not None:
+        yield value
+
+
+def fetch_by_ids(cls, ids, chunk_size=CHUNK_SIZE):
+    """Return {_id: document} of `cls` of the `ids` found,
+    see `Document.get_many`"""
+    docs = cls.get_many(ids, chunk_size=chunk_size, preserve_order=False)
+    return dict((doc['_id'], doc) for doc in docs)
+
+
+def resolve(docs, paths, references, chunk_size=CHUNK_SIZE):
+    """Fetch the documents referenced by `paths` of `docs`, and attach
+    them to `docs`, see `Document.ref`.
+
+    :param references: {path: class} from `Document.get_references`
+    """
+    values = []
+    ids_by_class = OrderedDict()
+    for path in paths:
+        ids = ids_by_class.setdefault(references[path], OrderedDict())
+        path_values = []
+        for doc in docs:
+            value = get_field(doc, path)
+            path_values.append(value)
+            for _id in _ids(value):
+                ids[_id] = None
+        values.append(path_values)
+
+    found = {}
+    for klass, ids in ids_by_class.iteritems():
+        found[klass] = fetch_by_ids(klass, ids.keys(), chunk_size)
+
+    for path, path_values in zip(paths, values):
+        klass_found = found[references[path]]
+        for doc, value in zip(docs, path_values):
+            if isinstance(value, list):
+                # Not found ids are left out
+                resolved = [klass_found[i] for i in _ids(value) if i in klass_found]
+            else:
+                resolved = klass_found.get(value)
+            doc._set_ref(path, resolved)
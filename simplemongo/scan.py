@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parallel scan of a collection, see `Document.parallel_scan`.
+
+The collection is split into chunks by ranges of `_id`, each chunk is
+fetched by `Document.find` and passed to a callable in a thread or process
+pool. Split points are either ObjectId timestamps evenly spaced between the
+first and last `_id` (`split='time'`, for the default ObjectId `_id`), or
+`_id` values sampled from the data by `$sample` (`split='sample'`, for any
+`_id`, or data unevenly spread in time).
+
+A range of `_id` only matches values of one BSON type, documents whose `_id`
+is of another type than the split points are not scanned.
+"""
+
+import time
+import struct
+import logging
+import datetime
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from bson.objectid import ObjectId
+
+
+# Number of `_id` sampled for each chunk by `split='sample'`
+SAMPLES_PER_CHUNK = 20
+
+
+def _timestamp(_id):
+    return struct.unpack('>I', _id.binary[:4])[0]
+
+
+def time_split_points(first, last, chunks):
+    """Return ObjectIds of evenly spaced timestamps between the ones of
+    ObjectId `first` and `last`, which split them into `chunks` ranges,
+    or fewer if they are less than `chunks` seconds apart"""
+    lo = _timestamp(first)
+    hi = _timestamp(last)
+    points = []
+    for i in range(1, chunks):
+        ts = lo + (hi - lo) * i // chunks
+        if ts > lo and (not points or ts > points[-1]):
+            points.append(ts)
+    return [ObjectId.from_datetime(datetime.datetime.utcfromtimestamp(point)) for point in points]
+
+
+def sample_split_points(ids, chunks):
+    """Return values of the sampled `ids` which split them into
+    `chunks` ranges of about the same size, or fewer if there are
+    duplicates or not enough samples"""
+    ids = sorted(ids)
+    points = []
+    for i in range(1, chunks):
+        index = len(ids) * i // chunks
+        if index == 0:
+            continue
+        value = ids[index]
+        if not points or value > points[-1]:
+            points.append(value)
+    return points
+
+
+def chunk_ranges(points):
+    """Return [(lower, upper), ...] of the ranges between sorted `points`,
+    None is unbounded"""
+    bounds = [None] + list(points) + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def range_spec(spec, lower, upper):
+    """Return `spec` restricted to `lower` <= `_id` < `upper`"""
+    condition = {}
+    if lower is not None:
+        condition['$gte'] = lower
+    if upper is not None:
+        condition['$lt'] = upper
+    if not condition:
+        return spec
+    condition = {'_id': condition}
+    if spec:
+        return {'$and': [spec, condition]}
+    return condition
+
+
+def _scan_chunk(task):
+    """Run `func` on a chunk in a worker, return (index, ok, result or
+    exception, attempts). A module level function to be picklable
+    for the process pool."""
+    cls, func, index, spec, kwargs, retries, retry_on, retry_delay = task
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return index, True, func(cls.find(spec, **kwargs)), attempt
+        except retry_on as e:
+            if attempt > retries:
+                return index, False, e, attempt
+            logging.warning('chunk %s failed (attempt %s), retry: %r', index, attempt, e)
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+        except Exception as e:
+            return index, False, e, attempt
+
+
+class ScanResult(object):
+    """Result of `Document.parallel_scan`
+
+    `results` are the return values of the callable in order of
+    `ranges`, None for the chunks in `errors`, which are dicts of `index`
+    (position in `ranges`), `range`, `error` (the exception) and `attempts`.
+    """
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.results = [None] * len(ranges)
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return '<ScanResult: chunks=%s errors=%s>' % (len(self.ranges), len(self.errors))
+
+
+def run_scan(cls, func, spec, ranges, executor, workers, retries, retry_on,
+             retry_delay, progress, kwargs):
+    if executor == 'thread':
+        pool = ThreadPool(workers)
+    elif executor == 'process':
+        pool = multiprocessing.Pool(workers)
+    else:
+        raise ValueError("executor should be 'thread' or 'process', got %r" % executor)
+
+    result = ScanResult(ranges)
+    tasks = [
+        (cls, func, index, range_spec(spec, lower, upper), kwargs,
+         retries, retry_on, retry_delay)
+        for index, (lower, upper) in enumerate(ranges)
+    ]
+    try:
+        done = 0
+        for index, ok, value, attempts in pool.imap_unordered(_scan_chunk, tasks):
+            done += 1
+            if ok:
+                result.results[index] = value
+            else:
+                logging.error('chunk %s %s failed after %s attempts: %r',
+                              index, ranges[index], attempts, value)
+                result.errors.append({
+                    'index': index,
+                    'range': ranges[index],
+                    'error': value,
+                    'attempts': attempts,
+                })
+            if progress is not None:
+                progress(done, len(tasks))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return result
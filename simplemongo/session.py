@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit of work for documents: collect the changes of many documents
+and write them with one `bulk_write` per collection.
+
+Identity map: documents loaded by the same `_id` are the same instance.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+
+_local = threading.local()
+
+
+def _current(name):
+    stack = getattr(_local, name, None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def _push(name, obj):
+    stack = getattr(_local, name, None)
+    if stack is None:
+        stack = []
+        setattr(_local, name, stack)
+    stack.append(obj)
+
+
+def _pop(name, obj):
+    getattr(_local, name).remove(obj)
+
+
+def current_session():
+    """Return the innermost session entered by `with` in this thread, or None"""
+    return _current('sessions')
+
+
+def current_identity_map():
+    """Return the innermost identity map entered by `with` in this thread, or None"""
+    return _current('identity_maps')
+
+
+class IdentityMap(object):
+    """
+    Map of (document class, `_id`) to document instance, the least
+    recently used instance is evicted when `max_size` is exceeded.
+
+    When entered by `with` (directly or through a `Session`), documents
+    fetched by `Document.find` and `Document.one` are looked up here first,
+    a document already in the map is returned as it is, without being
+    updated by the fetched data. `save` and `pull` put documents in,
+    `remove` evicts them.
+
+    `hits` and `misses` count the lookups.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()
+
+    def __enter__(self):
+        _push('identity_maps', self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _pop('identity_maps', self)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def get(self, cls, _id):
+        key = (cls, _id)
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._docs[key] = doc
+        return doc
+
+    def put(self, doc):
+        key = (doc.__class__, doc['_id'])
+        self._docs.pop(key, None)
+        self._docs[key] = doc
+        if len(self._docs) > self.max_size:
+            self._docs.popitem(last=False)
+
+    def discard(self, cls, _id):
+        self._docs.pop((cls, _id), None)
+
+    def clear(self):
+        self._docs.clear()
+
+
+class Session(object):
+    """
+    Documents are registered by `add` (new or fetched documents)
+    and `delete`, documents fetched from database inside a `with session:`
+    block are registered automatically. Nothing is written until `flush`,
+    which is also called when the `with` block exits without exception.
+
+    On flush, for every registered document:
+        * a document scheduled by `delete` is removed
+        * a document not in database is validated (if `__validate__`) and inserted
+        * a document in database is updated by its `changes`, if any
+
+    Usage::
+
+        with Session() as session:
+            for user in User.find({'group': group_id}):
+                user['score'] += 1
+            session.add(User.new(name='reorx'))
+    """
+    def __init__(self, ordered=True, identity_map=None):
+        """
+        :param identity_map: an `IdentityMap` to enter along with the session,
+                             or True to create one
+        """
+        self.ordered = ordered
+        if identity_map is True:
+            identity_map = IdentityMap()
+        self.identity_map = identity_map
+        self._docs = {}
+        self._order = []
+        self._deleted = set()
+
+    def __enter__(self):
+        _push('sessions', self)
+        if self.identity_map is not None:
+            self.identity_map.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _pop('sessions', self)
+        if self.identity_map is not None:
+            self.identity_map.__exit__(exc_type, exc_value, tb)
+        if exc_type is None:
+            self.flush()
+
+    def __contains__(self, doc):
+        return id(doc) in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc):
+        if id(doc) not in self._docs:
+            self._docs[id(doc)] = doc
+            self._order.append(doc)
+
+    def delete(self, doc):
+        assert doc._in_db, 'Could not remove document which is not in database'
+        self.add(doc)
+        self._deleted.add(id(doc))
+
+    def discard(self, doc):
+        """Unregister `doc`, its changes will not be flushed"""
+        if self._docs.pop(id(doc), None) is not None:
+            self._order.remove(doc)
+            self._deleted.discard(id(doc))
+
+    def _collect(self):
+        """Return [(collection, [(doc, action, request), ...]), ...]"""
+        groups = {}
+        keys = []
+        for doc in self._order:
+            cls = doc.__class__
+            if id(doc) in self._deleted:
+                action = 'delete'
+                request = DeleteOne(doc.identifier)
+            elif not doc._in_db:
+                if cls.__validate__:
+                    doc.validate()
+                if '_id' not in doc:
+                    doc['_id'] = ObjectId()
+                action = 'insert'
+                request = InsertOne(doc)
+            else:
+                changes = doc.changes
+                if not changes:
+                    continue
+                action = 'update'
+                request = UpdateOne(doc.identifier, changes)
+
+            # Documents of a collection with different write concerns
+            # could not be written together
+            key = (cls.col.full_name, tuple(sorted(cls.__write_concern__.items())))
+            if key not in groups:
+                groups[key] = (cls.get_write_collection(), [])
+                keys.append(key)
+            groups[key][1].append((doc, action, request))
+        return [groups[k] for k in keys]
+
+    def _done(self, doc, action):
+        doc.__class__.invalidate_cache(doc['_id'])
+        if action == 'delete':
+            if self.identity_map is not None:
+                self.identity_map.discard(doc.__class__, doc['_id'])
+            doc._removed()
+            self.discard(doc)
+        else:
+            doc._reset_changes()
+            doc._in_db = True
+            if self.identity_map is not None:
+                self.identity_map.put(doc)
+
+    def flush(self):
+        """Write all the changes, return the list of `BulkWriteResult`
+
+        If a `BulkWriteError` is raised, the documents written
+        before it are still marked as written.
+        """
+        results = []
+        for col, ops in self._collect():
+            try:
+                rv = col.bulk_write([i[2] for i in ops], ordered=self.ordered)
+            except BulkWriteError as e:
+                failed = set(i['index'] for i in e.details['writeErrors'])
+                if self.ordered:
+                    done = ops[:min(failed)]
+                else:
+                    done = [op for i, op in enumerate(ops) if i not in failed]
+                for doc, action, _ in done:
+                    self._done(doc, action)
+                raise
+            logging.debug('flushed %s operations to %s', len(ops), col.full_name)
+            for doc, action, _ in ops:
+                self._done(doc, action)
+            results.append(rv)
+        return results
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from simplemongo.cache import LRUCache, cache_key, register, invalidate
+from simplemongo.models import ObjectId
+
+
+class TestLRUCache(object):
+    def test_get_set(self):
+        c = LRUCache()
+        assert c.get('a') is None
+        c.set('a', 'A')
+        assert c.get('a') == 'A'
+        c.delete('a')
+        assert c.get('a') is None
+        assert (c.hits, c.misses) == (1, 2)
+
+    def test_eviction(self):
+        c = LRUCache(max_size=2)
+        c.set('a', 'A')
+        c.set('b', 'B')
+        c.get('a')
+        c.set('c', 'C')
+        assert len(c) == 2
+        assert c.get('b') is None
+        assert c.get('a') == 'A'
+        assert c.get('c') == 'C'
+
+    def test_ttl(self):
+        c = LRUCache()
+        c.set('a', 'A', ttl=0.01)
+        c.set('b', 'B', ttl=None)
+        assert c.get('a') == 'A'
+        time.sleep(0.02)
+        assert c.get('a') is None
+        assert c.get('b') == 'B'
+
+
+class FakeCollection(object):
+    full_name = 'db.col'
+
+
+def test_cache_key():
+    oid = ObjectId()
+    col = FakeCollection()
+    assert cache_key(col, oid) != cache_key(col, str(oid))
+    assert cache_key(col, oid) == cache_key(col, ObjectId(str(oid)))
+
+
+def test_invalidate():
+    col = FakeCollection()
+    a, b, other = LRUCache(), LRUCache(), LRUCache()
+    register(col, a)
+    register(col, b)
+    register(col, a)
+    for c in (a, b, other):
+        c.set(cache_key(col, 1), 'A')
+    invalidate(col, 1)
+    assert a.get(cache_key(col, 1)) is None
+    assert b.get(cache_key(col, 1)) is None
+    # Not registered for the collection
+    assert other.get(cache_key(col, 1)) == 'A'
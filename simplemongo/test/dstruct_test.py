@@ -8,8 +8,8 @@ import copy
 
 from simplemongo.dstruct import (
     check_struct, build_dict, validate_dict,
-    retrieve_dict, map_dict, hash_dict,
-    StructuredDict, ObjectId,
+    retrieve_dict, map_dict, hash_dict, diff_update, struct_projection, struct_paths,
+    StructuredDict, CompiledStruct, ObjectId,
 )
 from simplemongo.errors import StructError
 
@@ -170,6 +170,29 @@ class TestFunctions(object):
         d = self.d(foo='bar')
         validate_dict(d, self.s())
 
+    def test_compiled_struct(self):
+        compiled = CompiledStruct(
+            self.s(), required_fields=['nature.luck'], strict_fields=['disks.volums.size'])
+        compiled.validate(self.d())
+
+        d = self.d()
+        del d['nature']['luck']
+        with assert_raises(KeyError):
+            compiled.validate(d)
+
+        # strict fields apply to every item of lists, whatever the index is
+        d = self.d()
+        volums = d['disks'][0]['volums']
+        for i in range(11):
+            volums.append(copy.deepcopy(volums[0]))
+        compiled.validate(d)
+        volums[11]['size'] = None
+        with assert_raises(TypeError):
+            compiled.validate(d)
+
+        with assert_raises(StructError):
+            CompiledStruct(self.s(name='hello'))
+
     # require validate_dict
     def test_build_dict(self):
         d1 = build_dict(self.s(), ('nature.luck', 1))
@@ -211,6 +234,60 @@ class TestFunctions(object):
         validate_dict(d3, self.s())
         assert hash_dict(d3) == hash_before
 
+    def test_struct_projection(self):
+        assert struct_projection(self.s()) == {
+            'id': 1, 'name': 1, 'nature.luck': 1, 'people': 1, 'disks': 1, 'extra': 1}
+
+    def test_struct_paths(self):
+        assert struct_paths(self.s()) == {
+            'id': ObjectId, 'name': str, 'nature': dict, 'nature.luck': int, 'people': str,
+            'disks': dict, 'disks.is_primary': bool, 'disks.last_modified': datetime.datetime,
+            'disks.volums': dict, 'disks.volums.name': str, 'disks.volums.size': int,
+            'disks.volums.block': int, 'extra': float}
+        assert struct_paths({'tags': []}) == {'tags': list}
+
+    def test_diff_update(self):
+        d = self.d()
+        assert diff_update(d, self.d()) == {}
+
+        d['name'] = 'reorx reborn'
+        d['nature']['luck'] = 3
+        d['people'].append('rei')
+        d['disks'][0]['volums'][0]['size'] = 1
+        d['foo'] = {'bar': 1}
+        del d['extra']
+
+        assert diff_update(d, self.d()) == {
+            '$set': {
+                'name': 'reorx reborn',
+                'disks': d['disks'],
+                'foo': {'bar': 1},
+            },
+            '$inc': {'nature.luck': 2},
+            '$push': {'people': {'$each': ['rei']}},
+            '$unset': {'extra': ''},
+        }
+
+    def test_diff_update_list(self):
+        origin = {'l': [1, 2, 1, 3]}
+
+        assert diff_update({'l': [1, 1, 3]}, origin) == {'$pull': {'l': {'$in': [2]}}}
+        assert diff_update({'l': [2, 3]}, origin) == {'$pull': {'l': {'$in': [1]}}}
+        assert diff_update({'l': [3]}, origin) == {'$pull': {'l': {'$in': [1, 2]}}}
+
+        # not every occurrence removed, or order changed
+        assert diff_update({'l': [2, 1, 3]}, origin) == {'$set': {'l': [2, 1, 3]}}
+        assert diff_update({'l': [3, 1]}, origin) == {'$set': {'l': [3, 1]}}
+        # not appended at the end
+        assert diff_update({'l': [0, 1, 2, 1, 3]}, origin) == {'$set': {'l': [0, 1, 2, 1, 3]}}
+
+        # subdocuments are never pulled
+        origin = {'l': [{'a': 1}, {'a': 2}]}
+        assert diff_update({'l': [{'a': 2}]}, origin) == {'$set': {'l': [{'a': 2}]}}
+        assert diff_update({'l': [{'a': 1}, {'a': 2}, {}]}, origin) == {'$push': {'l': {'$each': [{}]}}}
+        origin = {'l': [1, {'a': 1}]}
+        assert diff_update({'l': [1]}, origin) == {'$set': {'l': [1]}}
+
 
 class TestStructedDict(object):
     def setUp(self):
@@ -296,6 +373,21 @@ class TestStructedDict(object):
             ud.validate()
         ud['skills'][1]['parents'][0]['distance'] = 1
 
+    def test_compiled_struct(self):
+        compiled = self.UserDict.get_compiled_struct()
+        assert compiled is self.UserDict._compiled_struct
+        assert compiled is self.UserDict.get_compiled_struct()
+
+        ud = self.sample()
+        del ud['bio']
+        ud.validate()
+
+        # reassigning a field list takes effect on the next validation
+        self.UserDict.required_fields = self.UserDict.required_fields + ['bio']
+        with assert_raises(KeyError):
+            ud.validate()
+        assert self.UserDict.get_compiled_struct() is not compiled
+
     def test_validate_nr_ns(self):
         ud = self.sample()
 
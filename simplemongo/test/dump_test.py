@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import datetime
+import tempfile
+from nose.tools import assert_raises
+from bson import BSON
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from simplemongo.dump import guess_format, open_file, encode_documents, iter_documents, Writer, ExportResult
+from simplemongo.models import ObjectId
+
+
+def test_guess_format():
+    assert guess_format('a.bson') == ('bson', None)
+    assert guess_format('a.ndjson.gz') == ('ndjson', 'gzip')
+    assert guess_format('a.json.bz2') == ('ndjson', 'bz2')
+    assert guess_format('a.dump', format='bson', compress='gzip') == ('bson', 'gzip')
+    with assert_raises(ValueError):
+        guess_format('a.dump')
+    with assert_raises(ValueError):
+        guess_format('a.bson', compress='zip')
+    with assert_raises(ValueError):
+        guess_format('a.bson', format='csv')
+
+
+def test_round_trip():
+    docs = [
+        {'_id': ObjectId(), 'name': u'名字', 'created': datetime.datetime(2016, 1, 1, 12, 30),
+         'tags': ['a', 'b'], 'nested': {'n': 1.5, 'none': None}},
+        {'_id': ObjectId(), 'name': u'reorx'},
+    ]
+    tmp = tempfile.mkdtemp()
+    try:
+        for fmt in ['bson', 'ndjson']:
+            for compress in [None, 'gzip', 'bz2']:
+                path = os.path.join(tmp, 'dump')
+                if fmt == 'bson':
+                    items = [RawBSONDocument(BSON.encode(d)) for d in docs]
+                else:
+                    items = docs
+                result = ExportResult(path, fmt)
+                with open_file(path, 'w', compress) as f:
+                    assert Writer(f, fmt, result).write_all(items, batch_size=1) == 2
+                assert result.count == 2
+                assert result.size == len(encode_documents(items, fmt))
+
+                with open_file(path, 'r', compress) as f:
+                    loaded = list(iter_documents(f, fmt, DEFAULT_CODEC_OPTIONS))
+                assert loaded == docs, (fmt, compress, loaded)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_ndjson_extended_json():
+    _id = ObjectId()
+    line = encode_documents([{'_id': _id, 'at': datetime.datetime(2016, 1, 1)}], 'ndjson')
+    assert line == '{"_id":{"$oid":"%s"},"at":{"$date":1451606400000}}\n' % _id
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+from nose.tools import assert_raises
+from pymongo import ASCENDING, DESCENDING
+from simplemongo.indexes import normalize_index, check_indexes, diff_indexes
+from simplemongo.errors import StructError
+
+
+struct = {
+    'name': str,
+    'email': str,
+    'score': int,
+    'created_at': datetime.datetime,
+    'tags': [str],
+    'skills': [{'name': str}],
+    'magic': {'camp': str},
+}
+
+
+def test_normalize_index():
+    assert normalize_index('name') == ([('name', ASCENDING)], {'name': 'name_1'})
+    assert normalize_index([('name', ASCENDING), ('score', DESCENDING)]) == (
+        [('name', ASCENDING), ('score', DESCENDING)], {'name': 'name_1_score_-1'})
+    assert normalize_index({'keys': ['name', ('tags', 'hashed')], 'unique': True, 'name': 'n'}) == (
+        [('name', ASCENDING), ('tags', 'hashed')], {'unique': True, 'name': 'n'})
+
+    for item in [{'unique': True}, [], 1, [('name', 2)], [('name', 1, 2)],
+                 {'keys': 'name', 'uniq': True}]:
+        with assert_raises(StructError):
+            normalize_index(item)
+
+
+def test_check_indexes():
+    declared = check_indexes([
+        'name',
+        ['magic.camp', 'skills.name', 'tags'],
+        {'keys': 'email', 'unique': True, 'sparse': True},
+        {'keys': 'created_at', 'expireAfterSeconds': 60},
+        {'keys': '_id', 'name': 'id_partial',
+         'partialFilterExpression': {'$or': [{'score': {'$gt': 0}}, {'magic.camp': 'a'}]}},
+    ], struct)
+    assert [options['name'] for keys, options in declared] == [
+        'name_1', 'magic.camp_1_skills.name_1_tags_1', 'email_1', 'created_at_1', 'id_partial']
+
+    for indexes in [
+            ['age'],
+            ['magic.spell'],
+            ['name', [('name', 1)]],
+            [{'keys': 'score', 'expireAfterSeconds': 60}],
+            [{'keys': ['created_at', 'name'], 'expireAfterSeconds': 60}],
+            [{'keys': 'name', 'partialFilterExpression': {'age': {'$gt': 0}}}]]:
+        with assert_raises(StructError):
+            check_indexes(indexes, struct)
+
+    check_indexes(['_v'], struct, extra_paths=['_id', '_v'])
+
+
+def test_diff_indexes():
+    declared = check_indexes([
+        'name',
+        {'keys': 'email', 'unique': True},
+        {'keys': [('score', DESCENDING)], 'sparse': True},
+    ], struct)
+    information = {
+        '_id_': {'key': [('_id', 1)]},
+        'email_1': {'key': [('email', 1.0)], 'unique': False},
+        'custom': {'key': [('score', -1)], 'sparse': True},
+        'tags_1': {'key': [('tags', 1)]},
+    }
+    missing, conflicts, undeclared = diff_indexes(declared, information)
+    assert missing == [declared[0]]
+    assert [c[0] for c in conflicts] == ['email_1']
+    assert undeclared == ['tags_1']
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import datetime
+from nose.tools import assert_raises
+from bson import BSON, Binary, Code, Regex, Int64, Timestamp, MinKey, MaxKey
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.errors import InvalidBSON
+from simplemongo.lazy import index_elements, decode_element
+from simplemongo.models import ObjectId
+
+
+def test_index_elements():
+    doc = {
+        '_id': ObjectId(),
+        'float': 1.5,
+        'str': u'中文',
+        'dict': {'a': {'b': [1, 2]}},
+        'list': [1, 'a', {'b': None}],
+        'binary': Binary('\x00\x01', 5),
+        'bool': True,
+        'datetime': datetime.datetime(2016, 1, 1),
+        'none': None,
+        'regex': Regex('^a.*', re.I),
+        'code': Code('f()'),
+        'code_scope': Code('f(x)', {'x': 1}),
+        'int': 1,
+        'int64': Int64(1 << 40),
+        'timestamp': Timestamp(1, 2),
+        'min': MinKey(),
+        'max': MaxKey(),
+    }
+    data = BSON.encode(doc)
+    index = index_elements(data)
+    assert set(index) == set(doc)
+    decoded = BSON(data).decode()
+    for k, (start, end) in index.iteritems():
+        assert decode_element(data, start, DEFAULT_CODEC_OPTIONS) == (k, decoded[k])
+
+
+def test_index_elements_invalid():
+    data = BSON.encode({'a': 1})
+    with assert_raises(InvalidBSON):
+        index_elements(data[:4] + '\xEE' + data[5:])
+    with assert_raises(InvalidBSON):
+        index_elements(data[:-1] + '\x00\x00')
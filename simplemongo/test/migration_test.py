@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from bson.int64 import Int64
+from simplemongo.dstruct import build_dict
+from simplemongo.migration import compute_fix, FileCheckpoint, CONVERTERS
+from simplemongo.models import ObjectId
+
+
+struct = {
+    'name': str,
+    'age': int,
+    'score': float,
+    'owner': ObjectId,
+    'tags': [str],
+    'skills': [
+        {
+            'name': str,
+            'power': float,
+        }
+    ],
+    'magic': {
+        'spell': float,
+        'camp': str,
+    },
+}
+
+
+def test_compute_fix_nothing():
+    doc = {'_id': 1, 'name': 'a', 'age': 1, 'score': None, 'owner': ObjectId(), 'tags': [],
+           'skills': [], 'magic': {'spell': 1.0, 'camp': u'c'}, 'extra': 1}
+    assert compute_fix(doc, struct) == ({}, {}, [])
+
+
+def test_compute_fix_missing():
+    template = build_dict(struct, **{'magic.spell': 10.1, 'age': 0})
+    doc = {'_id': 1, 'name': 'a', 'tags': None, 'score': 1.0, 'owner': None,
+           'skills': [{'name': 'x'}, {'name': 'y', 'power': 1.0}], 'magic': {'camp': 'c'}}
+    update, conditions, errors = compute_fix(doc, struct, template)
+    assert update == {'$set': {'age': 0, 'skills.0.power': None, 'magic.spell': 10.1}}
+    assert conditions == dict((k, {'$exists': False}) for k in update['$set'])
+    assert not errors
+
+    update, conditions, errors = compute_fix({'_id': 1}, struct, template)
+    assert update['$set']['magic'] == {'spell': 10.1, 'camp': None}
+    assert update['$set']['skills'] is None
+    # Not shared with the template
+    assert update['$set']['magic'] is not template['magic']
+
+
+def test_compute_fix_convert():
+    owner = ObjectId()
+    doc = {'_id': 1, 'name': 12, 'age': Int64(3), 'score': 2, 'owner': str(owner),
+           'tags': ['a', 5], 'skills': [{'name': 'x', 'power': 3}],
+           'magic': {'spell': 'much', 'camp': 'c'}}
+    update, conditions, errors = compute_fix(doc, struct, build_dict(struct))
+    assert update == {'$set': {
+        'name': '12', 'age': 3, 'score': 2.0, 'owner': owner,
+        'tags.1': '5', 'skills.0.power': 3.0,
+    }}
+    assert conditions['owner'] == str(owner) and conditions['tags.1'] == 5
+    assert type(update['$set']['age']) is int
+    assert len(errors) == 1 and "'magic.spell'" in errors[0]
+
+    # By struct path, list indexes are not part of it
+    converters = dict(CONVERTERS)
+    converters['skills.power'] = lambda v: v * 10.0
+    converters['magic.spell'] = lambda v: len(v) * 1.0
+    update, _, errors = compute_fix(doc, struct, build_dict(struct), converters=converters)
+    assert update['$set']['skills.0.power'] == 30.0
+    assert update['$set']['magic.spell'] == 4.0
+    assert not errors
+
+    # Not converted if it fails
+    update, _, errors = compute_fix({'age': 1.5}, {'age': int}, {})
+    assert update == {} and len(errors) == 1
+
+
+def test_compute_fix_container():
+    # A scalar where struct has a dict or a list is left as an error
+    doc = {'magic': 'x', 'skills': 'y', 'tags': 1, 'age': 1}
+    update, conditions, errors = compute_fix(doc, struct, build_dict(struct))
+    assert sorted(update['$set']) == ['name', 'owner', 'score']
+    assert sorted(e.split("'")[1] for e in errors) == ['magic', 'skills', 'tags']
+
+    # Converted by the container type or by path
+    converters = dict(CONVERTERS)
+    converters[(str, dict)] = lambda v: {'camp': v}
+    converters['skills'] = lambda v: [{'name': v}]
+    update, _, errors = compute_fix(doc, {'magic': struct['magic'], 'skills': struct['skills']},
+                                    converters=converters)
+    assert update == {'$set': {'magic': {'camp': 'x'}, 'skills': [{'name': 'y'}]}}
+    assert not errors
+
+
+def test_compute_fix_remove_unknown():
+    doc = {'_id': 1, 'name': 'a', 'old': 1, 'skills': [{'name': 'x', 'power': 1.0, 'level': 2}],
+           'magic': {'spell': 1.0, 'camp': 'c', 'color': 'red'}}
+    st = {'name': str, 'skills': struct['skills'], 'magic': struct['magic']}
+    update, conditions, errors = compute_fix(doc, st, remove_unknown=True)
+    assert update == {'$unset': {'old': '', 'skills.0.level': '', 'magic.color': ''}}
+    assert conditions == {}
+
+
+def test_file_checkpoint():
+    tmp = tempfile.mkdtemp()
+    try:
+        checkpoint = FileCheckpoint(os.path.join(tmp, 'checkpoint'))
+        assert checkpoint.load() is None
+        _id = ObjectId()
+        checkpoint.save(_id)
+        assert checkpoint.load() == _id
+        checkpoint.save(u'名字')
+        assert checkpoint.load() == u'名字'
+        checkpoint.clear()
+        assert checkpoint.load() is None
+    finally:
+        shutil.rmtree(tmp)
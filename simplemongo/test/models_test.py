@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import shutil
+import datetime
+import tempfile
 import unittest
 from nose.tools import assert_raises
+from bson.raw_bson import RawBSONDocument
 from pymongo import MongoClient
 from simplemongo.models import Document, ObjectId
-from simplemongo.errors import ObjectNotFound, MultipleObjectsReturned, StructError
+from simplemongo.session import Session, IdentityMap
+from simplemongo.cache import LRUCache
+from simplemongo.migration import FileCheckpoint
+from simplemongo.plan import PlanGuard
+from simplemongo.cursor import get_field
+from simplemongo import upgrade, tracing
+from simplemongo.errors import (
+    ObjectNotFound, MultipleObjectsReturned, StructError, InvalidToken, QueryPlanError)
 
 
 _FAKE_DATA = {
@@ -135,6 +148,149 @@ class ModelTest(unittest.TestCase):
         rv = u.save()
         assert isinstance(rv, ObjectId) and rv == u['_id']
 
+    def test_insert(self):
+        def docs(n, invalid=()):
+            for i in range(n):
+                d = self.get_fake()
+                d['age'] = i
+                if i in invalid:
+                    d['age'] = 'wrong'
+                yield d
+
+        rv = self.User.insert(docs(10), batch_size=3)
+        assert rv.inserted_count == 10 and not rv.errors
+        assert len(rv.inserted_ids) == 10
+        assert self.User.col.find().count() == 10
+
+        rv = self.User.insert(docs(10, invalid=[4, 7]), batch_size=3, ordered=False)
+        assert rv.inserted_count == 8
+        assert [e['index'] for e in rv.errors] == [4, 7]
+        assert self.User.col.find().count() == 18
+
+        rv = self.User.insert(docs(10, invalid=[4, 7]), batch_size=3)
+        assert rv.inserted_count == 4
+        assert [e['index'] for e in rv.errors] == [4]
+
+        # duplicated _id
+        u = self.User(self.get_fake())
+        u.save()
+        rv = self.User.insert([self.get_fake(), dict(u), self.get_fake()], ordered=False)
+        assert rv.inserted_count == 2
+        assert rv.errors[0]['index'] == 1 and rv.errors[0]['code'] == 11000
+
+        u = self.User(self.get_fake())
+        self.User.insert([u])
+        assert u.changes == {}
+
+    def test_session(self):
+        users = [self.User(self.get_fake()) for i in range(3)]
+        for u in users:
+            u.save()
+
+        with Session() as session:
+            fetched = list(self.User.find({'name': 'reorx'}))
+            assert len(session) == 3
+            fetched[0]['age'] = 30
+            fetched[1]['magic']['camp'] = 'Order'
+            deleted_id = fetched[2]['_id']
+            session.delete(fetched[2])
+            new = self.User(self.get_fake())
+            session.add(new)
+            # nothing is written until flush
+            assert self.User.col.find().count() == 3
+
+        assert self.User.col.find_one(fetched[0].identifier)['age'] == 30
+        assert self.User.col.find_one(fetched[1].identifier)['magic']['camp'] == 'Order'
+        assert self.User.col.find_one({'_id': deleted_id}) is None
+        assert self.User.col.find_one(new.identifier)
+        assert new._in_db and new.changes == {}
+        assert fetched[0].changes == {}
+
+        # no session after exit
+        u = self.User.one(users[0].identifier)
+        assert u not in session
+
+    def test_identity_map(self):
+        users = [self.User(self.get_fake()) for i in range(3)]
+        for u in users:
+            u.save()
+
+        with IdentityMap(max_size=2) as imap:
+            u0 = self.User.one(users[0]['_id'])
+            assert u0 is not users[0]
+            assert self.User.one(users[0]['_id']) is u0
+            assert self.User.find({'_id': users[0]['_id']}).next() is u0
+            assert (imap.hits, imap.misses) == (2, 1)
+
+            # evicted as least recently used
+            u1 = self.User.one(users[1]['_id'])
+            self.User.one(users[2]['_id'])
+            assert len(imap) == 2
+            assert self.User.one(users[0]['_id']) is not u0
+            assert self.User.one(users[1]['_id']) is not u1
+
+            u1.remove()
+            assert self.User.one(users[1]['_id']) is None
+
+            new = self.User(self.get_fake())
+            new.save()
+            assert self.User.one(new['_id']) is new
+
+        assert self.User.one(new['_id']) is not new
+
+        with Session(identity_map=True) as session:
+            u = self.User.one(users[0]['_id'])
+            assert self.User.one(users[0]['_id']) is u
+            assert session.identity_map.hits == 1
+
+        # partial documents are not in the identity map
+        with IdentityMap() as imap:
+            partial = self.User.one(users[0]['_id'], projection=['name'])
+            assert 'age' not in partial
+            assert len(imap) == 0
+            u = self.User.one(users[0]['_id'])
+            assert u is not partial and 'age' in u
+            assert self.User.one(users[0]['_id'], projection=['name']) is not u
+            assert self.User.find({'_id': users[0]['_id']}, projection=['name']).next() is not u
+            assert self.User.get_many([users[0]['_id']], projection=['name'])[0] is not u
+            assert self.User.get_many([users[0]['_id']])[0] is u
+
+    def test_cache(self):
+        class CachedUser(self.User):
+            col = db['user']
+            __cache__ = LRUCache()
+
+        u = CachedUser(self.get_fake())
+        u.save()
+
+        c1 = CachedUser.one(u['_id'])
+        # changed by others, but cached
+        self.User.col.update(u.identifier, {'$set': {'age': 1}})
+        c2 = CachedUser.one(u['_id'])
+        assert c2['age'] == c1['age'] == 20
+        assert CachedUser.__cache__.hits == 1
+
+        # cached values could not be modified by callers
+        c2['magic']['camp'] = 'Order'
+        assert CachedUser.one(u['_id'])['magic']['camp'] == 'Chaos'
+
+        c2.update_changes()
+        c3 = CachedUser.one(u['_id'])
+        assert c3['magic']['camp'] == 'Order'
+        assert c3['age'] == 1
+
+        c3.remove()
+        assert CachedUser.one(u['_id']) is None
+
+        # Invalidated when written by another class of the collection
+        u = CachedUser(self.get_fake())
+        u.save()
+        assert CachedUser.one(u['_id'])['age'] == 20
+        other = self.User.one(u['_id'])
+        other['age'] = 30
+        other.update_changes()
+        assert CachedUser.one(u['_id'])['age'] == 30
+
     def test_remove(self):
         pass
 
@@ -164,6 +320,563 @@ class ModelTest(unittest.TestCase):
             assert isinstance(u, Document)
             assert u['name'] in user_names
 
+    def test_raw_and_values_list(self):
+        d = self.get_fake()
+        self.User.col.insert(d)
+
+        raw = self.User.find({'_id': d['_id']}).raw().next()
+        assert type(raw) is dict and raw == d
+
+        raw = self.User.find({'_id': d['_id']}).raw('name').next()
+        assert raw == {'_id': d['_id'], 'name': 'reorx'}
+
+        rv = self.User.find({'_id': d['_id']}).values_list('name', 'magic.camp', 'skills.name', 'foo')
+        assert list(rv) == [('reorx', 'Chaos', ['Break'], None)]
+
+        # Slices, indexes and clones return results the same way
+        rv = list(self.User.find({'_id': d['_id']})[0:1].bson())
+        assert isinstance(rv[0], RawBSONDocument) and rv[0]['name'] == 'reorx'
+        rv = self.User.find({'_id': d['_id']}).bson()[0]
+        assert isinstance(rv, RawBSONDocument) and rv['name'] == 'reorx'
+        assert self.User.find({'_id': d['_id']}).values_list('name')[0] == ('reorx', )
+        assert isinstance(self.User.find({'_id': d['_id']}).clone().next(), self.User)
+        assert isinstance(self.User.find({'_id': d['_id']}).explain(), dict)
+
+    def test_records(self):
+        d = self.get_fake()
+        d['foo'] = 'bar'
+        self.User.col.insert(d)
+
+        RecordClass = self.User.get_record_class()
+        assert self.User.get_record_class() is RecordClass
+        r = self.User.find({'_id': d['_id']}).records().next()
+        assert isinstance(r, RecordClass)
+        assert r.name == 'reorx' and r['magic']['camp'] == 'Chaos'
+        del d['foo']
+        assert r.to_dict() == d
+
+    def test_auto_projection(self):
+        class ProjectedUser(self.User):
+            col = db['user']
+            __auto_projection__ = True
+
+        d = self.get_fake()
+        d['legacy'] = {'a': 1}
+        d['magic'] = dict(d['magic'], legacy=1)
+        self.User.col.insert(d)
+
+        assert ProjectedUser.get_projection() == {
+            'id': 1, 'name': 1, 'age': 1, 'is_choosen': 1, 'skills': 1,
+            'magic.spell': 1, 'magic.camp': 1,
+        }
+
+        u = ProjectedUser.one(d['_id'])
+        assert 'legacy' not in u and 'legacy' not in u['magic']
+        with assert_raises(AssertionError):
+            u.save()
+        u['age'] = 21
+        u['magic']['camp'] = 'Order'
+        assert u.changes == {'$inc': {'age': 1}, '$set': {'magic.camp': 'Order'}}
+        u.update_changes()
+        u.pull()
+        assert 'legacy' not in u and u['age'] == 21
+
+        raw = self.User.col.find_one(d['_id'])
+        assert raw['legacy'] == {'a': 1} and raw['magic']['legacy'] == 1
+
+        u = ProjectedUser.find({'_id': d['_id']}).next()
+        assert 'legacy' not in u
+        u = ProjectedUser.find({'_id': d['_id']}, auto_projection=False).next()
+        assert u['legacy'] == {'a': 1}
+        u.save()
+
+        # explicit projection makes partial documents too
+        u = self.User.one(d['_id'], projection=['name'])
+        assert sorted(u.keys()) == ['_id', 'name']
+        with assert_raises(AssertionError):
+            u.save()
+
+    def test_paginate(self):
+        for i in range(25):
+            self.User.col.insert({'name': 'user %s' % (i % 3), 'age': i % 4})
+
+        sort = [('age', -1), ('name', 1)]
+        expected = [(d['age'], d['name'], d['_id']) for d in self.User.find().sort(sort + [('_id', 1)])]
+        got = []
+        token = None
+        while True:
+            page = self.User.paginate({'age': {'$gt': 0}}, sort=sort, after=token, limit=4)
+            got.extend((d['age'], d['name'], d['_id']) for d in page)
+            assert all(isinstance(d, self.User) for d in page)
+            if not page.has_next:
+                break
+            token = page.next_token
+        assert got == [i for i in expected if i[0] > 0]
+
+        with assert_raises(InvalidToken):
+            self.User.paginate(sort=['name'], after=token)
+
+    def test_prefetch(self):
+        for i in range(10):
+            self.User.col.insert({'name': 'user %s' % i, 'age': i})
+
+        expected = [d['_id'] for d in self.User.find().sort('age')]
+        cursor = self.User.find().sort('age').batch_size(3).prefetch(depth=1)
+        docs = list(cursor)
+        assert [d['_id'] for d in docs] == expected
+        assert all(isinstance(d, self.User) for d in docs)
+        with assert_raises(StopIteration):
+            cursor.next()
+
+        # stopped by close
+        cursor = self.User.find().batch_size(3).prefetch()
+        for doc in cursor:
+            break
+        thread = cursor._SimplemongoCursor__prefetch_thread
+        cursor.close()
+        assert not thread.is_alive()
+
+        # stopped when the cursor is collected
+        cursor = self.User.find().batch_size(3).prefetch()
+        cursor.next()
+        thread = cursor._SimplemongoCursor__prefetch_thread
+        del cursor
+        thread.join(1)
+        assert not thread.is_alive()
+
+    def test_parallel_scan(self):
+        start = datetime.datetime(2016, 1, 1)
+        for i in range(20):
+            _id = ObjectId.from_datetime(start + datetime.timedelta(hours=i))
+            self.User.col.insert({'_id': _id, 'name': 'user %s' % i, 'age': i})
+
+        def func(cursor):
+            docs = list(cursor)
+            assert all(isinstance(d, self.User) for d in docs)
+            return [d['age'] for d in docs]
+
+        progress = []
+        result = self.User.parallel_scan(
+            func, {'age': {'$gte': 5}}, chunks=4, workers=2,
+            progress=lambda done, total: progress.append((done, total)))
+        assert result.ok
+        assert len(result.ranges) == 4
+        assert None not in result.results
+        assert sorted(sum(result.results, [])) == range(5, 20)
+        assert progress == [(1, 4), (2, 4), (3, 4), (4, 4)]
+
+        # Explicit split points, failed chunks are collected
+        middle = ObjectId.from_datetime(start + datetime.timedelta(hours=10))
+
+        def fail_first(cursor):
+            docs = list(cursor)
+            if docs[0]['age'] == 0:
+                raise ValueError('bad chunk')
+            return len(docs)
+
+        result = self.User.parallel_scan(fail_first, split=[middle], retry_delay=0)
+        assert not result.ok
+        assert result.results == [None, 10]
+        assert result.errors[0]['index'] == 0
+        assert result.errors[0]['range'] == (None, middle)
+        assert isinstance(result.errors[0]['error'], ValueError)
+
+    def test_export_import(self):
+        start = datetime.datetime(2016, 1, 1)
+        for i in range(20):
+            _id = ObjectId.from_datetime(start + datetime.timedelta(hours=i))
+            d = self.get_fake()
+            d.update(_id=_id, age=i)
+            self.User.col.insert(d)
+        expected = sorted(self.User.col.find(), key=lambda d: d['_id'])
+
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, kwargs in [('users.bson', {}),
+                                 ('users.ndjson.gz', {'prefetch': 1}),
+                                 ('users.bson.bz2', {'chunks': 3})]:
+                path = os.path.join(tmp, name)
+                rv = self.User.export(path, batch_size=7, **kwargs)
+                assert rv.count == 20 and rv.size > 0
+
+                self.db.drop_collection(self.User.col)
+                rv = self.User.import_(path, batch_size=6)
+                assert rv.inserted_count == 20 and not rv.errors
+                assert sorted(self.User.col.find(), key=lambda d: d['_id']) == expected
+
+            # Existing and invalid documents are reported
+            self.User.col.remove({'_id': expected[0]['_id']})
+            self.User.col.update({'_id': expected[1]['_id']}, {'$set': {'age': 'wrong'}})
+            self.User.export(path, {'_id': {'$lt': expected[5]['_id']}})
+            self.db.drop_collection(self.User.col)
+            self.User.col.insert(dict(expected[2]))
+            rv = self.User.import_(path)
+            assert rv.inserted_count == 2
+            assert sorted(e['index'] for e in rv.errors) == [0, 1]
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_auto_fix(self):
+        for i in range(10):
+            d = self.get_fake()
+            d['_id'] = i
+            if i % 2:
+                d['magic'] = {'camp': 'Chaos'}
+                d['age'] = str(i)
+            if i % 3 == 0:
+                d['skills'] = [{'name': 'Break'}]
+                d['legacy'] = True
+            self.User.col.insert(d)
+        self.User.col.insert({'_id': 10, 'name': 'bad', 'age': 'unknown'})
+
+        tmp = tempfile.mkdtemp()
+        try:
+            checkpoint = FileCheckpoint(os.path.join(tmp, 'checkpoint'))
+
+            # Nothing written by a dry run
+            rv = self.User.auto_fix(dry_run=True, remove_unknown=True)
+            assert (rv.scanned, rv.fixed, rv.modified) == (11, 8, 0)
+            assert self.User.col.find_one({'_id': 1})['age'] == '1'
+
+            # Stopped after the first batch
+            class Stop(Exception):
+                pass
+
+            def stop(result):
+                raise Stop()
+
+            with assert_raises(Stop):
+                self.User.auto_fix(remove_unknown=True, batch_size=4, checkpoint=checkpoint,
+                                   progress=stop)
+            assert checkpoint.load() == 3
+            assert self.User.col.find_one({'_id': 1})['age'] == 1
+            assert self.User.col.find_one({'_id': 5})['age'] == '5'
+
+            rv = self.User.auto_fix(remove_unknown=True, batch_size=4, checkpoint=checkpoint)
+            assert (rv.scanned, rv.fixed, rv.modified) == (7, 5, 5)
+            assert rv.last_id == 10 and checkpoint.load() == 10
+            assert rv.errors[0]['_id'] == 10
+
+            for i in range(10):
+                doc = self.User.col.find_one({'_id': i})
+                self.User(doc).validate()
+                assert 'legacy' not in doc
+            assert self.User.col.find_one({'_id': 1})['magic']['spell'] == 10.1
+            assert self.User.col.find_one({'_id': 3})['skills'] == [{'name': 'Break', 'power': None}]
+
+            # Nothing left after the checkpoint
+            rv = self.User.auto_fix(checkpoint=checkpoint)
+            assert rv.scanned == 0
+        finally:
+            shutil.rmtree(tmp)
+
+        # Fixed documents are not got from the cache or the identity map
+        class CachedUser(self.User):
+            col = db['user']
+            __cache__ = LRUCache()
+
+        d = self.get_fake()
+        d.update(_id=20, age='20')
+        self.User.col.insert(d)
+        assert CachedUser.one(20)['age'] == '20'
+        with IdentityMap():
+            assert CachedUser.one(20)['age'] == '20'
+            assert CachedUser.auto_fix({'_id': 20}).modified == 1
+            assert CachedUser.one(20)['age'] == 20
+        assert CachedUser.one(20)['age'] == 20
+
+    def test_schema_upgrade(self):
+        calls = []
+
+        def add_level(doc):
+            calls.append(0)
+            doc['level'] = doc['age'] // 10
+
+        def rename_camp(doc):
+            calls.append(1)
+            doc['magic']['camp'] = doc['magic']['camp'].lower()
+
+        class VersionedUser(self.User):
+            col = db['user']
+            __schema_version__ = 2
+            __upgrades__ = {0: add_level, 1: rename_camp}
+
+        with assert_raises(StructError):
+            class BrokenUser(VersionedUser):
+                col = db['user']
+                __schema_version__ = 3
+
+        old = self.get_fake()
+        self.User.col.insert(old)
+        u = VersionedUser.one(old['_id'])
+        assert u['_v'] == 2 and u['level'] == 2 and u['magic']['camp'] == 'chaos'
+        assert calls == [0, 1]
+        # Upgraded in memory only, until written back
+        assert '_v' not in self.User.col.find_one(old['_id'])
+        assert u.changes['$set']['_v'] == 2
+        u.update_changes()
+        stored = self.User.col.find_one(old['_id'])
+        assert stored['_v'] == 2 and stored['level'] == 2
+
+        # Current documents are not upgraded
+        del calls[:]
+        u = VersionedUser.one(old['_id'])
+        assert calls == [] and u.changes == {}
+
+        # Partial documents are not upgraded
+        d = self.get_fake()
+        d['_v'] = 1
+        self.User.col.insert(d)
+        u = VersionedUser.find({'_id': d['_id']}, {'magic': 1}).next()
+        assert u['magic']['camp'] == 'Chaos' and calls == []
+        u = VersionedUser.find({'_id': d['_id']}, read_only=True).next()
+        assert u['_v'] == 2 and calls == [1]
+
+        # New documents are of the current version, inserted dicts
+        # are of the version they have
+        assert VersionedUser(self.get_fake())['_v'] == 2
+        rv = VersionedUser.insert([VersionedUser(self.get_fake()), self.get_fake()])
+        assert self.User.col.find_one(rv.inserted_ids[0])['_v'] == 2
+        assert '_v' not in self.User.col.find_one(rv.inserted_ids[1])
+
+        # An old dump is imported as it is, and upgraded when read
+        old = self.get_fake()
+        self.User.col.insert(old)
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'users.bson')
+            self.User.export(path, {'_id': old['_id']})
+            self.User.col.remove({'_id': old['_id']})
+            assert VersionedUser.import_(path).inserted_count == 1
+        finally:
+            shutil.rmtree(tmp)
+        assert '_v' not in self.User.col.find_one(old['_id'])
+        u = VersionedUser.one(old['_id'])
+        assert u['_v'] == 2 and u['level'] == 2 and u['magic']['camp'] == 'chaos'
+
+        # Written back in background
+        class WriteBehindUser(VersionedUser):
+            col = db['user']
+            __upgrade_write_behind__ = True
+
+        u = WriteBehindUser.one(d['_id'])
+        # Not written again by `update_changes`
+        assert u['_v'] == 2 and u.changes == {}
+        upgrade.write_behind.flush()
+        stored = self.User.col.find_one(d['_id'])
+        assert stored['_v'] == 2 and stored['magic']['camp'] == 'chaos'
+
+        # Changes saved before the background write are not overwritten by it
+        d = self.get_fake()
+        self.User.col.insert(d)
+        u = WriteBehindUser.one(d['_id'])
+        u['age'] = 30
+        u['magic']['camp'] = 'order'
+        u['skills'].append({'name': 'Heal', 'power': 1.0})
+        u.update_changes()
+        upgrade.write_behind.flush()
+        stored = self.User.col.find_one(d['_id'])
+        assert stored['_v'] == 2 and stored['level'] == 2
+        assert stored['age'] == 30 and stored['magic']['camp'] == 'order'
+        assert len(stored['skills']) == 2
+
+    def test_indexes(self):
+        with assert_raises(StructError):
+            class BadIndexUser(self.User):
+                col = db['user']
+                indexes = ['magic.power']
+
+        class IndexedUser(self.User):
+            col = db['user']
+            indexes = [
+                'name',
+                [('magic.camp', 1), ('age', -1)],
+                {'keys': 'id', 'unique': True, 'sparse': True},
+            ]
+
+        rv = IndexedUser.ensure_indexes(create=False)
+        assert rv.created == ['name_1', 'magic.camp_1_age_-1', 'id_1']
+        assert IndexedUser.col.index_information().keys() == ['_id_']
+
+        rv = IndexedUser.ensure_indexes()
+        assert rv.created == ['name_1', 'magic.camp_1_age_-1', 'id_1']
+        assert sorted(IndexedUser.col.index_information()) == [
+            '_id_', 'id_1', 'magic.camp_1_age_-1', 'name_1']
+        assert IndexedUser.ensure_indexes().created == []
+
+        # Changed or undeclared indexes are reported, not changed
+        IndexedUser.indexes = ['name', 'id', 'skills.name']
+        rv = IndexedUser.ensure_indexes()
+        assert rv.created == ['skills.name_1']
+        assert [c[0] for c in rv.conflicts] == ['id_1']
+        assert rv.undeclared == ['magic.camp_1_age_-1']
+
+        results = Document.ensure_all_indexes(create=False)
+        assert results['simplemongo.test.models_test.IndexedUser'].created == []
+
+    def test_plan_guard(self):
+        class GuardedUser(self.User):
+            col = db['user']
+            indexes = ['name']
+            __plan_guard__ = PlanGuard('raise')
+
+        GuardedUser.ensure_indexes()
+        GuardedUser.col.insert(self.get_fake())
+        u = GuardedUser.one({'name': 'reorx'})
+        assert list(GuardedUser.find({'name': 'x'})) == []
+        assert GuardedUser.__plan_guard__.explained == 1
+
+        # Not checked: by `_id`, without filter
+        assert GuardedUser.one(u['_id']) == u
+        assert GuardedUser.find()[0] == u
+
+        with assert_raises(QueryPlanError):
+            GuardedUser.one({'age': 1})
+        with assert_raises(QueryPlanError):
+            GuardedUser.find({'age': 2})[0]
+
+        GuardedUser.__plan_guard__ = PlanGuard('record')
+        assert GuardedUser.find({'age': 1}).count() == 0
+        assert GuardedUser.__plan_guard__.explained == 0
+        assert list(GuardedUser.find({'age': 1}).sort('name').raw()) == []
+        assert [e.reason for e in GuardedUser.__plan_guard__.events] == ['COLLSCAN']
+
+    def test_tracing(self):
+        events = []
+        tracing.add_listener(events.append)
+        try:
+            u = self.get_new()
+            u.save()
+            u['age'] = 30
+            u.update_changes()
+            u.pull()
+            assert self.User.one(u['_id']) == u
+            assert len(list(self.User.find({'name': u['name']}))) == 1
+            assert self.User.find({'name': u['name']})[0] == u
+            self.User.insert([self.get_fake(), self.get_fake()])
+            u.remove()
+        finally:
+            tracing.remove_listener(events.append)
+        operations = [e.operation for e in events]
+        # `update_changes` is traced once, as `update_self`
+        assert operations[:6] == ['save', 'update_self', 'pull', 'one', 'find', 'find']
+        assert operations[-2:] == ['insert', 'remove']
+        assert all(e.collection == self.User.col.full_name for e in events)
+        assert events[0].count == 1 and events[0].size > 0
+        assert events[-2].count == 2
+
+    def test_references(self):
+        User = self.User
+
+        with assert_raises(StructError):
+            class BadProject(Document):
+                col = db['project']
+                struct = {'owner': str}
+                references = {'owner': User}
+
+        class ProjectReviewer(User):
+            col = db['user']
+
+        class Project(Document):
+            col = db['project']
+            struct = {
+                'name': str,
+                'owner': ObjectId,
+                'members': [ObjectId],
+                'review': {'reviewer': ObjectId},
+            }
+            references = {
+                'owner': User,
+                'members': User,
+                'review.reviewer': 'ProjectReviewer',
+            }
+
+        users = [User(self.get_fake()) for _ in range(4)]
+        for u in users:
+            u.save()
+        for i in range(5):
+            Project({
+                'name': 'p%s' % i,
+                'owner': users[i % 4]['_id'],
+                'members': [users[0]['_id'], ObjectId(), users[(i + 1) % 4]['_id']],
+                'review': {'reviewer': users[3]['_id'] if i else None},
+            }).save()
+
+        def queries():
+            return len([i for i in User.col.log if i[0] == 'find'])
+
+        try:
+            before = queries()
+            projects = list(Project.find().prefetch('owner', 'members', 'review.reviewer'))
+            assert queries() - before == 2
+            for i, p in enumerate(projects):
+                assert p.ref('owner') == users[i % 4]
+                assert p.ref('members') == [users[0], users[(i + 1) % 4]]
+                assert p.ref('review.reviewer') == (users[3] if i else None)
+                assert isinstance(p.ref('members')[0], User)
+            assert type(projects[1].ref('review.reviewer')) is ProjectReviewer
+            assert queries() - before == 2
+
+            # Resolved by document without prefetch
+            p = Project.one({'name': 'p1'})
+            assert p.ref('owner') == users[1]
+            assert queries() - before == 3
+
+            # Documents in the identity map are not fetched again
+            with IdentityMap():
+                owner = User.one(users[2]['_id'])
+                before = queries()
+                p = Project.find({'name': 'p2'}).prefetch('owner', depth=1).next()
+                assert p.ref('owner') is owner
+                assert queries() == before
+
+            with assert_raises(AssertionError):
+                Project.find().prefetch('name')
+        finally:
+            db.drop_collection(Project.col)
+
+    def test_get_many(self):
+        users = [self.User(self.get_fake()) for _ in range(7)]
+        for u in users:
+            u.save()
+        ids = [u['_id'] for u in users]
+        unknown = ObjectId()
+
+        def queries():
+            return len([i for i in self.User.col.log if i[0] == 'find'])
+
+        before = queries()
+        wanted = [ids[3], str(ids[0]), unknown, ids[6], ids[3]]
+        assert self.User.get_many(wanted, chunk_size=2) == [users[3], users[0], users[6], users[3]]
+        assert queries() - before == 2
+        assert self.User.get_many(wanted, missing='none') == [
+            users[3], users[0], None, users[6], users[3]]
+        assert sorted(self.User.get_many(wanted, preserve_order=False)) == sorted(
+            [users[0], users[3], users[6]])
+        with assert_raises(ObjectNotFound):
+            self.User.get_many(wanted, missing='raise')
+        with assert_raises(AssertionError):
+            self.User.get_many(wanted, preserve_order=False, missing='none')
+        with assert_raises(ValueError):
+            self.User.get_many([1])
+        assert self.User.get_many([]) == []
+
+        rv = self.User.get_many(reversed(ids), chunk_size=2, workers=3)
+        assert rv == users[::-1]
+        assert all(isinstance(u, self.User) for u in rv)
+
+        with IdentityMap():
+            u0 = self.User.one(ids[0])
+            before = queries()
+            rv = self.User.get_many([ids[1], ids[0]])
+            assert rv[1] is u0
+            assert self.User.get_many(ids[:2])[1] is rv[0]
+            assert queries() - before == 1
+
+        u = self.User.get_many(ids[:1], read_only=True, projection=['name'])[0]
+        assert u.keys() == ['_id', 'name']
+        assert u._read_only
+
     def test_one(self):
         d = self.get_fake()
 
@@ -179,6 +892,30 @@ class ModelTest(unittest.TestCase):
         with assert_raises(ObjectNotFound):
             self.User.one_or_raise({'age': 1})
 
+        assert self.User.one(query, allow_multiple=True)['name'] == 'reorx'
+
+        # Two documents too large for a single batch
+        for i in range(2):
+            self.User.col.insert({'name': 'large', 'data': 'x' * (9 * 1024 * 1024)})
+        with assert_raises(MultipleObjectsReturned):
+            self.User.one({'name': 'large'})
+
+    def test_one_by_id(self):
+        u = self.get_new()
+        u.save()
+
+        assert self.User.one(u['_id']) == u
+        assert self.User.one({'_id': u['_id']}) == u
+        assert self.User.one({'_id': {'$in': [u['_id']]}}) == u
+        assert self.User.one(ObjectId()) is None
+
+        # only an exact id skips the check of multiple results
+        for name in ('a1', 'a2'):
+            self.User.col.insert({'_id': name, 'name': name})
+        assert self.User.one('a1')['name'] == 'a1'
+        with assert_raises(MultipleObjectsReturned):
+            self.User.one(re.compile('^a'))
+
     def test_identifier(self):
         u = self.get_new()
         assert u.identifier == {'_id': u['_id']}
@@ -210,16 +947,15 @@ class ModelTest(unittest.TestCase):
         c = {
             '$set': {
                 'name': 'reorx reborn',
-                'skills': [{'name': 'Kill', 'power': None}, 1],
-                'magic': {
-                    'camp': 'Chaos',
-                    'spell': 111
-                }
+                'magic.spell': 111
             },
             '$inc': {
                 'age': 1
             },
-            '$unset': ['is_choosen']
+            '$push': {
+                'skills': {'$each': [1]}
+            },
+            '$unset': {'is_choosen': ''}
         }
         _c = u.changes
         assert _c
@@ -243,6 +979,151 @@ class ModelTest(unittest.TestCase):
         assert d['age'] == 21
         assert d['magic']['spell'] == 111.11
 
+    def test_copy_on_write(self):
+        d = self.get_fake()
+        self.User.col.insert(d)
+        u = self.User.one({'_id': d['_id']})
+
+        # nested values are shared with the snapshot until got
+        assert dict.__getitem__(u, 'magic') is u._raw['magic']
+        assert u.changes == {}
+
+        u['magic']['camp'] = 'Order'
+        u.get('skills').append({'name': 'Kill', 'power': 1.0})
+        assert u._raw['magic']['camp'] == 'Chaos'
+        assert len(u._raw['skills']) == 1
+        assert u.changes == {
+            '$set': {'magic.camp': 'Order'},
+            '$push': {'skills': {'$each': [{'name': 'Kill', 'power': 1.0}]}},
+        }
+
+        magic = u['magic']
+        u.update_changes()
+        assert u.changes == {}
+        magic['spell'] = 1.0
+        assert u.changes == {'$set': {'magic.spell': 1.0}}
+
+        u.pull()
+        assert u['magic'] == {'camp': 'Order', 'spell': 12.3}
+        assert u.changes == {}
+
+        # views detach the values too
+        u = self.User.one({'_id': d['_id']})
+        dict(u.viewitems())['magic']['camp'] = 'Chaos'
+        for v in u.viewvalues():
+            if isinstance(v, list):
+                v.append({'name': 'Heal', 'power': 2.0})
+        assert u._raw['magic']['camp'] == 'Order'
+        assert len(u._raw['skills']) == 2
+        assert u.changes == {
+            '$set': {'magic.camp': 'Chaos'},
+            '$push': {'skills': {'$each': [{'name': 'Heal', 'power': 2.0}]}},
+        }
+
+        # Read by `get_field` without copy
+        u = self.User.one({'_id': d['_id']})
+        assert get_field(u, 'magic.camp') == 'Order'
+        assert get_field(u, 'skills.name') == ['Break', 'Kill']
+        assert dict.__getitem__(u, 'magic') is u._raw['magic']
+        assert dict.__getitem__(u, 'skills') is u._raw['skills']
+
+        # `dict()` bypasses copy on write, see README
+        u = self.User.one({'_id': d['_id']})
+        assert dict(u)['magic'] is u._raw['magic']
+        assert u.copy()['magic'] is not u._raw['magic']
+
+    def test_read_only(self):
+        d = self.get_fake()
+        self.User.col.insert(d)
+
+        u = self.User.find({'_id': d['_id']}, read_only=True).next()
+        assert u == d
+        assert u.changes is None
+        with assert_raises(AssertionError):
+            u.save()
+        with assert_raises(AssertionError):
+            u.update_changes()
+
+    def test_lazy(self):
+        class LazyUser(self.User):
+            col = db['user']
+            __lazy__ = True
+
+        d = self.get_fake()
+        self.User.col.insert(d)
+
+        u = LazyUser.find({'_id': d['_id']}).next()
+        assert dict.__len__(u) == 0
+        assert u['name'] == 'reorx'
+        assert 'magic' in u and len(u) == len(d)
+        assert dict.keys(u) == ['name']
+        assert u.changes == {}
+
+        u['age'] = 21
+        u['magic']['camp'] = 'Order'
+        del u['skills']
+        assert u.changes == {
+            '$inc': {'age': 1},
+            '$set': {'magic.camp': 'Order'},
+            '$unset': {'skills': ''},
+        }
+        u.update_changes()
+        assert u.changes == {}
+
+        u = LazyUser.one(d['_id'])
+        assert u['age'] == 21
+        assert u['magic']['camp'] == 'Order'
+        assert 'skills' not in u
+        u.validate()
+        u.save()
+        assert self.User.col.find_one(d['_id'])['age'] == 21
+
+        with IdentityMap():
+            assert LazyUser.one(d['_id']) is LazyUser.find().next()
+
+        # By index, wrapped as by iterating
+        u = LazyUser.find()[0]
+        assert isinstance(u, LazyUser)
+        assert u['age'] == 21 and u.changes == {}
+        assert dict(u.viewitems()) == self.User.col.find_one(d['_id'])
+        assert isinstance(LazyUser.find().raw()[0], dict)
+        assert isinstance(LazyUser.find().bson()[0], RawBSONDocument)
+
+        with assert_raises(StructError):
+            class TrackedLazyUser(self.User):
+                col = db['user']
+                __lazy__ = True
+                __track_changes__ = True
+
+    def test_tracked_update_changes(self):
+        class TrackedUser(self.User):
+            col = db['user']
+            __track_changes__ = True
+
+        u = TrackedUser(self.get_fake())
+        u.save()
+        u = TrackedUser.one(u.identifier)
+        assert u.changes == {}
+
+        u['age'] = 21
+        u['magic']['spell'] = 111.11
+        u['skills'].append({'name': 'Kill', 'power': 1.0})
+        assert u.changes == {
+            '$set': {
+                'magic.spell': 111.11,
+                'skills': [{'name': 'Break', 'power': 9.0}, {'name': 'Kill', 'power': 1.0}],
+            },
+            '$inc': {'age': 1},
+        }
+
+        u.update_changes()
+        assert u.changes == {}
+
+        d = self.User.col.find_one(u.identifier)
+        assert d['age'] == 21
+        assert d['magic'] == {'spell': 111.11, 'camp': 'Chaos'}
+        assert len(d['skills']) == 2
+
 
 if not db:
     from nose.util import log
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+from nose.tools import assert_raises
+from pymongo import ASCENDING, DESCENDING
+from simplemongo.pagination import normalize_sort, keyset_filter, encode_token, decode_token
+from simplemongo.errors import InvalidToken
+from simplemongo.models import ObjectId
+
+
+def test_normalize_sort():
+    assert normalize_sort(None) == [('_id', ASCENDING)]
+    assert normalize_sort(['name', ('age', DESCENDING)]) == [
+        ('name', ASCENDING), ('age', DESCENDING), ('_id', ASCENDING)]
+    assert normalize_sort([('_id', DESCENDING)]) == [('_id', DESCENDING)]
+    with assert_raises(ValueError):
+        normalize_sort([('name', 'asc')])
+
+
+def test_keyset_filter():
+    assert keyset_filter([('_id', ASCENDING)], [1]) == {'_id': {'$gt': 1}}
+
+    sort = [('age', DESCENDING), ('name', ASCENDING), ('_id', ASCENDING)]
+    assert keyset_filter(sort, [20, 'reorx', 3]) == {
+        'age': {'$lte': 20},
+        '$or': [
+            {'age': {'$lt': 20}},
+            {'age': 20, 'name': {'$gt': 'reorx'}},
+            {'age': 20, 'name': 'reorx', '_id': {'$gt': 3}},
+        ],
+    }
+
+
+def test_token():
+    sort = normalize_sort([('created_at', DESCENDING)])
+    values = [datetime.datetime(2016, 1, 1), ObjectId()]
+    token = encode_token(sort, values)
+    assert '=' not in token
+    assert decode_token(token, sort) == values
+
+    with assert_raises(InvalidToken):
+        decode_token(token, normalize_sort(['created_at']))
+    with assert_raises(InvalidToken):
+        decode_token(token[:-2], sort)
+    with assert_raises(InvalidToken):
+        decode_token(u'中文', sort)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from nose.tools import assert_raises
+from bson import BSON
+from bson.son import SON
+from bson.raw_bson import RawBSONDocument
+from simplemongo.plan import query_shape, analyze_explain, PlanGuard
+from simplemongo.errors import QueryPlanError
+
+
+def test_query_shape():
+    assert query_shape(None) == ()
+    assert query_shape({'name': 'a'}) == query_shape({'name': 'b'}) == (('name', '?'), )
+    assert query_shape({'name': 'a'}) != query_shape({'age': 1})
+    assert query_shape({'age': {'$gt': 1, '$lt': 5}}) == (('age', (('$gt', '?'), ('$lt', '?'))), )
+    assert query_shape({'tags': {'$in': [1, 2]}}) == query_shape({'tags': {'$in': [3]}})
+    # An embedded document is a value
+    assert query_shape({'magic': {'camp': 'a'}}) == (('magic', '?'), )
+    assert query_shape({'$or': [{'a': 1}, {'b': {'$exists': True}}]}) == (
+        ('$or', ((('a', '?'), ), (('b', (('$exists', '?'), )), ))), )
+    assert query_shape({'skills': {'$elemMatch': {'name': 'x', 'level': {'$gt': 1}}}}) == (
+        ('skills', (('$elemMatch', (('level', (('$gt', '?'), )), ('name', '?'))), )), )
+    assert query_shape({'a': {'$not': {'$gt': 1}}}) == (('a', (('$not', (('$gt', '?'), )), )), )
+
+
+def test_analyze_explain():
+    explain = {
+        'queryPlanner': {'winningPlan': {
+            'stage': 'FETCH',
+            'inputStage': {'stage': 'OR', 'inputStages': [
+                {'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}},
+        'executionStats': {'nReturned': 2, 'totalDocsExamined': 100},
+    }
+    assert analyze_explain(explain) == (set(['FETCH', 'OR', 'IXSCAN', 'COLLSCAN']), 100, 2)
+    raw = RawBSONDocument(BSON.encode(explain))
+    assert analyze_explain(raw) == analyze_explain(explain)
+
+    sharded = {'queryPlanner': {'winningPlan': {'stage': 'SHARD_MERGE', 'shards': [
+        {'shardName': 's0', 'winningPlan': {'stage': 'IXSCAN'}}]}}}
+    assert analyze_explain(sharded) == (set(['SHARD_MERGE', 'IXSCAN']), None, None)
+
+    assert analyze_explain({'cursor': 'BasicCursor', 'nscannedObjects': 10, 'n': 1}) == (
+        set(['COLLSCAN']), 10, 1)
+    assert analyze_explain({'cursor': 'BtreeCursor name_1', 'nscannedObjects': 1, 'n': 1}) == (
+        set(), 1, 1)
+
+
+class StandInCursor(object):
+    """Has what `PlanGuard` reads from a cursor"""
+    def __init__(self, spec, stage='IXSCAN', examined=1, returned=1, sort=None):
+        self._Cursor__spec = spec
+        self._Cursor__ordering = SON(sort) if sort else None
+        self._Cursor__projection = None
+        self._Cursor__hint = None
+        self.collection = self
+        self.full_name = 'db.users'
+        self.explained = 0
+        self.plan = {
+            'queryPlanner': {'winningPlan': {'stage': stage}},
+            'executionStats': {'nReturned': returned, 'totalDocsExamined': examined},
+        }
+
+    def explain(self):
+        self.explained += 1
+        return self.plan
+
+
+def test_plan_guard():
+    with assert_raises(ValueError):
+        PlanGuard('ignore')
+
+    guard = PlanGuard('record', max_ratio=10, min_examined=100)
+    guard.check_cursor(StandInCursor({'name': 'a'}))
+    guard.check_cursor(StandInCursor({'name': 'b'}))
+    assert guard.explained == 1
+    assert guard.events == []
+
+    # Once per shape
+    guard.check_cursor(StandInCursor({'age': 1}, 'COLLSCAN'))
+    guard.check_cursor(StandInCursor({'age': 2}, 'COLLSCAN'))
+    assert guard.explained == 2
+    assert [e.reason for e in guard.events] == ['COLLSCAN']
+    assert guard.events[0].spec == {'age': 1}
+
+    # Sort is part of the shape
+    guard.check_cursor(StandInCursor({'name': 'a'}, examined=5000, returned=10, sort=[('age', 1)]))
+    assert [e.reason for e in guard.events] == ['COLLSCAN', 'ratio']
+    assert guard.events[1].sort == [('age', 1)]
+    guard.check_cursor(StandInCursor({'email': 'a'}, examined=50, returned=0))
+    assert len(guard.events) == 2
+
+    # No filter, not checked
+    cursor = StandInCursor({}, 'COLLSCAN')
+    guard.check_cursor(cursor)
+    assert cursor.explained == 0
+
+    guard = PlanGuard('raise')
+    for _ in range(2):
+        with assert_raises(QueryPlanError) as cm:
+            guard.check_cursor(StandInCursor({'age': 1}, 'COLLSCAN'))
+        assert cm.exception.args[0].reason == 'COLLSCAN'
+    assert guard.explained == 1
+    # No ratio check without `max_ratio`
+    guard.check_cursor(StandInCursor({'name': 'a'}, examined=10 ** 6, returned=1))
+
+    guard = PlanGuard('warn', max_shapes=2)
+    for i in range(3):
+        guard.check_cursor(StandInCursor({'k%s' % i: 1}))
+    assert len(guard._shapes) == 1
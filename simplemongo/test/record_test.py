@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from nose.tools import assert_raises
+from simplemongo.record import Record, make_record_class
+from simplemongo.models import ObjectId
+
+
+STRUCT = {
+    'name': str,
+    'age': int,
+    'magic': {
+        'spell': float,
+    },
+    'first-name': str,
+    'keys': [str],
+}
+
+
+def test_record():
+    UserRecord = make_record_class('UserRecord', STRUCT)
+    assert issubclass(UserRecord, Record)
+    assert UserRecord._fields[0] == '_id'
+
+    d = {'_id': ObjectId(), 'name': 'reorx', 'magic': {'spell': 1.0},
+         'first-name': 'Reorx', 'keys': ['a'], 'foo': 'bar'}
+    r = UserRecord.from_dict(d)
+    assert not hasattr(r, '__dict__')
+    assert r.name == r['name'] == 'reorx'
+    assert r['first-name'] == 'Reorx'
+    # field clashes with methods are only got by item access
+    assert r['keys'] == ['a'] and callable(r.keys)
+    assert 'age' not in r and r.get('age') is None
+    with assert_raises(KeyError):
+        r['age']
+    with assert_raises(AttributeError):
+        r.age
+    with assert_raises(KeyError):
+        r['foo'] = 1
+
+    del d['foo']
+    assert r.to_dict() == d
+    assert r == d and r == UserRecord(d)
+    assert sorted(r) == sorted(d) and len(r) == len(d)
+
+    r['age'] = 20
+    assert r.age == 20
+    del r['age']
+    assert 'age' not in r
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from nose.tools import assert_raises
+from bson.objectid import ObjectId
+from simplemongo.references import check_references, find_class, _ids
+from simplemongo.errors import StructError
+
+
+struct = {
+    'name': str,
+    'owner': ObjectId,
+    'members': [ObjectId],
+    'tasks': [{'assignee': ObjectId, 'watchers': [ObjectId]}],
+}
+
+
+class Base(object):
+    pass
+
+
+class Owner(Base):
+    pass
+
+
+class Member(Owner):
+    pass
+
+
+def test_check_references():
+    check_references({
+        'owner': Owner,
+        'members': 'Member',
+        'tasks.assignee': Owner,
+        'tasks.watchers': Owner,
+    }, struct)
+
+    for references in [{'name': Owner}, {'tasks': Owner}, {'creator': Owner}, {'owner': 1}]:
+        with assert_raises(StructError):
+            check_references(references, struct)
+    with assert_raises(StructError):
+        check_references({'owner': Owner}, None)
+
+
+def test_find_class():
+    assert find_class(Base, 'Member') is Member
+    assert find_class(Base, __name__ + '.Owner') is Owner
+    with assert_raises(StructError):
+        find_class(Base, 'Nobody')
+
+
+def test_ids():
+    a, b, c = ObjectId(), ObjectId(), ObjectId()
+    assert list(_ids(a)) == [a]
+    assert list(_ids(None)) == []
+    assert list(_ids([[a, b], None, [c], []])) == [a, b, c]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+from pymongo.errors import AutoReconnect
+from simplemongo.scan import (
+    time_split_points, sample_split_points, chunk_ranges, range_spec, _scan_chunk)
+from simplemongo.models import ObjectId
+
+
+def test_time_split_points():
+    first = ObjectId.from_datetime(datetime.datetime(2016, 1, 1))
+    last = ObjectId.from_datetime(datetime.datetime(2016, 1, 5))
+    points = time_split_points(first, last, 4)
+    assert [p.generation_time.day for p in points] == [2, 3, 4]
+    assert first < points[0] < points[-1] < last
+
+    # Fewer chunks than asked if too close
+    last = ObjectId.from_datetime(datetime.datetime(2016, 1, 1, 0, 0, 2))
+    assert len(time_split_points(first, last, 8)) == 1
+    assert time_split_points(first, first, 8) == []
+
+
+def test_sample_split_points():
+    assert sample_split_points(range(100, 0, -1), 4) == [26, 51, 76]
+    assert sample_split_points([1, 1, 1, 2], 4) == [1, 2]
+    assert sample_split_points([], 4) == []
+    assert sample_split_points([1], 4) == []
+
+
+def test_chunk_ranges():
+    assert chunk_ranges([]) == [(None, None)]
+    assert chunk_ranges([1, 5]) == [(None, 1), (1, 5), (5, None)]
+
+
+def test_range_spec():
+    assert range_spec(None, None, None) is None
+    assert range_spec({'a': 1}, None, None) == {'a': 1}
+    assert range_spec(None, 1, None) == {'_id': {'$gte': 1}}
+    assert range_spec({'a': 1}, 1, 5) == {'$and': [{'a': 1}, {'_id': {'$gte': 1, '$lt': 5}}]}
+
+
+class FakeDocument(object):
+    @classmethod
+    def find(cls, spec, **kwargs):
+        return [spec]
+
+
+def test_scan_chunk_retries():
+    calls = []
+
+    def func(cursor):
+        calls.append(cursor)
+        if len(calls) < 3:
+            raise AutoReconnect('reset')
+        return len(calls)
+
+    task = (FakeDocument, func, 1, {'a': 1}, {}, 2, (AutoReconnect, ), 0)
+    assert _scan_chunk(task) == (1, True, 3, 3)
+    assert calls == [[{'a': 1}]] * 3
+
+    del calls[:]
+    task = (FakeDocument, func, 1, {'a': 1}, {}, 1, (AutoReconnect, ), 0)
+    index, ok, error, attempts = _scan_chunk(task)
+    assert not ok and isinstance(error, AutoReconnect) and attempts == 2
+
+    # Other errors are not retried
+    def fail(cursor):
+        calls.append(cursor)
+        raise KeyError('x')
+
+    del calls[:]
+    index, ok, error, attempts = _scan_chunk(
+        (FakeDocument, fail, 0, None, {}, 2, (AutoReconnect, ), 0))
+    assert not ok and isinstance(error, KeyError) and attempts == 1
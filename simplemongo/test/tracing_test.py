@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from simplemongo import tracing
+from simplemongo.tracing import OperationEvent, HistogramCollector
+
+
+class StandInCollection(object):
+    full_name = 'db.users'
+
+
+def test_listeners():
+    events = []
+
+    def broken(event):
+        raise ValueError('broken')
+
+    tracing.add_listener(broken)
+    tracing.add_listener(events.append)
+    try:
+        tracing.emit('save', StandInCollection(), time.time(), 1, [{'a': 1}])
+    finally:
+        tracing.remove_listener(broken)
+        tracing.remove_listener(events.append)
+    assert tracing.listeners == []
+
+    event, = events
+    assert (event.operation, event.collection, event.count) == ('save', 'db.users', 1)
+    assert event.duration >= 0
+
+
+def test_event_size():
+    doc = {'name': 'reorx', 'age': 1}
+    raw = RawBSONDocument(BSON.encode(doc))
+    event = OperationEvent('find', 'db.users', 0.1, 2, [doc, raw])
+    assert event.size == 2 * len(BSON.encode(doc))
+    assert OperationEvent('remove', 'db.users', 0.1, 1).size == 0
+
+
+def test_histogram_collector():
+    collector = HistogramCollector(buckets=(0.01, 0.1), sizes=True)
+    for duration in (0.005, 0.05, 0.5):
+        collector(OperationEvent('find', 'db.users', duration, 10, [{'a': 1}]))
+    collector(OperationEvent('save', 'db.users', 0.01, 1, [{'a': 1}]))
+
+    stats = collector.stats()
+    s = stats[('find', 'db.users')]
+    assert s['count'] == 3
+    assert s['documents'] == 30
+    assert s['bytes'] == 3 * len(BSON.encode({'a': 1}))
+    assert s['buckets'] == [(0.01, 1), (0.1, 2), (float('inf'), 3)]
+    # Upper bounds are inclusive
+    assert stats[('save', 'db.users')]['buckets'][0] == (0.01, 1)
+
+    text = collector.to_prometheus()
+    lines = text.splitlines()
+    assert '# TYPE simplemongo_operation_duration_seconds histogram' in lines
+    assert ('simplemongo_operation_duration_seconds_bucket'
+            '{operation="find",collection="db.users",le="0.1"} 2') in lines
+    assert ('simplemongo_operation_duration_seconds_bucket'
+            '{operation="find",collection="db.users",le="+Inf"} 3') in lines
+    assert 'simplemongo_operation_duration_seconds_count{operation="find",collection="db.users"} 3' in lines
+    assert 'simplemongo_operation_documents_total{operation="save",collection="db.users"} 1' in lines
+    assert 'simplemongo_operation_bytes_total{operation="save",collection="db.users"} 12' in lines
+    assert text.endswith('\n')
+
+    collector.reset()
+    assert collector.stats() == {}
+    collector(OperationEvent('find', 'db."x"', 0.001, 1))
+    assert 'collection="db.\\"x\\""' in collector.to_prometheus()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+from simplemongo.tracking import TrackedDocumentMixin, TrackedDict, TrackedList
+
+
+class TrackedDoc(TrackedDocumentMixin, dict):
+    _in_db = True
+
+
+class TestTracking(object):
+    def sample(self):
+        d = TrackedDoc()
+        d._load({
+            'name': 'reorx',
+            'age': 20,
+            'attributes': {
+                'armor': 10,
+                'magic': {'spell': 1.5},
+            },
+            'slots': ['a', 'b'],
+            'skills': [{'name': 'punch'}],
+            'extra': 1,
+        })
+        return d
+
+    def test_wrap_on_access(self):
+        d = self.sample()
+        assert type(dict.__getitem__(d, 'attributes')) is dict
+
+        assert isinstance(d['attributes'], TrackedDict)
+        assert isinstance(d['attributes']['magic'], TrackedDict)
+        assert isinstance(d['slots'], TrackedList)
+        assert isinstance(d['skills'][0], TrackedDict)
+        assert d.changes == {}
+
+    def test_changes(self):
+        d = self.sample()
+        d['name'] = 'reorx reborn'
+        d['age'] += 1
+        d['attributes']['magic']['spell'] = 2.5
+        d['slots'].append('c')
+        d['skills'][0]['name'] = 'kick'
+        del d['extra']
+        d['new'] = {'foo': 1}
+        d['new']['foo'] = 2
+
+        assert d.changes == {
+            '$set': {
+                'name': 'reorx reborn',
+                'attributes.magic.spell': 2.5,
+                'slots': ['a', 'b', 'c'],
+                'skills': [{'name': 'kick'}],
+                'new': {'foo': 2},
+            },
+            '$inc': {'age': 1},
+            '$unset': {'extra': ''},
+        }
+
+        d._reset_changes()
+        assert d.changes == {}
+
+    def test_parent_covers_children(self):
+        d = self.sample()
+        d['attributes']['armor'] = 11
+        d['attributes'] = {'armor': 12}
+        assert d.changes == {'$set': {'attributes': {'armor': 12}}}
+
+    def test_no_change(self):
+        d = self.sample()
+        d['name'] = 'reorx'
+        d['age'] = 20
+        d['added'] = 1
+        del d['added']
+        assert d.changes == {}
+
+    def test_dict_methods(self):
+        d = self.sample()
+        d.update(name='foo')
+        d.setdefault('bar', 1)
+        d['attributes'].pop('armor')
+        d['attributes']['magic'].clear()
+        assert d.changes == {
+            '$set': {'name': 'foo', 'bar': 1},
+            '$unset': {'attributes.armor': '', 'attributes.magic.spell': ''},
+        }
+
+    def test_list_methods(self):
+        d = self.sample()
+        for k in ('slots', 'skills'):
+            d._reset_changes()
+            d[k].insert(0, {})
+            assert d.changes == {'$set': {k: dict.__getitem__(d, k)}}
+
+        d._reset_changes()
+        for skill in d['skills']:
+            skill['level'] = 1
+        assert d.changes == {'$set': {'skills': [{'level': 1}, {'name': 'punch', 'level': 1}]}}
+
+        d._reset_changes()
+        d['slots'][0:1] = ['x']
+        d['slots'].reverse()
+        assert d.changes == {'$set': {'slots': ['b', 'a', 'x']}}
+
+    def test_detach(self):
+        d = self.sample()
+        d['copied'] = d['attributes']
+        d._reset_changes()
+        d['copied']['armor'] = 1
+        assert d['attributes']['armor'] == 10
+        assert d.changes == {'$inc': {'copied.armor': -9}}
+
+    def test_deepcopy(self):
+        d = self.sample()
+        d['attributes']['armor'] = 1
+        c = copy.deepcopy(d)
+        assert type(c) is TrackedDoc
+        assert type(dict.__getitem__(c, 'attributes')) is dict
+        assert c == d
+        assert c.changes == d.changes
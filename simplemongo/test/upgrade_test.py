@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from nose.tools import assert_raises
+from simplemongo.upgrade import (
+    check_upgrades, compile_upgrade, changed_keys, absolute_update, WriteBehind)
+from simplemongo.errors import StructError, SchemaVersionError
+
+
+def add_age(doc):
+    doc['age'] = 0
+
+
+def split_name(doc):
+    doc['first'], doc['last'] = doc.pop('name').split(' ', 1)
+
+
+def test_check_upgrades():
+    check_upgrades(0, {})
+    check_upgrades(2, {0: add_age, 1: split_name})
+    # Documents older than 1 are not supported
+    check_upgrades(2, {1: split_name})
+
+    for version, upgrades in [
+            (-1, {}),
+            ('2', {}),
+            (2, {0: add_age}),
+            (2, {0: add_age, 2: split_name}),
+            (3, {0: add_age, 2: split_name}),
+            (2, {0: add_age, 1: None})]:
+        with assert_raises(StructError):
+            check_upgrades(version, upgrades)
+
+
+def test_compile_upgrade():
+    upgrades = {0: add_age, 1: split_name}
+    doc = {'name': 'Rei Ayanami'}
+    compile_upgrade(upgrades, 0, 2, '_v')(doc)
+    assert doc == {'first': 'Rei', 'last': 'Ayanami', 'age': 0, '_v': 2}
+
+    doc = {'name': 'Rei Ayanami', 'age': 14, '_v': 1}
+    compile_upgrade(upgrades, 1, 2, '_v')(doc)
+    assert doc == {'first': 'Rei', 'last': 'Ayanami', 'age': 14, '_v': 2}
+
+    with assert_raises(SchemaVersionError):
+        compile_upgrade({1: split_name}, 0, 2, '_v')
+
+
+def test_absolute_update():
+    doc = {'first': 'Rei', 'last': 'Ayanami', 'age': 14, 'tags': ['a', 'b'], '_v': 2}
+    upgrade = {
+        '$set': {'first': 'Rei', 'last': 'Ayanami', '_v': 2},
+        '$unset': {'name': ''},
+        '$push': {'tags': {'$each': ['b']}},
+    }
+    keys = changed_keys(upgrade)
+    assert keys == set(['first', 'last', '_v', 'name', 'tags'])
+    assert absolute_update(doc, keys) == {
+        '$set': {'first': 'Rei', 'last': 'Ayanami', 'tags': ['a', 'b'], '_v': 2},
+        '$unset': {'name': ''},
+    }
+
+    # Changes under the keys are replaced, the others are kept
+    changes = {'$inc': {'age': 1, '_v': 1}, '$push': {'tags': {'$each': ['c']}}}
+    doc['tags'].append('c')
+    assert absolute_update(doc, keys, changes) == {
+        '$inc': {'age': 1},
+        '$set': {'first': 'Rei', 'last': 'Ayanami', 'tags': ['a', 'b', 'c'], '_v': 2},
+        '$unset': {'name': ''},
+    }
+
+
+class FakeResult(object):
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class FakeCollection(object):
+    def __init__(self, name):
+        self.full_name = name
+        self.writes = []
+
+    def bulk_write(self, ops, ordered=True):
+        self.writes.append([op._filter for op in ops])
+        return FakeResult(len(ops))
+
+
+def test_write_behind():
+    writer = WriteBehind(batch_size=2, interval=0.01)
+    a, b = FakeCollection('db.a'), FakeCollection('db.b')
+    for i in range(3):
+        writer.put(a, {'_id': i}, {'$set': {'_v': 1}})
+    writer.put(b, {'_id': 0}, {'$set': {'_v': 1}})
+    writer.flush()
+    assert writer.written == 4
+    assert sum(a.writes, []) == [{'_id': 0}, {'_id': 1}, {'_id': 2}]
+    assert all(len(w) <= 2 for w in a.writes)
+    assert b.writes == [[{'_id': 0}]]
+    writer.close()
+    assert writer._thread is None
+
+    # Pending updates are written on close
+    writer.put(a, {'_id': 3}, {'$set': {'_v': 1}})
+    writer.close()
+    assert a.writes[-1] == [{'_id': 3}]
+
+
+def test_write_behind_interval():
+    # A batch is written `interval` after its first update, however
+    # often updates come in
+    writer = WriteBehind(batch_size=100, interval=0.2)
+    a = FakeCollection('db.a')
+    start = time.time()
+    for i in range(8):
+        writer.put(a, {'_id': i}, {'$set': {'_v': 1}})
+        time.sleep(0.05)
+    assert a.writes and len(a.writes[0]) < 8
+    writer.close()
+    assert sum(a.writes, []) == [{'_id': i} for i in range(8)]
+    assert time.time() - start < 1
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tracing of the operations of `Document`, e.g.::
+
+    collector = HistogramCollector()
+    tracing.add_listener(collector)
+    ...
+    print collector.to_prometheus()
+
+A listener is called with an `OperationEvent` after each of these
+operations succeeds:
+
+- 'save', 'remove', 'update_self' (also of `update_changes`), 'pull' of a document
+- 'insert' per batch sent by `Document.insert`
+- 'one' of `Document.one`, 'get_many' of the queries of `Document.get_many`
+- 'find' and 'getmore' per batch fetched by a cursor of `Document.find`
+
+Listeners are called in the thread of the operation, they should be
+fast and thread-safe. When no listener is added, an operation only
+checks that `listeners` is empty.
+"""
+
+import time
+import bisect
+import logging
+import threading
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+
+
+# Only changed by `add_listener` and `remove_listener`
+listeners = []
+
+_lock = threading.Lock()
+
+
+def add_listener(listener):
+    """Add a callable that takes an `OperationEvent`"""
+    global listeners
+    with _lock:
+        # Replaced, not changed in place, as it is iterated without lock
+        listeners = listeners + [listener]
+
+
+def remove_listener(listener):
+    global listeners
+    with _lock:
+        listeners = [i for i in listeners if i != listener]
+
+
+def _size(doc):
+    if isinstance(doc, RawBSONDocument):
+        return len(doc.raw)
+    return len(BSON.encode(doc))
+
+
+class OperationEvent(object):
+    """An operation on `collection` (full name) that took `duration`
+    seconds, on `count` documents.
+
+    `size` is the number of bytes of the BSON of `payload`, the documents
+    or specs sent or received, it is computed when first read.
+    """
+    __slots__ = ('operation', 'collection', 'duration', 'count', 'payload', '_size')
+
+    def __init__(self, operation, collection, duration, count, payload=None):
+        self.operation = operation
+        self.collection = collection
+        self.duration = duration
+        self.count = count
+        self.payload = payload
+        self._size = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = sum(_size(i) for i in self.payload or ())
+        return self._size
+
+    def __repr__(self):
+        return '<OperationEvent: %s on %s, %s documents in %.6fs>' % (
+            self.operation, self.collection, self.count, self.duration)
+
+
+def emit(operation, col, start, count, payload=None):
+    """Call the listeners with an event of an operation on `col`
+    started at `start` (by `time.time`)"""
+    event = OperationEvent(operation, col.full_name, time.time() - start, count, payload)
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception:
+            # A broken listener should not break the operation
+            logging.exception('failed to call listener %r', listener)
+
+
+# Upper bounds of the buckets of durations in seconds, like in Prometheus clients
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Histogram(object):
+    __slots__ = ('counts', 'sum', 'count', 'documents', 'bytes')
+
+    def __init__(self, buckets):
+        # The last is of durations above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.documents = 0
+        self.bytes = 0
+
+
+class HistogramCollector(object):
+    """A listener that counts operations by (operation, collection)
+    in a histogram of durations, with the number of documents, and
+    of bytes if `sizes` is on (which costs the encoding of documents
+    fetched decoded).
+
+    :param buckets: increasing upper bounds of the buckets in seconds
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, sizes=False):
+        assert list(buckets) == sorted(buckets), '`buckets` should be increasing'
+        self.buckets = tuple(buckets)
+        self.sizes = sizes
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        size = event.size if self.sizes else 0
+        index = bisect.bisect_left(self.buckets, event.duration)
+        key = (event.operation, event.collection)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = _Histogram(self.buckets)
+            h.counts[index] += 1
+            h.sum += event.duration
+            h.count += 1
+            h.documents += event.count
+            h.bytes += size
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def stats(self):
+        """Return {(operation, collection): dict of `count`, `sum` (seconds),
+        `documents`, `bytes` and `buckets` [(upper bound, cumulative count), ...]}"""
+        rv = {}
+        with self._lock:
+            for key, h in self._histograms.iteritems():
+                cumulative = 0
+                buckets = []
+                for bound, n in zip(self.buckets + (float('inf'), ), h.counts):
+                    cumulative += n
+                    buckets.append((bound, cumulative))
+                rv[key] = {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'documents': h.documents,
+                    'bytes': h.bytes,
+                    'buckets': buckets,
+                }
+        return rv
+
+    def to_prometheus(self, prefix='simplemongo'):
+        """Return the stats in the Prometheus text format"""
+        stats = sorted(self.stats().iteritems())
+        duration = prefix + '_operation_duration_seconds'
+        documents = prefix + '_operation_documents_total'
+        lines = [
+            '# HELP %s Duration of operations of documents.' % duration,
+            '# TYPE %s histogram' % duration,
+        ]
+        for (operation, collection), s in stats:
+            labels = 'operation="%s",collection="%s"' % (_escape(operation), _escape(collection))
+            for bound, n in s['buckets']:
+                lines.append('%s_bucket{%s,le="%s"} %s' % (duration, labels, _format_float(bound), n))
+            lines.append('%s_sum{%s} %s' % (duration, labels, _format_float(s['sum'])))
+            lines.append('%s_count{%s} %s' % (duration, labels, s['count']))
+        lines.append('# HELP %s Documents of operations.' % documents)
+        lines.append('# TYPE %s counter' % documents)
+        for (operation, collection), s in stats:
+            lines.append('%s{operation="%s",collection="%s"} %s' % (
+                documents, _escape(operation), _escape(collection), s['documents']))
+        if self.sizes:
+            size = prefix + '_operation_bytes_total'
+            lines.append('# HELP %s Bytes of BSON of operations.' % size)
+            lines.append('# TYPE %s counter' % size)
+            for (operation, collection), s in stats:
+                lines.append('%s{operation="%s",collection="%s"} %s' % (
+                    size, _escape(operation), _escape(collection), s['bytes']))
+        return '\n'.join(lines) + '\n'
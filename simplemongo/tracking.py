@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Change tracking for documents with `__track_changes__` turned on.
+
+Instead of keeping a snapshot and diffing against it, the document records
+the paths that are modified as they happen. Nested dicts and lists are
+wrapped into `TrackedDict` and `TrackedList` lazily, when they are accessed
+through the document, so untouched parts of a document are never copied.
+
+Mutations inside a list are recorded on the path of the list,
+as the index of an item is not stable.
+"""
+
+import copy
+
+
+# Marks the value of a path before it was first modified
+MISSING = object()
+UNKNOWN = object()
+
+
+def _untrack(value):
+    """Convert tracked containers to plain dict and list recursively"""
+    if isinstance(value, dict):
+        return dict((k, _untrack(v)) for k, v in dict.iteritems(value))
+    if isinstance(value, list):
+        return [_untrack(i) for i in list.__iter__(value)]
+    return value
+
+
+def _detach(value):
+    # A tracked container reports to the path it was wrapped at,
+    # so it should not be put in another place as it is
+    if isinstance(value, (TrackedDict, TrackedList)):
+        return _untrack(value)
+    return value
+
+
+def _track(value, root, path, collapse):
+    if isinstance(value, (TrackedDict, TrackedList)):
+        return value
+    if isinstance(value, dict):
+        tracked = TrackedDict(value)
+    elif isinstance(value, list):
+        tracked = TrackedList(value)
+    else:
+        return value
+    tracked._root = root
+    tracked._tracking_path = path
+    tracked._tracking_collapse = collapse
+    return tracked
+
+
+def _is_int(v):
+    return isinstance(v, (int, long)) and not isinstance(v, bool)
+
+
+class _DictTracking(object):
+    """Methods shared by `TrackedDict` and `TrackedDocumentMixin`"""
+    __slots__ = ()
+
+    def _key_path(self, k):
+        if self._tracking_collapse:
+            return self._tracking_path
+        if self._tracking_path is None:
+            return k
+        return self._tracking_path + '.' + k
+
+    def _changed(self, k):
+        if self._tracking_collapse:
+            old = UNKNOWN
+        else:
+            old = dict.get(self, k, MISSING)
+            if isinstance(old, (dict, list)):
+                old = UNKNOWN
+        self._tracking_root()._mark_dirty(self._key_path(k), old)
+
+    def _wrap(self, k, v):
+        tracked = _track(v, self._tracking_root(), self._key_path(k), self._tracking_collapse)
+        if tracked is not v:
+            dict.__setitem__(self, k, tracked)
+        return tracked
+
+    def __getitem__(self, k):
+        return self._wrap(k, dict.__getitem__(self, k))
+
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
+
+    def setdefault(self, k, default=None):
+        if k in self:
+            return self[k]
+        self[k] = default
+        return default
+
+    def __setitem__(self, k, v):
+        self._changed(k)
+        dict.__setitem__(self, k, _detach(v))
+
+    def __delitem__(self, k):
+        if k in self:
+            self._changed(k)
+        dict.__delitem__(self, k)
+
+    def pop(self, k, *args):
+        if k in self:
+            self._changed(k)
+        return dict.pop(self, k, *args)
+
+    def popitem(self):
+        if not self:
+            return dict.popitem(self)
+        k = next(iter(self))
+        return k, self.pop(k)
+
+    def clear(self):
+        for k in dict.keys(self):
+            self._changed(k)
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def values(self):
+        return [self[k] for k in dict.keys(self)]
+
+    def items(self):
+        return [(k, self[k]) for k in dict.keys(self)]
+
+    def itervalues(self):
+        for k in dict.keys(self):
+            yield self[k]
+
+    def iteritems(self):
+        for k in dict.keys(self):
+            yield k, self[k]
+
+
+class TrackedDict(_DictTracking, dict):
+    __slots__ = ('_root', '_tracking_path', '_tracking_collapse')
+
+    def _tracking_root(self):
+        return self._root
+
+    def __reduce__(self):
+        return (dict, (_untrack(self), ))
+
+    def __deepcopy__(self, memo):
+        return dict((copy.deepcopy(k, memo), copy.deepcopy(v, memo))
+                    for k, v in dict.iteritems(self))
+
+
+class TrackedList(list):
+    __slots__ = ('_root', '_tracking_path', '_tracking_collapse')
+
+    def _changed(self):
+        self._root._mark_dirty(self._tracking_path, UNKNOWN)
+
+    def _wrap(self, index, v):
+        tracked = _track(v, self._root, self._tracking_path, True)
+        if tracked is not v:
+            list.__setitem__(self, index, tracked)
+        return tracked
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return self._wrap(index, list.__getitem__(self, index))
+
+    def __getslice__(self, i, j):
+        return self[max(0, i):max(0, j):]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in xrange(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __setitem__(self, index, v):
+        self._changed()
+        if isinstance(index, slice):
+            v = [_detach(i) for i in v]
+        else:
+            v = _detach(v)
+        list.__setitem__(self, index, v)
+
+    def __setslice__(self, i, j, v):
+        self[max(0, i):max(0, j):] = v
+
+    def __delitem__(self, index):
+        self._changed()
+        list.__delitem__(self, index)
+
+    def __delslice__(self, i, j):
+        del self[max(0, i):max(0, j):]
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        self._changed()
+        return list.__imul__(self, n)
+
+    def append(self, v):
+        self._changed()
+        list.append(self, _detach(v))
+
+    def extend(self, iterable):
+        self._changed()
+        list.extend(self, [_detach(i) for i in iterable])
+
+    def insert(self, index, v):
+        self._changed()
+        list.insert(self, index, _detach(v))
+
+    def pop(self, *args):
+        self._changed()
+        return list.pop(self, *args)
+
+    def remove(self, v):
+        self._changed()
+        list.remove(self, v)
+
+    def reverse(self):
+        self._changed()
+        list.reverse(self)
+
+    def sort(self, *args, **kwargs):
+        self._changed()
+        list.sort(self, *args, **kwargs)
+
+    def __reduce__(self):
+        return (list, (_untrack(self), ))
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(i, memo) for i in list.__iter__(self)]
+
+
+def _resolve(doc, path):
+    o = doc
+    for k in path.split('.'):
+        if not isinstance(o, dict):
+            return MISSING
+        o = dict.get(o, k, MISSING)
+        if o is MISSING:
+            return MISSING
+    return o
+
+
+class TrackedDocumentMixin(_DictTracking):
+    """
+    Put in front of the bases of a `Document` subclass by `DocumentMetaclass`
+    when `__track_changes__` is True, overrides the snapshot based
+    implementation of `changes`.
+
+    Dirty paths are stored in `_dirty` along with the value they had
+    before the first modification (only for scalar values).
+    """
+    _tracking_path = None
+    _tracking_collapse = False
+
+    _dirty = None
+
+    def _tracking_root(self):
+        return self
+
+    def _mark_dirty(self, path, old):
+        if self._dirty is None:
+            self._dirty = {path: old}
+        elif path not in self._dirty:
+            self._dirty[path] = old
+
+    def _load(self, raw, snapshot=True):
+        # No copy needed, nested containers are copied when wrapped
+        dict.clear(self)
+        dict.update(self, raw)
+        self._dirty = None
+
+    def _reset_changes(self):
+        self._dirty = None
+
+    @property
+    def changes(self):
+        if not self._in_db:
+            return None
+        c = {}
+        if not self._dirty:
+            return c
+
+        dirty = self._dirty
+        for path in sorted(dirty):
+            # Skip paths whose parent is modified as a whole
+            index = path.rfind('.')
+            parent_dirty = False
+            while index > 0:
+                if path[:index] in dirty:
+                    parent_dirty = True
+                    break
+                index = path.rfind('.', 0, index)
+            if parent_dirty:
+                continue
+
+            old = dirty[path]
+            new = _resolve(self, path)
+            if new is MISSING:
+                if old is not MISSING:
+                    c.setdefault('$unset', {})[path] = ''
+            elif _is_int(old) and _is_int(new):
+                if new != old:
+                    c.setdefault('$inc', {})[path] = new - old
+            elif old is UNKNOWN or old is MISSING or old != new or type(old) is not type(new):
+                c.setdefault('$set', {})[path] = new
+        return c
+
+    def __deepcopy__(self, memo):
+        cls = self.__class__
+        copied = cls.__new__(cls)
+        memo[id(self)] = copied
+        copied.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        for k, v in dict.iteritems(self):
+            dict.__setitem__(copied, k, copy.deepcopy(v, memo))
+        return copied
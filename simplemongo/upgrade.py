@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Upgrade of documents on read for `Document` subclasses with
+`__schema_version__`, instead of migrating the whole collection.
+
+The version of a stored document is in the field `__version_field__`,
+a document without it is of version 0. `__upgrades__` maps a version
+to a function that modifies a document of that version in place to
+the next version, e.g.::
+
+    class User(Document):
+        __schema_version__ = 2
+        __upgrades__ = {
+            0: split_name,     # 0 -> 1
+            1: rename_score,   # 1 -> 2
+        }
+
+An older document is upgraded when it is wrapped, the functions from its
+version to the current one are chained once per version and cached
+(see `Document.get_upgrade`), a current document only costs a lookup of
+the version. The snapshot is taken before upgrading, so the upgrade is in
+`changes` and written back by the next `update_changes` or `save`, or in
+background by `write_behind` if `__upgrade_write_behind__` is on.
+
+The update written in background only `$set`s or `$unset`s the top level
+keys changed by the upgrade, if the version is still the old one. Until
+it is known to be written, `update_changes` writes these keys again with
+the changes, which also changes the version, so a newer write is never
+overwritten by the upgrade, and the upgrade is not lost if `write_behind`
+fails or is closed before writing it.
+"""
+
+import copy
+import time
+import atexit
+import logging
+import threading
+from Queue import Queue, Empty
+from collections import OrderedDict
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from . import errors
+
+
+def check_upgrades(version, upgrades):
+    """Raise `errors.StructError` if `upgrades` do not chain up
+    to `version` without gaps"""
+    if not isinstance(version, (int, long)) or version < 0:
+        raise errors.StructError('`__schema_version__` should be a non-negative int, got %r' % version)
+    for v, func in upgrades.iteritems():
+        if not isinstance(v, (int, long)) or not 0 <= v < version:
+            raise errors.StructError(
+                'key %r of `__upgrades__` should be a version lower than %s' % (v, version))
+        if not callable(func):
+            raise errors.StructError('upgrade from version %s is not callable: %r' % (v, func))
+    if upgrades:
+        for v in range(min(upgrades), version):
+            if v not in upgrades:
+                raise errors.StructError('upgrade from version %s is missing' % v)
+
+
+def compile_upgrade(upgrades, from_version, to_version, field):
+    """Return a function that upgrades a document of `from_version`
+    to `to_version` in place"""
+    steps = []
+    for v in range(from_version, to_version):
+        if v not in upgrades:
+            raise errors.SchemaVersionError(
+                'no upgrade from version %s to %s' % (from_version, to_version))
+        steps.append(upgrades[v])
+
+    def upgrade(doc):
+        for step in steps:
+            step(doc)
+        doc[field] = to_version
+
+    return upgrade
+
+
+def changed_keys(update):
+    """Return the set of top level keys of the paths in `update`"""
+    keys = set()
+    for fields in update.itervalues():
+        for path in fields:
+            keys.add(path.split('.', 1)[0])
+    return keys
+
+
+def absolute_update(doc, keys, update=None):
+    """Return `update` with the paths under top level `keys` replaced by
+    `$set` of their values in `doc`, or `$unset` if not in `doc`, so that
+    writing them again does not change the result"""
+    rv = {}
+    for op, fields in (update or {}).iteritems():
+        fields = dict((path, v) for path, v in fields.iteritems()
+                      if path.split('.', 1)[0] not in keys)
+        if fields:
+            rv[op] = fields
+    for k in keys:
+        if k in doc:
+            # Copied as it is encoded later, in another thread
+            rv.setdefault('$set', {})[k] = copy.deepcopy(doc[k])
+        else:
+            rv.setdefault('$unset', {})[k] = ''
+    return rv
+
+
+# Put in the queue of `WriteBehind` to stop the thread
+_STOP = object()
+
+
+class WriteBehind(object):
+    """Write the updates of upgraded documents in a background thread,
+    in `bulk_write` batches of at most `batch_size` per collection,
+    gathered for at most `interval` seconds.
+
+    `close` is called at exit to write the pending updates, those not
+    written in time are lost, the documents are then upgraded again
+    when read.
+    """
+    def __init__(self, batch_size=100, interval=1.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.failed = 0
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, col, spec, update):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    thread = threading.Thread(target=self._run, name='simplemongo_write_behind')
+                    thread.daemon = True
+                    thread.start()
+                    self._thread = thread
+        self._queue.put((col, spec, update))
+
+    def flush(self):
+        """Wait until the updates put so far are written"""
+        self._queue.join()
+
+    def close(self, timeout=5):
+        """Write the pending updates and stop the thread,
+        wait for at most `timeout` seconds"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _run(self):
+        queue = self._queue
+        stop = False
+        while not stop:
+            batch = [queue.get()]
+            # The whole batch waits for at most `interval`
+            deadline = time.time() + self.interval
+            try:
+                while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    batch.append(queue.get(timeout=timeout))
+            except Empty:
+                pass
+            if batch[-1] is _STOP:
+                stop = True
+            try:
+                self._write([i for i in batch if i is not _STOP])
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _write(self, batch):
+        by_col = OrderedDict()
+        for col, spec, update in batch:
+            by_col.setdefault(col.full_name, (col, []))[1].append(UpdateOne(spec, update))
+        for name, (col, ops) in by_col.iteritems():
+            try:
+                rv = col.bulk_write(ops, ordered=False)
+            except PyMongoError:
+                logging.exception('failed to write %s upgraded documents of %s', len(ops), name)
+                self.failed += len(ops)
+                continue
+            # Not matched if the document was written meanwhile
+            self.written += rv.matched_count
+            logging.debug('wrote %s of %s upgraded documents of %s',
+                          rv.matched_count, len(ops), name)
+
+
+write_behind = WriteBehind()
+
+atexit.register(write_behind.close)